@@ -0,0 +1,158 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : admission.py
+Description : Admission control for the API servers: a token bucket rate
+              limit for each user, and a cap on the number of requests
+              handled at once, turning requests away straight away when
+              either is exceeded.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import math
+import threading
+import time
+
+from schema import RequestError
+
+
+class _Bucket:
+    """The token bucket for one user."""
+
+    __slots__ = ("tokens", "updated", "lock")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.lock = threading.Lock()
+
+
+class AdmissionController:
+    """Decides whether to handle a request or turn it away.
+
+    Each user has a token bucket holding up to burst tokens, refilled at
+    rate tokens a second; a request takes a token, and a user whose bucket
+    is empty gets an HTTP 429 error. Separately, no more than max_in_flight
+    requests (from all users) are handled at once; any more get an HTTP
+    503 error rather than queueing up. Both errors carry a Retry-After
+    header. A limit which is None isn't applied.
+
+    Every decision takes constant time, and only holds a lock for a few
+    arithmetic operations: one per user for the rate limit, so users never
+    wait on each other's buckets, and one shared lock for the in-flight
+    count."""
+
+    def __init__(self, rate=None, burst=None, max_in_flight=None,
+                 retry_after=1):
+        """Create an admission controller. burst defaults to rate (and is
+        at least 1), and retry_after is the number of seconds clients are
+        told to wait after a 503 error. A rate of 0 turns rate limiting
+        off, like None; a negative rate raises a ValueError."""
+
+        if rate is not None and rate < 0:
+            raise ValueError(f"The admission rate must not be negative, "
+                             f"not {rate}")
+        self._rate = rate or None
+        self._burst = max(burst or rate or 1, 1)
+        self._max_in_flight = max_in_flight
+        self._retry_after = retry_after
+        self._buckets = {}
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "admitted": 0,
+            "rate_limited": 0,
+            "shed": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        """Create an admission controller from the admission section of the
+        configuration. If the section is missing or not enabled, nothing
+        is limited."""
+
+        admission_config = config.get('admission') or {}
+        if not admission_config.get('enabled', False):
+            return cls()
+        return cls(rate=admission_config.get('rate'),
+                   burst=admission_config.get('burst'),
+                   max_in_flight=admission_config.get('max_in_flight'),
+                   retry_after=admission_config.get('retry_after', 1))
+
+    @property
+    def stats(self):
+        """Get the number of requests admitted, rate limited and shed, and
+        the number in flight."""
+
+        return dict(self._stats, in_flight=self._in_flight)
+
+    def acquire_slot(self):
+        """Count a request as in flight, raising a RequestError (503) if
+        there are already max_in_flight requests in flight. Every
+        successful call must be matched by a call to release_slot."""
+
+        if self._max_in_flight is None:
+            return
+        with self._lock:
+            if self._in_flight >= self._max_in_flight:
+                self._stats["shed"] += 1
+                raise RequestError(
+                    503, 'The server is too busy; try again later',
+                    {'Retry-After': str(self._retry_after)})
+            self._in_flight += 1
+
+    def release_slot(self):
+        """Count a request as no longer in flight."""
+
+        if self._max_in_flight is None:
+            return
+        with self._lock:
+            self._in_flight -= 1
+
+    def check_rate(self, user):
+        """Take a token from a user's bucket, raising a RequestError (429)
+        if it is empty."""
+
+        if self._rate is None:
+            self._stats["admitted"] += 1
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets.setdefault(user,
+                                              _Bucket(self._burst, now))
+        with bucket.lock:
+            tokens = min(self._burst,
+                         bucket.tokens + (now - bucket.updated) * self._rate)
+            bucket.updated = now
+            if tokens < 1:
+                bucket.tokens = tokens
+                self._stats["rate_limited"] += 1
+                retry_after = math.ceil((1 - tokens) / self._rate)
+                raise RequestError(
+                    429, 'Too many requests; slow down',
+                    {'Retry-After': str(retry_after)})
+            bucket.tokens = tokens - 1
+        self._stats["admitted"] += 1
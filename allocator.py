@@ -0,0 +1,149 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : allocator.py
+Description : Block ("hi/lo") allocation of numeric pastie IDs, so that the
+              shared pastie counter is only bumped once per block of IDs
+              rather than once per pastie.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import threading
+
+
+class IdAllocator:
+    """Hands out numeric pastie IDs from blocks reserved on a counter.
+
+    Each time the current block runs out, a whole block of block_size IDs
+    is reserved with a single increment of the named counter in the
+    storage engine; IDs are then handed out from that block in-process,
+    under a lock. Several processes can share a counter, each working
+    through its own blocks. IDs left over in a block when the process
+    exits are never used, so the numbering can have gaps; the stats
+    property reports how many IDs are at risk of that."""
+
+    def __init__(self, engine, block_size=1, counter_name="pasties"):
+        """Create a new allocator drawing on a counter in the given storage
+        engine. A block_size of 1 reserves one ID per counter update."""
+
+        if block_size < 1:
+            raise ValueError("The ID block size must be at least 1")
+        self._engine = engine
+        self._block_size = block_size
+        self._counter_name = counter_name
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._last_id = -1
+        self._blocks_reserved = 0
+        self._ids_reserved = 0
+        self._ids_issued = 0
+
+    @property
+    def block_size(self):
+        """Get the number of IDs reserved at a time."""
+
+        return self._block_size
+
+    @property
+    def stats(self):
+        """Get the allocator statistics as a dictionary:
+
+        - block_size: The number of IDs reserved at a time.
+        - blocks_reserved: The number of counter updates made, which is
+          also the number of times a block was exhausted.
+        - ids_reserved: The total number of IDs reserved.
+        - ids_issued: The number of IDs handed out.
+        - ids_remaining: The number of IDs left in the current block. These
+          become a gap in the numbering if the process stops now."""
+
+        with self._lock:
+            return {
+                "block_size": self._block_size,
+                "blocks_reserved": self._blocks_reserved,
+                "ids_reserved": self._ids_reserved,
+                "ids_issued": self._ids_issued,
+                "ids_remaining": self._last_id - self._next_id + 1,
+            }
+
+    def _reserve(self, count):
+        """Reserve a new block of count IDs. Must be called with the lock
+        held; any IDs left in the current block are abandoned."""
+
+        last_id = self._engine.increment_counter(self._counter_name, count)
+        self._next_id = last_id - count + 1
+        self._last_id = last_id
+        self._blocks_reserved += 1
+        self._ids_reserved += count
+
+    def allocate(self):
+        """Get the next pastie ID."""
+
+        with self._lock:
+            if self._next_id > self._last_id:
+                self._reserve(self._block_size)
+            pastie_id = self._next_id
+            self._next_id += 1
+            self._ids_issued += 1
+            return pastie_id
+
+    def allocate_many(self, count):
+        """Get a list of count pastie IDs, using at most one counter update.
+
+        The IDs left in the current block are used first. If they aren't
+        enough, a new block large enough for the rest of the request (and
+        at least block_size IDs) is reserved."""
+
+        with self._lock:
+            ids = list(range(self._next_id,
+                             min(self._last_id + 1, self._next_id + count)))
+            self._next_id += len(ids)
+            if len(ids) < count:
+                self._reserve(max(self._block_size, count - len(ids)))
+                needed = count - len(ids)
+                ids.extend(range(self._next_id, self._next_id + needed))
+                self._next_id += needed
+            self._ids_issued += count
+            return ids
+
+    @property
+    def counter_value(self):
+        """Get the counter's current value: the highest ID reserved by any
+        allocator sharing it."""
+
+        return self._engine.increment_counter(self._counter_name, 0)
+
+    def reserve_through(self, last_id):
+        """Make sure no ID up to last_id is ever handed out, for instance
+        after pasties with those IDs have been imported. The counter is
+        moved up to last_id if it is below it, and any IDs left in the
+        current block which are at or below last_id are skipped. Returns
+        the counter's value."""
+
+        with self._lock:
+            current = self.counter_value
+            if current < last_id:
+                current = self._engine.increment_counter(
+                    self._counter_name, last_id - current)
+            self._next_id = max(self._next_id, last_id + 1)
+            return current
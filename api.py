@@ -29,20 +29,288 @@ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """
 
-import yaml
+import atexit
+import os
+import threading
+import time
 
-from flask import Flask, jsonify, make_response, request, url_for, abort
+from flask import Flask, Response, make_response, request, url_for, abort, \
+    g, stream_with_context
 import flask_httpauth
 from flask_httpauth import HTTPBasicAuth
-from datastore import Datastore
+from admission import AdmissionController
+from auth import UserDB
+from datastore import ConflictError, Datastore
+from metrics import MetricsRegistry, SIZE_BUCKETS, TimedProxy
+from reaper import Reaper
+from stats import StatsReconciler
+from writebehind import QueueFullError
+import schema
+from schema import DEFAULT_MAX_BATCH_SIZE, RequestError, pastie_etag
 
 API_SERVER_VERSION = "0.0.1"
 LISTEN_PORT = 5000
+RAW_UPLOAD_TYPES = ('application/octet-stream', 'text/plain')
+# Seconds to wait before trying to warm up again after it fails
+WARM_UP_RETRY_INTERVAL = 5
 
 api_app = Flask(__name__)     # pylint disable=invalid-name
 http_auth = HTTPBasicAuth()   # pylint disable=invalid-name
-app_users = {}                # pylint disable=invalid-name
-db = Datastore()              # pylint disable=invalid-name
+metrics = MetricsRegistry()   # pylint disable=invalid-name
+
+# The services below are created by start_services in each process that
+# serves requests, never at import time (see create_app). Any of them set
+# beforehand, e.g. by tests, are kept.
+config_path = 'config.yaml'   # pylint disable=invalid-name
+db = None                     # pylint disable=invalid-name
+user_db = None                # pylint disable=invalid-name
+reaper = None                 # pylint disable=invalid-name
+stats_reconciler = None       # pylint disable=invalid-name
+admission = None              # pylint disable=invalid-name
+startup_stats = {             # pylint disable=invalid-name
+    'services_seconds': 0.0,
+    'warm_up_seconds': 0.0,
+    'cold_start_seconds': 0.0,
+}
+_services_pid = None          # pylint disable=invalid-name
+_warmed_up_pid = None         # pylint disable=invalid-name
+_started_at = None            # pylint disable=invalid-name
+_warm_up_on_first_request = False  # pylint disable=invalid-name
+_warm_up_failed_at = None     # pylint disable=invalid-name
+_services_lock = threading.Lock()  # pylint disable=invalid-name
+
+request_latency = metrics.histogram(  # pylint disable=invalid-name
+    'tammypaste_http_request_seconds', 'Latency of API requests',
+    ('route', 'method'))
+request_count = metrics.counter(      # pylint disable=invalid-name
+    'tammypaste_http_requests_total', 'Number of API requests',
+    ('route', 'method', 'status'))
+response_size = metrics.histogram(    # pylint disable=invalid-name
+    'tammypaste_http_response_bytes', 'Size of API response bodies',
+    ('route', 'method'), buckets=SIZE_BUCKETS)
+
+#############################################################################
+# Startup
+#############################################################################
+
+
+def start_services():
+    """Create the datastore, user database, reaper, statistics reconciler
+    and admission controller for this process, if they haven't been
+    already. Database connections and background threads don't survive a
+    fork, so if the process has forked since they were created, they are
+    created afresh. Nothing connects to the database until it is used."""
+    global db, user_db, reaper, stats_reconciler, admission, \
+        _services_pid  # pylint: disable=global-statement
+    if _services_pid == os.getpid():
+        return
+    with _services_lock:
+        if _services_pid == os.getpid():
+            return
+        started = time.perf_counter()
+        if _services_pid is not None:
+            db = user_db = reaper = stats_reconciler = admission = None
+        if db is None:
+            db = TimedProxy(Datastore(config_path), metrics)
+            # Insert any write-behind pasties before the worker exits.
+            atexit.register(db.close)
+        auth_config = db.config.get('auth') or {}
+        expiry_config = db.config.get('expiry') or {}
+        if user_db is None:
+            user_db = UserDB(auth_config.get('users_file', 'users.yaml'),
+                             cache_size=auth_config.get('cache_size', 1024))
+        if reaper is None:
+            reaper = Reaper(
+                db,
+                batch_size=expiry_config.get('batch_size', 100),
+                max_batches=expiry_config.get('max_batches', 50),
+                batch_pause=expiry_config.get('batch_pause', 0.05))
+        if stats_reconciler is None:
+            stats_reconciler = StatsReconciler(db)
+        if admission is None:
+            admission = AdmissionController.from_config(db.config)
+        _services_pid = os.getpid()
+        startup_stats['services_seconds'] = time.perf_counter() - started
+
+
+def warm_up():
+    """Get this process ready to take traffic: start the services, connect
+    to the database and create its indexes, and start the background
+    threads (the user database watcher, the reaper and the statistics
+    reconciler).
+
+    Pre-fork servers should call this in each worker as it starts, e.g.
+    from gunicorn's post_worker_init hook; otherwise an app made by
+    create_app calls it before serving its requests. If connecting to the
+    database fails, it isn't tried again for WARM_UP_RETRY_INTERVAL
+    seconds; until then, a RuntimeError is raised straight away."""
+    global _warmed_up_pid, \
+        _warm_up_failed_at  # pylint: disable=global-statement
+    start_services()
+    if _warmed_up_pid == os.getpid():
+        return
+    _check_warm_up_backoff()
+    with _services_lock:
+        if _warmed_up_pid == os.getpid():
+            return
+        _check_warm_up_backoff()
+        started = time.perf_counter()
+        try:
+            db.warm_up()
+        except Exception:
+            _warm_up_failed_at = time.monotonic()
+            api_app.logger.exception('Warm-up failed; retrying in %ss',
+                                     WARM_UP_RETRY_INTERVAL)
+            raise
+        _warm_up_failed_at = None
+        user_db.start_watching(
+            (db.config.get('auth') or {}).get('reload_interval', 5))
+        reaper.start(
+            (db.config.get('expiry') or {}).get('reaper_interval', 60))
+        stats_reconciler.start(
+            (db.config.get('stats') or {}).get('reconcile_interval', 300))
+        _warmed_up_pid = os.getpid()
+        startup_stats['warm_up_seconds'] = time.perf_counter() - started
+
+
+def _check_warm_up_backoff():
+    """Raise a RuntimeError if warming up failed too recently to try
+    again."""
+    failed_at = _warm_up_failed_at
+    if failed_at is not None and \
+            time.monotonic() - failed_at < WARM_UP_RETRY_INTERVAL:
+        raise RuntimeError('Warm-up failed recently; not retrying yet')
+
+
+def _after_fork():
+    """Start timing the cold start afresh in a newly forked worker."""
+    global _services_lock, _started_at, \
+        _warm_up_failed_at  # pylint: disable=global-statement
+    _services_lock = threading.Lock()
+    _warm_up_failed_at = None
+    if _started_at is not None:
+        _started_at = time.perf_counter()
+        startup_stats['cold_start_seconds'] = 0.0
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def create_app(config='config.yaml', warm_up_on_first_request=True):
+    """Get the API application, configured from the given file. This is the
+    entry point for WSGI servers, e.g. "gunicorn 'api:create_app()'".
+
+    Only the configuration file's path is noted here: the datastore and
+    the other services are created, and the database connected to, in
+    each worker process, by warm_up or before the first request. So the
+    app can safely be created before the server forks. The time from here
+    (or from the fork) to the end of the first request is reported as
+    cold_start_seconds in the tammypaste_startup metric."""
+    global config_path, _started_at, \
+        _warm_up_on_first_request  # pylint: disable=global-statement
+    config_path = config
+    _started_at = time.perf_counter()
+    _warm_up_on_first_request = warm_up_on_first_request
+    return api_app
+
+
+#############################################################################
+# Request instrumentation
+#############################################################################
+
+
+@api_app.before_request
+def start_request_timer():
+    """Note when the request started, for the request latency metrics, and
+    make sure the services are running."""
+    g.request_started = time.perf_counter()
+    if _warm_up_on_first_request:
+        try:
+            warm_up()
+        except Exception:  # pylint: disable=broad-except
+            raise RequestError(503, 'The server is not ready',
+                               {'Retry-After': str(WARM_UP_RETRY_INTERVAL)})
+    else:
+        start_services()
+
+
+@api_app.before_request
+def admit_request():
+    """Turn the request away with an HTTP 503 error if the server already
+    has as many requests in flight as it allows (see admission.py)."""
+    admission.acquire_slot()
+    g.admitted = True
+
+
+@api_app.teardown_request
+def release_request_slot(_error):
+    """Count an admitted request as no longer in flight."""
+    if g.pop('admitted', False):
+        admission.release_slot()
+
+
+@api_app.after_request
+def record_request_metrics(response):
+    """Record the latency, status and response size of a request."""
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_latency.observe(time.perf_counter() - started, route,
+                            request.method)
+    request_count.inc(route, request.method, str(response.status_code))
+    if response.content_length is not None:
+        response_size.observe(response.content_length, route,
+                              request.method)
+    if _started_at is not None and not startup_stats['cold_start_seconds']:
+        cold_start = time.perf_counter() - _started_at
+        startup_stats['cold_start_seconds'] = cold_start
+        api_app.logger.info('First request served %.3fs after startup',
+                            cold_start)
+    return response
+
+
+def datastore_gauge(stats_name):
+    """Make a gauge callback reporting one of the datastore's sets of
+    statistics (the cache or the ID allocator)."""
+    def callback():
+        source = getattr(db, stats_name, None)
+        if source is None:
+            return {}
+        return {(stat,): value for stat, value in source.stats.items()}
+    return callback
+
+
+def service_gauge(service_name):
+    """Make a gauge callback reporting the statistics of one of the
+    services (the reaper, statistics reconciler or admission
+    controller)."""
+    def callback():
+        service = globals()[service_name]
+        if service is None:
+            return {}
+        return {(stat,): value for stat, value in service.stats.items()}
+    return callback
+
+
+metrics.gauge('tammypaste_pastie_cache', 'Pastie cache statistics',
+              ('stat',), datastore_gauge('cache'))
+metrics.gauge('tammypaste_id_allocator', 'Pastie ID allocator statistics',
+              ('stat',), datastore_gauge('id_allocator'))
+metrics.gauge('tammypaste_reaper', 'Expired pastie reaper statistics',
+              ('stat',), service_gauge('reaper'))
+metrics.gauge('tammypaste_stats_reconciler',
+              'Aggregate statistics reconciliation',
+              ('stat',), service_gauge('stats_reconciler'))
+metrics.gauge('tammypaste_admission', 'Admission control statistics',
+              ('stat',), service_gauge('admission'))
+metrics.gauge('tammypaste_write_behind', 'Write-behind queue statistics',
+              ('stat',), lambda: {} if getattr(db, 'write_behind', None)
+              is None else {(stat,): value for stat, value
+                            in db.write_behind.stats.items()})
+metrics.gauge('tammypaste_startup', 'Worker startup times, in seconds',
+              ('stat',), lambda: {(stat,): value for stat, value
+                                  in startup_stats.items()})
 
 #############################################################################
 # Error handlers
@@ -52,29 +320,42 @@ db = Datastore()              # pylint disable=invalid-name
 @api_app.errorhandler(404)
 def not_found(error):
     """Error handler for 404 (pastie not found) errors."""
-    return make_response(jsonify({'error': 'Not Found', 'details': error}),
-                         404)
+    return json_response({'error': 'Not Found',
+                          'details': error.description}, 404)
+
+
+@api_app.errorhandler(RequestError)
+def request_error(error):
+    """Error handler for invalid requests."""
+    return json_response({'error': error.message}, error.status,
+                         error.headers)
+
+
+@api_app.errorhandler(ConflictError)
+def conflict(error):
+    """Error handler for updates based on an out of date pastie."""
+    return json_response({'error': 'Conflict', 'details': str(error)}, 409)
+
+
+@api_app.errorhandler(QueueFullError)
+def queue_full(error):
+    """Error handler for new pasties turned away because the write-behind
+    queue is full."""
+    return json_response({'error': str(error)}, 503, {'Retry-After': '1'})
 
 
 #############################################################################
 # Helper methods
 #############################################################################
 
-def read_userdb(filename="users.yaml"):
-    """Read the API userlist from the YAML file."""
-    with open(filename) as user_file:
-        userlist = yaml.load(user_file, Loader=yaml.FullLoader)
-    return userlist
-
-
 def validate_user_token(username, token):
     """Validate an API user exists and has the correct token."""
-    try:
-        if app_users[username] == token:
-            return True
-    except KeyError:
-        return False
-    return False
+    return user_db.verify(username, token)
+
+
+def get_api_setting(name, default=None):
+    """Get a setting from the api section of the configuration file."""
+    return (db.config.get('api') or {}).get(name, default)
 
 
 def get_next_pastie_id():
@@ -87,37 +368,53 @@ def get_pastie_by_id(pastie_id):
     return db.get_pastie(pastie_id)
 
 
+def is_raw_upload():
+    """Check if the request body is a raw pastie body (sent as
+    application/octet-stream or text/plain) rather than JSON."""
+    return request.mimetype in RAW_UPLOAD_TYPES
+
+
+def public_pastie_maker():
+    """Get the function making public pasties for the current request (see
+    schema.public_pastie_maker). The pastie URL prefix is worked out with
+    url_for once per request, rather than once per pastie."""
+    maker = g.get('public_pastie_maker')
+    if maker is None:
+        url = url_for('get_pastie', pastie_id=0, _external=True)
+        maker = g.public_pastie_maker = schema.public_pastie_maker(url[:-1])
+    return maker
+
+
 def make_public_pastie(pastie):
     """Add a URL field to a pastie for public use."""
-    new_pastie_data = {}
-    for field in pastie:
-        if field == 'id':
-            new_pastie_data['id'] = pastie['id']
-            new_pastie_data['url'] = url_for('get_pastie',
-                                             pastie_id=pastie['id'],
-                                             _external=True)
-        else:
-            new_pastie_data[field] = pastie[field]
-    return new_pastie_data
+    return public_pastie_maker()(pastie)
+
+
+def json_response(body, status=200, headers=None):
+    """Make a JSON response, serialized with schema.dump_json."""
+    return Response(schema.dump_json(body), status=status, headers=headers,
+                    mimetype='application/json')
 
 
 #############################################################################
 # Authentication Methods
 #############################################################################
 
-@http_auth.get_password
-def get_password(username):
-    """Return the password (API token) for a specified user. If the user does
-    not exist, returns None."""
-    if username in app_users.keys():
-        return app_users[username]
+@http_auth.verify_password
+def verify_password(username, token):
+    """Check the username and API token sent with a request. Returns the
+    username if they are valid, or None if not. A valid user who is over
+    their rate limit gets an HTTP 429 error."""
+    if validate_user_token(username, token):
+        admission.check_rate(username)
+        return username
     return None
 
 
 @http_auth.error_handler
 def unauthorized():
     """Return an HTTP 401 error if the user is unauthorized."""
-    return make_response(jsonify({'error': 'Unauthorized'}), 401)
+    return json_response({'error': 'Unauthorized'}, 401)
 
 
 #############################################################################
@@ -128,52 +425,218 @@ def unauthorized():
 @api_app.route('/api/pasties', methods=['GET'])
 @http_auth.login_required
 def get_pasties():
-    """Return a list of the defined pasties."""
-    pasties = db.list_pasties(None)
-    return jsonify({'pasties': [make_public_pastie(p) for p in pasties]})
+    """Return a list of the defined pasties, a page at a time.
+
+    The page size is set with the limit query parameter
+    (schema.DEFAULT_PAGE_SIZE if not given, and never more than
+    schema.MAX_PAGE_SIZE). The response includes
+    a next_cursor value; passing it back as the after_id parameter returns
+    the next page. next_cursor is None on the last page.
+
+    If format=ndjson is given, every pastie after after_id is instead
+    streamed as newline-delimited JSON, one pastie per line, as it is read
+    from the database.
+
+    If view=summary is given, each pastie is listed with just its ID, URL,
+    timestamps, size_bytes, line_count and a short preview instead of its
+    full content (see schema.parse_view).
+
+    If ids is given (a comma-separated list of up to max_batch_fetch
+    pastie IDs), just those pasties are returned, along with a list of the
+    requested IDs which were not found."""
+    if 'ids' in request.args:
+        return get_pasties_by_ids(request.args['ids'])
+
+    after_id, limit = schema.parse_list_args(request.args)
+    fields = schema.parse_view(request.args)
+
+    if request.args.get('format') == 'ndjson':
+        pasties = db.list_pasties(None, after_id=after_id, fields=fields)
+        make = public_pastie_maker()
+        return Response(stream_with_context(
+            schema.ndjson_line(make(p)) for p in pasties),
+                        mimetype='application/x-ndjson')
+
+    pasties = list(map(public_pastie_maker(),
+                       db.list_pasties(None, max_records=limit + 1,
+                                       after_id=after_id, fields=fields)))
+    return json_response(schema.make_page(pasties, limit))
+
+
+def get_pasties_by_ids(ids_arg):
+    """Return the pasties with the IDs in a comma-separated list."""
+    pastie_ids = schema.parse_ids(
+        ids_arg, get_api_setting('max_batch_fetch', DEFAULT_MAX_BATCH_SIZE))
+    found = db.get_pasties(pastie_ids)
+    make = public_pastie_maker()
+    return json_response({
+        'pasties': [make(found[i])
+                    for i in pastie_ids if i in found],
+        'missing': [i for i in pastie_ids if i not in found]
+    })
+
+
+@api_app.route('/api/pasties/search', methods=['GET'])
+@http_auth.login_required
+def search_pasties():
+    """Return the pasties whose content contains all of the words in the q
+    query parameter, best match first, a page at a time. The page size is
+    set with the limit parameter, as for get_pasties, and the response
+    includes a next_offset value to pass back as the offset parameter for
+    the next page (None on the last page), and the total number of
+    matches."""
+    query, limit, offset = schema.parse_search_args(request.args)
+    if db.search_index is None:
+        raise RequestError(501, 'Search is not enabled')
+    pasties, total = db.search_pasties(query, limit, offset)
+    return json_response(schema.make_search_page(
+        list(map(public_pastie_maker(), pasties)), total, limit, offset))
 
 
 @api_app.route('/api/pasties/<int:pastie_id>', methods=['GET'])
 @http_auth.login_required
 def get_pastie(pastie_id):
     """Return a specific pastie by numeric ID. Returns an HTTP 404 error if
-    the requested pastie does not exist."""
+    the requested pastie does not exist.
+
+    The response carries an ETag derived from the pastie's updated_at
+    timestamp. If the client sends a matching If-None-Match header, an
+    HTTP 304 response with no body is returned instead."""
+    pastie = get_pastie_by_id(pastie_id)
+    if pastie is None:
+        abort(404)
+    etag = pastie_etag(pastie)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = json_response({'pastie': make_public_pastie(pastie)})
+    response.set_etag(etag)
+    return response
+
+
+@api_app.route('/api/pasties/<int:pastie_id>/raw', methods=['GET'])
+@http_auth.login_required
+def get_pastie_raw(pastie_id):
+    """Return the content of a specific pastie by numeric ID as plain
+    text, streamed from storage a chunk at a time. Returns an HTTP 404
+    error if the requested pastie does not exist.
+
+    A single byte range may be requested with a Range header, in which case
+    an HTTP 206 response with just those bytes is returned, or an HTTP 416
+    error if the range starts past the end of the content. ETag and
+    If-None-Match work as for get_pastie."""
     pastie = get_pastie_by_id(pastie_id)
     if pastie is None:
         abort(404)
-    return jsonify({'pastie': make_public_pastie(pastie)})
+    etag = pastie_etag(pastie)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    length = db.pastie_content_length(pastie)
+    byte_range = schema.parse_range(request.headers.get('Range'), length)
+    start, end = byte_range or (0, length - 1)
+    response = Response(db.iter_pastie_content(pastie, start, end),
+                        status=206 if byte_range else 200,
+                        mimetype='text/plain')
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Length'] = str(end - start + 1)
+    if byte_range:
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{length}'
+    response.set_etag(etag)
+    return response
 
 
 @api_app.route('/api/pastie', methods=['POST'])
 @http_auth.login_required
 def new_pastie():
     """Create a new pastie and save it. Returns the newly created pastie with
-    its ID and URL properties set."""
-    if not request.json or 'content' not in request.json:
-        abort(400)
-    pastie = {
-        'content': request.json.get('content', '')
-    }
-    the_pastie = db.create_pastie(pastie)
-    return jsonify({'pastie': make_public_pastie(the_pastie)}), 201
+    its ID and URL properties set.
+
+    The pastie is normally sent as a JSON object with a content property.
+    Large pasties can instead be sent as a raw application/octet-stream or
+    text/plain body, which is streamed into storage as it is received.
+
+    The pastie can be made to expire with an expires_at (Unix timestamp)
+    or expires_in (seconds) property, or query parameter for a raw body.
+    Expired pasties are treated as deleted straight away.
+
+    The pastie's owner is the user who created it."""
+    if is_raw_upload():
+        expires_at = schema.parse_expiry(request.args)
+        pastie = {'owner': http_auth.current_user()}
+        if expires_at is not None:
+            pastie['expires_at'] = expires_at
+        the_pastie = db.create_pastie_from_stream(request.stream, pastie)
+    else:
+        pastie = schema.parse_new_pastie(request.get_json(silent=True))
+        pastie['owner'] = http_auth.current_user()
+        the_pastie = db.create_pastie(pastie)
+    return json_response({'pastie': make_public_pastie(the_pastie)}, 201)
+
+
+@api_app.route('/api/pasties/batch', methods=['POST'])
+@http_auth.login_required
+def new_pasties():
+    """Create several new pasties at once. The request body is a JSON array
+    of pastie objects, each with a content property, of at most
+    max_batch_create items.
+
+    The response has a result for each item, in the same order: either a
+    status of 201 and the new pastie, or an error status and a description
+    of the problem. The response status is 201 if every pastie was created,
+    or 207 if any of them failed."""
+    results, valid = schema.parse_batch(
+        request.get_json(silent=True),
+        get_api_setting('max_batch_create', DEFAULT_MAX_BATCH_SIZE))
+    created = db.create_pasties([dict(pastie, owner=http_auth.current_user())
+                                 for _, pastie in valid])
+    body, status = schema.batch_results(results, valid, created,
+                                        make_public_pastie)
+    return json_response(body, status)
 
 
 @api_app.route('/api/pastie/<int:pastie_id>', methods=['PUT'])
 @http_auth.login_required
 def update_pastie(pastie_id):
     """Update a specific pastie by ID. Returns an HTTP 404 error if the
-    requested pastie does not exist. Otherwise returns the updated pastie."""
+    requested pastie does not exist. Otherwise returns the updated pastie.
+    As with new_pastie, the new content may be sent as a raw body."""
     pastie = get_pastie_by_id(pastie_id)
     if pastie is None:
         abort(404)
-    if not request.json:
-        abort(400)
-    if 'content' not in request.json:
-        abort(400)
-    my_pastie = db.update_pastie(pastie_id, {
-        "content": request.json.get('content', pastie.content)
-    })
-    return jsonify({'pastie': make_public_pastie(my_pastie)})
+    try:
+        if is_raw_upload():
+            my_pastie = db.update_pastie_from_stream(pastie_id,
+                                                     request.stream)
+        else:
+            my_pastie = db.update_pastie(
+                pastie_id,
+                schema.parse_new_pastie(request.get_json(silent=True)))
+    except KeyError:
+        # Deleted by another worker since this one cached it
+        abort(404)
+    return json_response({'pastie': make_public_pastie(my_pastie)})
+
+
+@api_app.route('/api/pastie/<int:pastie_id>', methods=['PATCH'])
+@http_auth.login_required
+def patch_pastie(pastie_id):
+    """Edit a specific pastie's content in place by appending to it or
+    replacing byte ranges of it (see schema.parse_patch), without sending
+    the whole content. Returns an HTTP 404 error if the requested pastie
+    does not exist, or an HTTP 409 error if an updated_at value was sent
+    and the pastie has been updated since. Otherwise returns the updated
+    pastie."""
+    updated_at, operations = schema.parse_patch(request.get_json(silent=True))
+    try:
+        my_pastie = db.patch_pastie(pastie_id, operations, updated_at)
+    except KeyError:
+        abort(404)
+    except ValueError as err:
+        raise RequestError(400, str(err))
+    return json_response({'pastie': make_public_pastie(my_pastie)})
 
 
 @api_app.route('/api/pastie/<int:pastie_id>', methods=['DELETE'])
@@ -184,7 +647,29 @@ def delete_pastie(pastie_id):
     if not db.pastie_exists(pastie_id):
         abort(404)
     db.delete_pastie(pastie_id)
-    return jsonify({'deleted': True})
+    return json_response({'deleted': True})
+
+
+@api_app.route('/api/stats', methods=['GET'])
+@http_auth.login_required
+def get_stats():
+    """Return the number of pasties, their total size in bytes, and the
+    number of pasties owned by each user. These are kept up to date as
+    pasties are written, so this doesn't scan the database; writes made
+    through other servers are counted when the statistics are next
+    reconciled (see the stats section of the configuration file)."""
+    return json_response(schema.make_stats(
+        db.get_stats(),
+        (db.config.get('stats') or {}).get('reconcile_interval', 300)))
+
+
+@api_app.route('/api/metrics', methods=['GET'])
+@http_auth.login_required
+def get_metrics():
+    """Return the server's request and datastore metrics, in the
+    Prometheus text exposition format."""
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
 
 
 @api_app.route('/')
@@ -194,5 +679,6 @@ def index():
 
 
 if __name__ == '__main__':
-    app_users = read_userdb()     # pylint disable=invalid-name
+    create_app()
+    warm_up()
     api_app.run(port=LISTEN_PORT, debug=True)
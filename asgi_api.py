@@ -0,0 +1,588 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : asgi_api.py
+Description : Asynchronous (ASGI) version of the REST API server, serving
+              the same routes as api.py from an asyncio event loop. Run it
+              with any ASGI server, e.g. "uvicorn asgi_api:app".
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import base64
+import binascii
+import json
+import re
+import sys
+import time
+from urllib.parse import parse_qs
+
+from async_datastore import AsyncDatastore
+from admission import AdmissionController
+from auth import UserDB
+from datastore import ConflictError, Datastore
+from metrics import MetricsRegistry, SIZE_BUCKETS, TimedProxy
+from reaper import Reaper
+from stats import StatsReconciler
+from writebehind import QueueFullError
+import schema
+from schema import DEFAULT_MAX_BATCH_SIZE, RequestError
+
+API_SERVER_VERSION = "0.0.1"
+LISTEN_PORT = 5000
+
+
+class Request:
+    """The parts of an HTTP request the API routes need."""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = {name: values[-1] for name, values in
+                     parse_qs(scope.get("query_string", b"").decode("latin-1"),
+                              keep_blank_values=True).items()}
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+                        for name, value in scope.get("headers", [])}
+        self.body = body
+        self.user = None
+        scheme = scope.get("scheme", "http")
+        host = self.headers.get("host")
+        if host is None:
+            server = scope.get("server") or ("localhost", LISTEN_PORT)
+            host = f"{server[0]}:{server[1]}"
+        self.base_url = f"{scheme}://{host}{scope.get('root_path', '')}"
+
+    def json(self):
+        """Get the request body parsed as JSON, or None if it isn't."""
+
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    def if_none_match(self):
+        """Get the entity tags listed in the If-None-Match header."""
+
+        tags = set()
+        for tag in self.headers.get("if-none-match", "").split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag:
+                tags.add(tag.strip('"'))
+        return tags
+
+
+class Response:
+    """An HTTP response. body is bytes, or an async iterator of strings or
+    bytes to be streamed."""
+
+    def __init__(self, status, body=b"", content_type="application/json",
+                 headers=None):
+        self.status = status
+        self.body = body
+        self.headers = [(b"content-type", content_type.encode("latin-1"))]
+        for name, value in (headers or {}).items():
+            self.headers.append((name.lower().encode("latin-1"),
+                                 value.encode("latin-1")))
+
+    async def send(self, send):
+        """Send the response through an ASGI send callable. Returns the
+        number of body bytes sent."""
+
+        if isinstance(self.body, bytes):
+            headers = self.headers + [
+                (b"content-length", str(len(self.body)).encode("latin-1"))]
+            await send({"type": "http.response.start",
+                        "status": self.status, "headers": headers})
+            await send({"type": "http.response.body", "body": self.body})
+            return len(self.body)
+
+        await send({"type": "http.response.start", "status": self.status,
+                    "headers": self.headers})
+        size = 0
+        async for chunk in self.body:
+            data = chunk if isinstance(chunk, bytes) else \
+                chunk.encode("utf-8")
+            size += len(data)
+            await send({"type": "http.response.body", "body": data,
+                        "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        return size
+
+
+def json_response(body, status=200, headers=None):
+    """Make a JSON response."""
+
+    return Response(status, schema.dump_json(body), headers=headers)
+
+
+class PastieASGIApp:
+    """The tammypaste API as an ASGI application.
+
+    The datastore and user database are created when the server starts
+    (or on the first request, for servers which don't send lifespan
+    events), not when the module is imported. Datastore calls go through
+    an AsyncDatastore, so a blocking database never stalls the event
+    loop."""
+
+    def __init__(self, datastore=None, user_db=None,
+                 config_path="config.yaml", admission=None):
+        """Create the application. A Datastore, UserDB and
+        AdmissionController can be passed in; otherwise they are created
+        from the configuration file."""
+
+        self._config_path = config_path
+        self._datastore = datastore
+        self._user_db = user_db
+        self._db = None
+        self._reaper = None
+        self._stats_reconciler = None
+        self._admission = admission
+        self.metrics = MetricsRegistry()
+        self.metrics.gauge(
+            'tammypaste_reaper', 'Expired pastie reaper statistics',
+            ('stat',), lambda: {} if self._reaper is None else {
+                (stat,): value for stat, value in self._reaper.stats.items()})
+        self.metrics.gauge(
+            'tammypaste_stats_reconciler',
+            'Aggregate statistics reconciliation',
+            ('stat',), lambda: {} if self._stats_reconciler is None else {
+                (stat,): value for stat, value
+                in self._stats_reconciler.stats.items()})
+        self.metrics.gauge(
+            'tammypaste_admission', 'Admission control statistics',
+            ('stat',), lambda: {} if self._admission is None else {
+                (stat,): value for stat, value
+                in self._admission.stats.items()})
+        self._request_latency = self.metrics.histogram(
+            'tammypaste_http_request_seconds', 'Latency of API requests',
+            ('route', 'method'))
+        self._request_count = self.metrics.counter(
+            'tammypaste_http_requests_total', 'Number of API requests',
+            ('route', 'method', 'status'))
+        self._response_size = self.metrics.histogram(
+            'tammypaste_http_response_bytes', 'Size of API response bodies',
+            ('route', 'method'), buckets=SIZE_BUCKETS)
+        # (method, rule, handler, login required) for each route
+        routes = [
+            ('GET', '/api/pasties', self.get_pasties, True),
+            ('GET', '/api/pasties/search', self.search_pasties, True),
+            ('GET', '/api/pasties/<int:pastie_id>', self.get_pastie, True),
+            ('GET', '/api/pasties/<int:pastie_id>/raw', self.get_pastie_raw,
+             True),
+            ('POST', '/api/pastie', self.new_pastie, True),
+            ('POST', '/api/pasties/batch', self.new_pasties, True),
+            ('PUT', '/api/pastie/<int:pastie_id>', self.update_pastie, True),
+            ('PATCH', '/api/pastie/<int:pastie_id>', self.patch_pastie,
+             True),
+            ('DELETE', '/api/pastie/<int:pastie_id>', self.delete_pastie,
+             True),
+            ('GET', '/api/stats', self.get_stats, True),
+            ('GET', '/api/metrics', self.get_metrics, True),
+            ('GET', '/', self.index, False),
+        ]
+        self._routes = [
+            (method, rule,
+             re.compile("^" + rule.replace("<int:pastie_id>",
+                                           r"(?P<pastie_id>\d+)") + "$"),
+             handler, login_required)
+            for method, rule, handler, login_required in routes]
+
+    @property
+    def db(self):
+        """Get the AsyncDatastore, creating it if need be."""
+
+        if self._db is None:
+            self.startup()
+        return self._db
+
+    @property
+    def admission(self):
+        """Get the AdmissionController, starting the server if need be."""
+
+        if self._admission is None:
+            self.startup()
+        return self._admission
+
+    def startup(self):
+        """Create the datastore, user database and admission controller,
+        connect to the database and create its indexes (see
+        Datastore.warm_up), and start the expired pastie reaper and the
+        statistics reconciler."""
+
+        if self._db is not None:
+            return
+        if self._datastore is None:
+            self._datastore = Datastore(self._config_path)
+        datastore = TimedProxy(self._datastore, self.metrics)
+        datastore.warm_up()
+        asgi_config = datastore.config.get('asgi') or {}
+        self._db = AsyncDatastore(datastore,
+                                  asgi_config.get('max_db_threads', 16))
+        if self._admission is None:
+            self._admission = AdmissionController.from_config(
+                datastore.config)
+        expiry_config = datastore.config.get('expiry') or {}
+        self._reaper = Reaper(datastore,
+                              batch_size=expiry_config.get('batch_size', 100),
+                              max_batches=expiry_config.get('max_batches', 50),
+                              batch_pause=expiry_config.get('batch_pause',
+                                                            0.05))
+        self._reaper.start(expiry_config.get('reaper_interval', 60))
+        self._stats_reconciler = StatsReconciler(datastore)
+        self._stats_reconciler.start(
+            (datastore.config.get('stats') or {}).get('reconcile_interval',
+                                                      300))
+        if self._user_db is None:
+            auth_config = datastore.config.get('auth') or {}
+            self._user_db = UserDB(
+                auth_config.get('users_file', 'users.yaml'),
+                cache_size=auth_config.get('cache_size', 1024))
+            self._user_db.start_watching(
+                auth_config.get('reload_interval', 5))
+
+    def shutdown(self):
+        """Stop the user database watcher, the reaper, the statistics
+        reconciler and the datastore threads, and insert any pasties still
+        in the write-behind queue."""
+
+        if self._user_db is not None:
+            self._user_db.stop_watching()
+        if self._reaper is not None:
+            self._reaper.stop()
+        if self._stats_reconciler is not None:
+            self._stats_reconciler.stop()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            self._datastore.close()
+
+    def get_api_setting(self, name, default=None):
+        """Get a setting from the api section of the configuration file."""
+
+        return (self.db.config.get('api') or {}).get(name, default)
+
+    @staticmethod
+    def public_pastie_maker(request):
+        """Get a function making public pasties for a request (see
+        schema.public_pastie_maker)."""
+
+        return schema.public_pastie_maker(f"{request.base_url}/api/pasties/")
+
+    def make_public_pastie(self, request, pastie):
+        """Add a URL field to a pastie for public use."""
+
+        return self.public_pastie_maker(request)(pastie)
+
+    #########################################################################
+    # ASGI plumbing
+    #########################################################################
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        started = time.perf_counter()
+        admission = self.admission
+        try:
+            admission.acquire_slot()
+        except RequestError as err:
+            # Turned away before the body is even read.
+            response = json_response({'error': err.message}, err.status,
+                                     err.headers)
+            await response.send(send)
+            self._request_count.inc('shed', scope["method"],
+                                    str(response.status))
+            return
+        try:
+            body = b""
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body += message.get("body", b"")
+                if not message.get("more_body", False):
+                    break
+
+            request = Request(scope, body)
+            rule, response = await self._dispatch(request)
+            size = await response.send(send)
+        finally:
+            admission.release_slot()
+        self._request_latency.observe(time.perf_counter() - started, rule,
+                                      request.method)
+        self._request_count.inc(rule, request.method, str(response.status))
+        self._response_size.observe(size, rule, request.method)
+
+    async def _dispatch(self, request):
+        allowed = False
+        for method, rule, pattern, handler, login_required in self._routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            if method != request.method:
+                allowed = True
+                continue
+            kwargs = {name: int(value)
+                      for name, value in match.groupdict().items()}
+            if login_required and not await self._authorized(request):
+                return rule, json_response(
+                    {'error': 'Unauthorized'}, 401,
+                    {'www-authenticate': 'Basic realm="Authentication '
+                                         'Required"'})
+            try:
+                if login_required:
+                    self.admission.check_rate(request.user)
+                return rule, await handler(request, **kwargs)
+            except RequestError as err:
+                return rule, json_response({'error': err.message},
+                                           err.status, err.headers)
+            except QueueFullError as err:
+                return rule, json_response({'error': str(err)}, 503,
+                                           {'retry-after': '1'})
+        if allowed:
+            return 'unmatched', json_response(
+                {'error': 'Method Not Allowed'}, 405)
+        return 'unmatched', not_found('The requested URL was not found')
+
+    async def _authorized(self, request):
+        """Check the HTTP basic authentication credentials of a request,
+        noting the user in request.user if they are valid. The check
+        (PBKDF2, for a token not verified recently) runs on the datastore's
+        worker threads, so a burst of bad credentials can't stall the event
+        loop."""
+
+        header = request.headers.get("authorization", "")
+        scheme, _, credentials = header.partition(" ")
+        if scheme.lower() != "basic":
+            return False
+        try:
+            decoded = base64.b64decode(credentials).decode("utf-8")
+        except (binascii.Error, UnicodeDecodeError):
+            return False
+        username, _, token = decoded.partition(":")
+        db = self.db
+        if not await db.run_blocking(self._user_db.verify, username, token):
+            return False
+        request.user = username
+        return True
+
+    #########################################################################
+    # API methods
+    #########################################################################
+
+    async def get_pasties(self, request):
+        """Return a list of the defined pasties, a page at a time, as an
+        NDJSON stream, or by a list of IDs, as for api.get_pasties."""
+
+        if 'ids' in request.args:
+            pastie_ids = schema.parse_ids(
+                request.args['ids'],
+                self.get_api_setting('max_batch_fetch',
+                                     DEFAULT_MAX_BATCH_SIZE))
+            found = await self.db.get_pasties(pastie_ids)
+            make = self.public_pastie_maker(request)
+            return json_response({
+                'pasties': [make(found[i])
+                            for i in pastie_ids if i in found],
+                'missing': [i for i in pastie_ids if i not in found]
+            })
+
+        after_id, limit = schema.parse_list_args(request.args)
+        fields = schema.parse_view(request.args)
+        make = self.public_pastie_maker(request)
+        if request.args.get('format') == 'ndjson':
+            async def lines():
+                async for pastie in self.db.list_pasties(
+                        None, after_id=after_id, fields=fields):
+                    yield schema.ndjson_line(make(pastie))
+            return Response(200, lines(),
+                            content_type='application/x-ndjson')
+
+        pasties = [make(pastie) async for pastie
+                   in self.db.list_pasties(None, max_records=limit + 1,
+                                           after_id=after_id,
+                                           fields=fields)]
+        return json_response(schema.make_page(pasties, limit))
+
+    async def search_pasties(self, request):
+        """Return the pasties matching a full-text search, as for
+        api.search_pasties."""
+
+        query, limit, offset = schema.parse_search_args(request.args)
+        if self.db.datastore.search_index is None:
+            raise RequestError(501, 'Search is not enabled')
+        pasties, total = await self.db.search_pasties(query, limit, offset)
+        return json_response(schema.make_search_page(
+            list(map(self.public_pastie_maker(request), pasties)),
+            total, limit, offset))
+
+    async def get_pastie(self, request, pastie_id):
+        """Return a specific pastie by numeric ID, honoring If-None-Match."""
+
+        pastie = await self.db.get_pastie(pastie_id)
+        if pastie is None:
+            return not_found('The requested pastie was not found')
+        etag = schema.pastie_etag(pastie)
+        headers = {'etag': f'"{etag}"'}
+        if etag in request.if_none_match():
+            return Response(304, headers=headers)
+        return json_response(
+            {'pastie': self.make_public_pastie(request, pastie)},
+            headers=headers)
+
+    async def get_pastie_raw(self, request, pastie_id):
+        """Return the content of a specific pastie as plain text, honoring
+        Range and If-None-Match, as for api.get_pastie_raw."""
+
+        pastie = await self.db.get_pastie(pastie_id)
+        if pastie is None:
+            return not_found('The requested pastie was not found')
+        etag = schema.pastie_etag(pastie)
+        headers = {'etag': f'"{etag}"'}
+        if etag in request.if_none_match():
+            return Response(304, headers=headers)
+
+        length = await self.db.pastie_content_length(pastie)
+        byte_range = schema.parse_range(request.headers.get('range'),
+                                        length)
+        start, end = byte_range or (0, length - 1)
+        headers['accept-ranges'] = 'bytes'
+        headers['content-length'] = str(end - start + 1)
+        if byte_range:
+            headers['content-range'] = f'bytes {start}-{end}/{length}'
+        return Response(206 if byte_range else 200,
+                        self.db.iter_pastie_content(pastie, start, end),
+                        content_type='text/plain; charset=utf-8',
+                        headers=headers)
+
+    async def new_pastie(self, request):
+        """Create a new pastie and save it."""
+
+        pastie = schema.parse_new_pastie(request.json())
+        pastie['owner'] = request.user
+        the_pastie = await self.db.create_pastie(pastie)
+        return json_response(
+            {'pastie': self.make_public_pastie(request, the_pastie)}, 201)
+
+    async def new_pasties(self, request):
+        """Create several new pasties at once."""
+
+        results, valid = schema.parse_batch(
+            request.json(),
+            self.get_api_setting('max_batch_create', DEFAULT_MAX_BATCH_SIZE))
+        created = await self.db.create_pasties(
+            [dict(pastie, owner=request.user) for _, pastie in valid])
+        body, status = schema.batch_results(
+            results, valid, created,
+            lambda pastie: self.make_public_pastie(request, pastie))
+        return json_response(body, status)
+
+    async def update_pastie(self, request, pastie_id):
+        """Update a specific pastie by ID."""
+
+        pastie_data = schema.parse_new_pastie(request.json())
+        try:
+            my_pastie = await self.db.update_pastie(pastie_id, pastie_data)
+        except KeyError:
+            return not_found('The requested pastie was not found')
+        return json_response(
+            {'pastie': self.make_public_pastie(request, my_pastie)})
+
+    async def patch_pastie(self, request, pastie_id):
+        """Edit a specific pastie's content in place."""
+
+        updated_at, operations = schema.parse_patch(request.json())
+        try:
+            my_pastie = await self.db.patch_pastie(pastie_id, operations,
+                                                   updated_at)
+        except KeyError:
+            return not_found('The requested pastie was not found')
+        except ValueError as err:
+            raise RequestError(400, str(err))
+        except ConflictError as err:
+            return json_response({'error': 'Conflict',
+                                  'details': str(err)}, 409)
+        return json_response(
+            {'pastie': self.make_public_pastie(request, my_pastie)})
+
+    async def delete_pastie(self, request, pastie_id):
+        """Delete a pastie."""
+
+        if not await self.db.delete_pastie(pastie_id):
+            return not_found('The requested pastie was not found')
+        return json_response({'deleted': True})
+
+    async def get_stats(self, request):
+        """Return the aggregate statistics about the stored pasties, as for
+        api.get_stats."""
+
+        return json_response(schema.make_stats(
+            await self.db.get_stats(),
+            (self.db.config.get('stats') or {}).get('reconcile_interval',
+                                                    300)))
+
+    async def get_metrics(self, request):
+        """Return the server's metrics in the Prometheus text format."""
+
+        return Response(200, self.metrics.render().encode("utf-8"),
+                        content_type='text/plain; version=0.0.4')
+
+    async def index(self, request):
+        """Return some basic information about the pastie server."""
+
+        return Response(200, f"tammypaste API server v{API_SERVER_VERSION} "
+                             f"(ASGI) on port {LISTEN_PORT}".encode("utf-8"),
+                        content_type='text/html; charset=utf-8')
+
+
+def not_found(details):
+    """Make a 404 (pastie not found) error response."""
+
+    return json_response({'error': 'Not Found', 'details': details}, 404)
+
+
+app = PastieASGIApp()     # pylint disable=invalid-name
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("The ASGI server needs uvicorn (or another ASGI server)")
+    uvicorn.run(app, port=LISTEN_PORT)
@@ -0,0 +1,190 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : async_datastore.py
+Description : Asynchronous (asyncio) interface to the Datastore, used by the
+              ASGI API server (asgi_api.py).
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import asyncio
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of pasties read from the database per step of an async listing.
+ITER_BATCH_SIZE = 100
+
+
+class AsyncDatastore:
+    """The Datastore interface as coroutines.
+
+    Operations on a blocking storage engine (mongodb or SQLite) are run on
+    a bounded pool of worker threads, so the event loop is never blocked
+    waiting on the database and the number of database operations in
+    flight is capped at max_threads, however many clients are connected.
+    Operations on a non-blocking engine (the in-memory one) are run
+    directly on the event loop."""
+
+    def __init__(self, datastore, max_threads=16):
+        """Wrap a Datastore (or a proxy for one)."""
+
+        self._datastore = datastore
+        self._inline = not datastore.engine.blocking
+        self._executor = None
+        if not self._inline:
+            self._executor = ThreadPoolExecutor(
+                max_threads, thread_name_prefix="datastore")
+
+    @property
+    def datastore(self):
+        """Get the wrapped Datastore."""
+
+        return self._datastore
+
+    @property
+    def config(self):
+        """Get the configuration of the wrapped Datastore."""
+
+        return self._datastore.config
+
+    async def _call(self, method, *args, **kwargs):
+        """Run a Datastore method without blocking the event loop."""
+
+        if self._inline:
+            return method(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(method, *args, **kwargs))
+
+    async def run_blocking(self, function, *args):
+        """Run a blocking function which isn't a Datastore method, such as
+        a password check, on the worker threads. Unlike _call, this never
+        runs on the event loop, even for a non-blocking engine (the loop's
+        default executor is used then)."""
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(function, *args))
+
+    async def get_pasties_count(self):
+        """Get the number of pasties in the database."""
+
+        return await self._call(self._datastore.get_pasties_count)
+
+    async def get_stats(self):
+        """Get the aggregate statistics about the stored pasties."""
+
+        return await self._call(self._datastore.get_stats)
+
+    async def get_pastie(self, pastie_id):
+        """Look up a pastie by its numeric ID."""
+
+        return await self._call(self._datastore.get_pastie, pastie_id)
+
+    async def get_pasties(self, pastie_ids):
+        """Look up several pasties by numeric ID at once."""
+
+        return await self._call(self._datastore.get_pasties, pastie_ids)
+
+    async def pastie_exists(self, pastie_id):
+        """Check if a pastie with the given numeric ID exists."""
+
+        return await self._call(self._datastore.pastie_exists, pastie_id)
+
+    async def create_pastie(self, pastie_data):
+        """Create a new pastie."""
+
+        return await self._call(self._datastore.create_pastie, pastie_data)
+
+    async def create_pasties(self, pasties_data):
+        """Create several new pasties at once."""
+
+        return await self._call(self._datastore.create_pasties,
+                                pasties_data)
+
+    async def update_pastie(self, pastie_id, pastie_data):
+        """Update a pastie's data."""
+
+        return await self._call(self._datastore.update_pastie, pastie_id,
+                                pastie_data)
+
+    async def patch_pastie(self, pastie_id, operations,
+                           expected_updated_at=None):
+        """Apply a series of edits to a pastie's content in place."""
+
+        return await self._call(self._datastore.patch_pastie, pastie_id,
+                                operations, expected_updated_at)
+
+    async def delete_pastie(self, pastie_id):
+        """Delete a pastie by its numeric ID."""
+
+        return await self._call(self._datastore.delete_pastie, pastie_id)
+
+    async def search_pasties(self, text, limit, offset=0):
+        """Search the content of the pasties."""
+
+        return await self._call(self._datastore.search_pasties, text, limit,
+                                offset)
+
+    async def list_pasties(self, query=None, max_records=None,
+                           after_id=None, fields=None):
+        """Iterate asynchronously over a list of pasties, as for
+        Datastore.list_pasties. The pasties are read from the database in
+        batches of ITER_BATCH_SIZE."""
+
+        pasties = await self._call(self._datastore.list_pasties, query,
+                                   max_records, after_id, fields)
+        while True:
+            batch = await self._call(
+                lambda: list(itertools.islice(pasties, ITER_BATCH_SIZE)))
+            if not batch:
+                return
+            for pastie in batch:
+                yield pastie
+
+    async def iter_pastie_content(self, pastie, start=0, end=None):
+        """Iterate asynchronously over a pastie's UTF-8 encoded content, as
+        for Datastore.iter_pastie_content, reading one chunk per step."""
+
+        chunks = await self._call(self._datastore.iter_pastie_content,
+                                  pastie, start, end)
+        while True:
+            chunk = await self._call(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def pastie_content_length(self, pastie):
+        """Get the length, in bytes, of a pastie's UTF-8 encoded
+        content."""
+
+        return await self._call(self._datastore.pastie_content_length,
+                                pastie)
+
+    def close(self):
+        """Shut down the worker threads."""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
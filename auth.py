@@ -0,0 +1,196 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : auth.py
+Description : API user database and token checking for the REST API
+              (api.py). Tokens are stored hashed in users.yaml.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import hashlib
+import hmac
+import os
+import sys
+import threading
+
+import yaml
+
+HASH_SCHEME = "pbkdf2_sha256"
+DEFAULT_ITERATIONS = 200000
+
+
+def hash_token(token, iterations=DEFAULT_ITERATIONS, salt=None):
+    """Hash an API token for storage in the user database.
+
+    The result has the form pbkdf2_sha256$<iterations>$<salt>$<hash>."""
+
+    if salt is None:
+        salt = os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac("sha256", token.encode("utf-8"),
+                                 salt.encode("ascii"), iterations)
+    return f"{HASH_SCHEME}${iterations}${salt}${digest.hex()}"
+
+
+def check_token(token, stored):
+    """Check a token against its stored form, in constant time.
+
+    Stored values which aren't in the hashed format are treated as legacy
+    plaintext tokens."""
+
+    if not isinstance(stored, str) or not isinstance(token, str):
+        return False
+    parts = stored.split("$")
+    if len(parts) != 4 or parts[0] != HASH_SCHEME:
+        return hmac.compare_digest(token.encode("utf-8"),
+                                   stored.encode("utf-8"))
+    _, iterations, salt, _ = parts
+    return hmac.compare_digest(hash_token(token, int(iterations), salt),
+                               stored)
+
+
+def read_userdb(filename="users.yaml"):
+    """Read the API userlist from the YAML file."""
+    with open(filename) as user_file:
+        userlist = yaml.load(user_file, Loader=yaml.FullLoader)
+    return userlist or {}
+
+
+class _UserSnapshot:
+    """One version of the user database, along with the credentials which
+    have been verified against it."""
+
+    def __init__(self, users, mtime):
+        self.users = users
+        self.mtime = mtime
+        self.verified = {}
+
+
+class UserDB:
+    """The API user database.
+
+    Users and their hashed tokens are read from a YAML file. Hashing a
+    token is deliberately slow, so once a username and token have been
+    verified, a fast digest of the token is remembered and later requests
+    with the same credentials are checked against that instead.
+
+    The file is reloaded when it changes, either on a call to
+    check_for_changes() or from a background thread started with
+    start_watching(). A reload swaps in a whole new snapshot of the users,
+    with an empty set of verified credentials, so requests never need to
+    take a lock and nothing verified against the old file outlives it."""
+
+    def __init__(self, filename="users.yaml", cache_size=1024):
+        """Create a user database backed by the given file. If the file
+        doesn't exist, the database is empty until it is created."""
+
+        self._filename = filename
+        self._cache_size = cache_size
+        self._snapshot = _UserSnapshot({}, None)
+        self._watcher = None
+        self._stop = threading.Event()
+        self.check_for_changes()
+
+    @classmethod
+    def from_dict(cls, users, cache_size=1024):
+        """Create a user database holding the given users, rather than
+        reading them from a file."""
+
+        user_db = cls(filename=None, cache_size=cache_size)
+        user_db._snapshot = _UserSnapshot(dict(users), None)
+        return user_db
+
+    @property
+    def usernames(self):
+        """Get the names of the users in the database."""
+
+        return list(self._snapshot.users)
+
+    def check_for_changes(self):
+        """Reload the user database if its file has changed since it was
+        last read. Returns True if it was reloaded."""
+
+        if self._filename is None:
+            return False
+        try:
+            mtime = os.stat(self._filename).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._snapshot.mtime:
+            return False
+        self._snapshot = _UserSnapshot(read_userdb(self._filename), mtime)
+        return True
+
+    def verify(self, username, token):
+        """Check that a user exists and has the given token."""
+
+        snapshot = self._snapshot
+        stored = snapshot.users.get(username)
+        if stored is None or token is None:
+            return False
+
+        fast_digest = hashlib.sha256(token.encode("utf-8")).digest()
+        verified = snapshot.verified.get(username)
+        if verified is not None:
+            if hmac.compare_digest(verified, fast_digest):
+                return True
+
+        if not check_token(token, stored):
+            return False
+        if len(snapshot.verified) >= self._cache_size:
+            snapshot.verified.clear()
+        snapshot.verified[username] = fast_digest
+        return True
+
+    def start_watching(self, interval=5):
+        """Start a background thread which checks the file for changes
+        every interval seconds."""
+
+        if self._watcher is not None or self._filename is None:
+            return
+
+        def watch():
+            while not self._stop.wait(interval):
+                try:
+                    self.check_for_changes()
+                except (OSError, yaml.YAMLError):
+                    pass
+
+        self._stop.clear()
+        self._watcher = threading.Thread(target=watch, daemon=True,
+                                         name="userdb-watcher")
+        self._watcher.start()
+
+    def stop_watching(self):
+        """Stop the background file watcher, if it is running."""
+
+        if self._watcher is not None:
+            self._stop.set()
+            self._watcher.join()
+            self._watcher = None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(f"Usage: {sys.argv[0]} <token>")
+    print(hash_token(sys.argv[1]))
@@ -0,0 +1,598 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : bench.py
+Description : Load and benchmark suite for the REST API (api.py). Drives
+              the API through the Flask test client, a local WSGI server or
+              the ASGI app (asgi_api.py), against an embedded datastore,
+              and compares the results with a saved baseline. Also
+              micro-benchmarks the serialization of pastie lists
+              (--serialization).
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from flask import g, jsonify, url_for
+from werkzeug.serving import WSGIRequestHandler, make_server
+import yaml
+
+from admission import AdmissionController
+import api
+from asgi_api import PastieASGIApp
+from auth import UserDB
+from datastore import Datastore
+from metrics import TimedProxy
+import schema
+from storage import make_engine
+
+OPERATIONS = ("create", "get", "list", "update", "delete")
+BENCH_USER = "bench"
+BENCH_TOKEN = "bench"
+AUTH_HEADER = "Basic YmVuY2g6YmVuY2g="     # base64 of bench:bench
+LOAD_CHUNK_SIZE = 10000
+SERIALIZATION_SIZES = (1000, 10000, 100000)
+# Run in a fresh interpreter to time a worker's cold start: importing the
+# API, creating the app, and serving a first request.
+COLD_START_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import api
+imported = time.perf_counter()
+connected_at_import = api.db is not None
+app = api.create_app(sys.argv[1])
+status = app.test_client().get('/').status_code
+print(json.dumps(dict(api.startup_stats,
+                      import_seconds=imported - started,
+                      first_request_seconds=time.perf_counter() - started,
+                      connected_at_import=connected_at_import,
+                      status=status)))
+"""
+
+
+def percentile(sorted_values, fraction):
+    """Get a percentile (0 <= fraction <= 1) of a sorted list of values,
+    using the nearest-rank method."""
+
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1,
+                      int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+class TestClientTransport:
+    """Sends requests to the API through the Flask test client."""
+
+    def __init__(self):
+        self._client = api.api_app.test_client()
+
+    def request(self, method, path, body=None):
+        """Send a request, returning the response status code."""
+
+        resp = self._client.open(path, method=method, json=body,
+                                 headers={"Authorization": AUTH_HEADER})
+        resp.get_data()
+        return resp.status_code
+
+    def close(self):
+        """Release the transport's resources."""
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """A WSGI request handler which doesn't log every request."""
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+class HTTPTransport:
+    """Sends requests to the API over HTTP, to a local WSGI server."""
+
+    def __init__(self, port):
+        self._conn = http.client.HTTPConnection("127.0.0.1", port)
+
+    def request(self, method, path, body=None):
+        """Send a request, returning the response status code."""
+
+        headers = {"Authorization": AUTH_HEADER}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        self._conn.request(method, path, body=payload, headers=headers)
+        resp = self._conn.getresponse()
+        resp.read()
+        if resp.will_close:
+            self._conn.close()
+        return resp.status
+
+    def close(self):
+        """Release the transport's resources."""
+
+        self._conn.close()
+
+
+class ASGITransport:
+    """Sends requests straight to the ASGI app, in-process. If client_delay
+    is set, the request body takes that many seconds to arrive, as it
+    would from a slow client."""
+
+    def __init__(self, app, client_delay=0):
+        self._app = app
+        self._client_delay = client_delay
+
+    async def request(self, method, path, body=None):
+        """Send a request, returning the response status code."""
+
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http", "method": method, "path": path,
+            "query_string": query.encode(), "scheme": "http",
+            "server": ("127.0.0.1", api.LISTEN_PORT),
+            "headers": [(b"authorization", AUTH_HEADER.encode()),
+                        (b"content-type", b"application/json")],
+        }
+        payload = json.dumps(body).encode() if body is not None else b""
+        status = []
+
+        async def receive():
+            if self._client_delay:
+                await asyncio.sleep(self._client_delay)
+            return {"type": "http.request", "body": payload}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+
+        await self._app(scope, receive, send)
+        return status[0]
+
+
+def setup_datastore(engine_name):
+    """Point the API at a fresh embedded datastore and a benchmark user,
+    with no admission limits."""
+
+    engine = make_engine({"engine": engine_name,
+                          "sqlite": {"path": ":memory:"}})
+    api.db = TimedProxy(Datastore(engine=engine), api.metrics)
+    api.user_db = UserDB.from_dict({BENCH_USER: BENCH_TOKEN})
+    api.admission = AdmissionController()
+    return api.db
+
+
+def load_dataset(datastore, size, content_size):
+    """Fill the datastore with size pasties, in bulk."""
+
+    for start in range(0, size, LOAD_CHUNK_SIZE):
+        count = min(LOAD_CHUNK_SIZE, size - start)
+        datastore.create_pasties([
+            {"content": f"pastie {start + i} ".ljust(content_size, "x")}
+            for i in range(count)])
+
+
+def make_requests(operation, count, dataset_size, content_size, rng):
+    """Build the list of (method, path, body) requests for an operation."""
+
+    content = "benchmark ".ljust(content_size, "y")
+    if operation == "create":
+        return [("POST", "/api/pastie", {"content": content})] * count
+    if operation == "get":
+        return [("GET", f"/api/pasties/{rng.randint(1, dataset_size)}",
+                 None) for _ in range(count)]
+    if operation == "list":
+        return [("GET", f"/api/pasties?limit=100&after_id="
+                        f"{rng.randint(0, dataset_size)}", None)
+                for _ in range(count)]
+    if operation == "update":
+        return [("PUT", f"/api/pastie/{rng.randint(1, dataset_size)}",
+                 {"content": content}) for _ in range(count)]
+    if operation == "delete":
+        ids = rng.sample(range(1, dataset_size + 1),
+                         min(count, dataset_size))
+        return [("DELETE", f"/api/pastie/{i}", None) for i in ids]
+    raise ValueError(f"Unknown operation {operation}")
+
+
+def summarize(latencies, errors, elapsed):
+    """Summarize the throughput and latency of a set of requests."""
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run_operation(requests, concurrency, make_transport, client_delay=0):
+    """Send a list of requests from concurrency threads, and summarize the
+    throughput and latency. If client_delay is set, each request holds its
+    thread for that many seconds first, as a slow client holds a worker
+    thread of a synchronous server."""
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(my_requests):
+        transport = make_transport()
+        my_latencies = []
+        my_errors = 0
+        for method, path, body in my_requests:
+            started = time.perf_counter()
+            if client_delay:
+                time.sleep(client_delay)
+            status = transport.request(method, path, body)
+            my_latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                my_errors += 1
+        transport.close()
+        with lock:
+            latencies.extend(my_latencies)
+            errors.append(my_errors)
+
+    threads = [threading.Thread(target=worker,
+                                args=(requests[i::concurrency],))
+               for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, sum(errors), elapsed)
+
+
+def run_operation_async(requests, concurrency, transport):
+    """Send a list of requests to the ASGI app from concurrency tasks on
+    one event loop, and summarize the throughput and latency."""
+
+    latencies = []
+    errors = []
+
+    async def worker(my_requests):
+        for method, path, body in my_requests:
+            started = time.perf_counter()
+            status = await transport.request(method, path, body)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors.append(status)
+
+    async def run_all():
+        await asyncio.gather(*(worker(requests[i::concurrency])
+                               for i in range(concurrency)))
+
+    started = time.perf_counter()
+    asyncio.run(run_all())
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, len(errors), elapsed)
+
+
+def run_benchmark(engine="memory", dataset_size=1000, concurrency=4,
+                  requests=500, content_size=256, operations=OPERATIONS,
+                  transport="test-client", client_delay_ms=0, seed=1):
+    """Run the benchmark and return the results as a dictionary.
+
+    transport is "test-client", "http" (a local threaded WSGI server) or
+    "asgi". client_delay_ms simulates slow clients: each request is held
+    up by that long before it reaches the application, tying up a thread
+    for the synchronous transports but only a task for "asgi"."""
+
+    rng = random.Random(seed)
+    datastore = setup_datastore(engine)
+    load_started = time.perf_counter()
+    load_dataset(datastore, dataset_size, content_size)
+    load_seconds = time.perf_counter() - load_started
+
+    client_delay = client_delay_ms / 1000
+    server = None
+    asgi_app = None
+    if transport == "asgi":
+        asgi_app = PastieASGIApp(datastore=datastore.target,
+                                 user_db=api.user_db,
+                                 admission=api.admission)
+        asgi_transport = ASGITransport(asgi_app, client_delay)
+    elif transport == "http":
+        server = make_server("127.0.0.1", 0, api.api_app, threaded=True,
+                             request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_port
+
+        def make_transport():
+            return HTTPTransport(port)
+    else:
+        make_transport = TestClientTransport
+
+    results = {}
+    try:
+        for operation in operations:
+            op_requests = make_requests(operation, requests, dataset_size,
+                                        content_size, rng)
+            if asgi_app is not None:
+                results[operation] = run_operation_async(
+                    op_requests, concurrency, asgi_transport)
+            else:
+                results[operation] = run_operation(
+                    op_requests, concurrency, make_transport, client_delay)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if asgi_app is not None:
+            asgi_app.shutdown()
+
+    return {
+        "config": {
+            "engine": engine,
+            "dataset_size": dataset_size,
+            "concurrency": concurrency,
+            "requests": requests,
+            "content_size": content_size,
+            "transport": transport,
+            "client_delay_ms": client_delay_ms,
+        },
+        "load_seconds": round(load_seconds, 3),
+        "results": results,
+    }
+
+
+def legacy_public_pastie(pastie):
+    """Make the public version of a pastie the way the API did before
+    schema.public_pastie_maker: field by field, with a url_for call for
+    each pastie. Kept as the baseline for the serialization benchmark."""
+
+    url = url_for('get_pastie', pastie_id=pastie['id'], _external=True)
+    new_pastie_data = {}
+    for field in pastie:
+        if field == 'id':
+            new_pastie_data['id'] = pastie['id']
+            new_pastie_data['url'] = url
+        elif field == '_id':
+            new_pastie_data['_id'] = str(pastie['_id'])
+        else:
+            new_pastie_data[field] = pastie[field]
+    return new_pastie_data
+
+
+def run_serialization_benchmark(sizes=SERIALIZATION_SIZES, content_size=256,
+                                repeat=3):
+    """Time turning lists of pasties into a JSON list response, the old way
+    (legacy_public_pastie and jsonify) and the current way
+    (api.public_pastie_maker and api.json_response), taking the best of
+    repeat runs. Returns the times, in milliseconds, and the speedup for
+    each list size."""
+
+    content = "benchmark ".ljust(content_size, "z")
+    results = {}
+    for size in sizes:
+        pasties = [{"_id": f"{i:024x}", "id": i, "content": content,
+                    "created_at": "2020-04-15 12:00:00.000000",
+                    "updated_at": "2020-04-15 12:00:00.000000",
+                    "owner": BENCH_USER, "size_bytes": content_size,
+                    "line_count": 1, "preview": content[:200]}
+                   for i in range(1, size + 1)]
+        timings = {"legacy": [], "fast": []}
+        with api.api_app.test_request_context("/api/pasties"):
+            for _ in range(repeat):
+                started = time.perf_counter()
+                jsonify(schema.make_page(
+                    [legacy_public_pastie(p) for p in pasties],
+                    size)).get_data()
+                timings["legacy"].append(time.perf_counter() - started)
+
+                g.pop("public_pastie_maker", None)
+                started = time.perf_counter()
+                api.json_response(schema.make_page(
+                    list(map(api.public_pastie_maker(), pasties)),
+                    size)).get_data()
+                timings["fast"].append(time.perf_counter() - started)
+        legacy, fast = min(timings["legacy"]), min(timings["fast"])
+        results[size] = {
+            "legacy_ms": round(legacy * 1000, 2),
+            "fast_ms": round(fast * 1000, 2),
+            "speedup": round(legacy / fast, 2),
+        }
+    return {"json_encoder": "json" if schema.orjson is None else "orjson",
+            "results": results}
+
+
+def measure_cold_start(engine="memory", runs=3):
+    """Time the cold start of an API worker using the given storage engine,
+    in a fresh interpreter each run: the import, the services' creation
+    and warm-up, and the time from create_app (cold_start_seconds) and from
+    the interpreter starting (first_request_seconds) to the end of the
+    first request. Returns the fastest of runs runs for each."""
+
+    with open("config.yaml") as cfg_file:
+        config = yaml.load(cfg_file, Loader=yaml.FullLoader)
+    config["database"]["engine"] = engine
+    config["database"]["sqlite"] = {"path": ":memory:"}
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml",
+                                     delete=False) as cfg_file:
+        yaml.dump(config, cfg_file)
+    try:
+        samples = []
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", COLD_START_SCRIPT, cfg_file.name],
+                check=True, capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            samples.append(json.loads(output.splitlines()[-1]))
+    finally:
+        os.unlink(cfg_file.name)
+    results = {stat: round(min(sample[stat] for sample in samples), 4)
+               for stat in ("import_seconds", "services_seconds",
+                            "warm_up_seconds", "cold_start_seconds",
+                            "first_request_seconds")}
+    results["connected_at_import"] = any(sample["connected_at_import"]
+                                         for sample in samples)
+    results["errors"] = sum(sample["status"] != 200 for sample in samples)
+    return results
+
+
+def median_results(runs):
+    """Combine the results of repeated benchmark runs into one set, taking
+    the median of each statistic of each operation, so that one noisy run
+    doesn't move the numbers compared with the baseline."""
+
+    combined = dict(runs[0], config=dict(runs[0]["config"], runs=len(runs)))
+    combined["load_seconds"] = statistics.median(
+        run["load_seconds"] for run in runs)
+    combined["results"] = {
+        operation: {stat: statistics.median(run["results"][operation][stat]
+                                            for run in runs)
+                    for stat in stats}
+        for operation, stats in runs[0]["results"].items()}
+    return combined
+
+
+def compare(results, baseline, tolerance=0.5):
+    """Compare benchmark results with a baseline. Returns a list of
+    descriptions of the regressions found: operations whose throughput
+    dropped, or whose median (p50) latency grew, by more than tolerance (a
+    fraction), or which produced errors the baseline didn't. The tail
+    latencies of a few hundred requests vary too much from run to run to
+    gate on, so they are only reported."""
+
+    regressions = []
+    for operation, current in results["results"].items():
+        base = baseline.get("results", {}).get(operation)
+        if base is None:
+            continue
+        if current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{operation}: throughput {current['throughput']}/s, "
+                f"baseline {base['throughput']}/s")
+        if current["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{operation}: p50 {current['p50_ms']} ms, "
+                f"baseline {base['p50_ms']} ms")
+        if current["errors"] > base["errors"]:
+            regressions.append(
+                f"{operation}: {current['errors']} errors, "
+                f"baseline {base['errors']}")
+    return regressions
+
+
+def print_results(results):
+    """Print a table of benchmark results."""
+
+    print(f"{'operation':<10} {'requests':>9} {'errors':>7} {'req/s':>10} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for operation, res in results["results"].items():
+        print(f"{operation:<10} {res['requests']:>9} {res['errors']:>7} "
+              f"{res['throughput']:>10} {res['p50_ms']:>9} "
+              f"{res['p95_ms']:>9} {res['p99_ms']:>9}")
+
+
+def print_serialization_results(results):
+    """Print a table of serialization benchmark results."""
+
+    print(f"JSON encoder: {results['json_encoder']}")
+    print(f"{'pasties':>9} {'legacy ms':>11} {'fast ms':>9} {'speedup':>8}")
+    for size, res in results["results"].items():
+        print(f"{size:>9} {res['legacy_ms']:>11} {res['fast_ms']:>9} "
+              f"{res['speedup']:>7}x")
+
+
+def main(argv=None):
+    """Run the benchmark from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--engine", default="memory",
+                        choices=("memory", "sqlite"))
+    parser.add_argument("--dataset-size", type=int, default=1000,
+                        help="number of pasties loaded before the run")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=500,
+                        help="number of requests per operation")
+    parser.add_argument("--content-size", type=int, default=256)
+    parser.add_argument("--operations", default=",".join(OPERATIONS))
+    parser.add_argument("--transport", default="test-client",
+                        choices=("test-client", "http", "asgi"))
+    parser.add_argument("--client-delay-ms", type=float, default=0,
+                        help="simulated slow-client delay per request")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default=None,
+                        help="baseline results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--runs", type=int, default=5,
+                        help="times the benchmark is run; the median of "
+                             "each statistic is reported")
+    parser.add_argument("--serialization", action="store_true",
+                        help="only run the pastie list serialization "
+                             "micro-benchmark")
+    parser.add_argument("--cold-start", action="store_true",
+                        help="only measure a worker's cold start time")
+    args = parser.parse_args(argv)
+
+    if args.cold_start:
+        for stat, value in measure_cold_start(args.engine).items():
+            print(f"{stat:<22} {value}")
+        return 0
+
+    if args.serialization:
+        print_serialization_results(run_serialization_benchmark(
+            content_size=args.content_size))
+        return 0
+
+    results = median_results([run_benchmark(
+        engine=args.engine, dataset_size=args.dataset_size,
+        concurrency=args.concurrency, requests=args.requests,
+        content_size=args.content_size,
+        operations=args.operations.split(","), transport=args.transport,
+        client_delay_ms=args.client_delay_ms)
+        for _ in range(max(1, args.runs))])
+    print_results(results)
+    with open(args.output, "w") as out_file:
+        json.dump(results, out_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : cache.py
+Description : Bounded read-through cache for pasties, used by the Datastore
+              (datastore.py) to avoid a database round trip for pasties
+              that are read over and over.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import threading
+import time
+
+# Rough fixed cost, in bytes, charged for each cache entry on top of the
+# size of its field names and values.
+ENTRY_OVERHEAD = 100
+
+
+def estimate_size(doc):
+    """Estimate the memory used by a cached pastie, in bytes."""
+
+    if doc is None:
+        return ENTRY_OVERHEAD
+    return ENTRY_OVERHEAD + sum(len(str(key)) + len(str(value))
+                                for key, value in doc.items())
+
+
+class PastieCache:
+    """A bounded, thread-safe LRU cache of pasties keyed by numeric ID.
+
+    Entries are evicted least recently used first once the estimated size
+    of the cache passes max_bytes, and expire ttl seconds after they were
+    stored (if ttl is set). Lookups which found no pastie are cached too, as
+    negative entries which expire after negative_ttl seconds.
+
+    Every invalidation bumps the cache generation. A reader takes the
+    generation before going to the database and passes it back to put(), so
+    a pastie read before an update or delete can't be cached after the
+    invalidation that should have removed it.
+
+    The cache only sees the changes made through its own process. With
+    several worker processes, a pastie changed or deleted by another one
+    can be served from the cache until its entry expires, so ttl bounds
+    how stale it can be."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=None,
+                 negative_ttl=5):
+        """Create a new, empty cache."""
+
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    @property
+    def generation(self):
+        """Get the current cache generation."""
+
+        return self._generation
+
+    @property
+    def stats(self):
+        """Get the cache statistics as a dictionary of counters."""
+
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "negative_hits": self._negative_hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "invalidations": self._invalidations,
+            }
+
+    def _remove(self, pastie_id):
+        """Remove an entry. Must be called with the lock held."""
+
+        _, size, _ = self._entries.pop(pastie_id)
+        self._bytes -= size
+
+    def get(self, pastie_id):
+        """Look up a pastie in the cache.
+
+        Returns a (found, pastie) tuple. If found is False the pastie isn't
+        cached; if found is True and pastie is None, the pastie is known
+        not to exist."""
+
+        with self._lock:
+            entry = self._entries.get(pastie_id)
+            if entry is None:
+                self._misses += 1
+                return False, None
+            doc, _, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                self._remove(pastie_id)
+                self._expirations += 1
+                self._misses += 1
+                return False, None
+            self._entries.move_to_end(pastie_id)
+            if doc is None:
+                self._negative_hits += 1
+                return True, None
+            self._hits += 1
+            return True, dict(doc)
+
+    def put(self, pastie_id, doc, generation=None):
+        """Store a pastie (or None, meaning it doesn't exist) in the cache.
+
+        If generation is given and the cache has been invalidated since it
+        was read, the pastie may be stale and isn't stored."""
+
+        if doc is None:
+            ttl = self._negative_ttl
+            if not ttl:
+                return
+        else:
+            ttl = self._ttl
+            doc = dict(doc)
+        size = estimate_size(doc)
+        if size > self._max_bytes:
+            return
+        expires = time.monotonic() + ttl if ttl else None
+
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if pastie_id in self._entries:
+                self._remove(pastie_id)
+            self._entries[pastie_id] = (doc, size, expires)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def invalidate(self, pastie_id):
+        """Drop any cached entry for a pastie."""
+
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            if pastie_id in self._entries:
+                self._remove(pastie_id)
+
+    def clear(self):
+        """Drop every entry in the cache."""
+
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
@@ -0,0 +1,507 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : content.py
+Description : Storage of large pastie bodies. Bodies over a size threshold
+              are compressed and stored once per distinct body, keyed by
+              their SHA-256 digest, with the pastie holding a reference.
+              Bodies uploaded as a raw stream are stored in fixed-size
+              chunks so they never need to be held in memory whole.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import hashlib
+import uuid
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_CHUNK_SIZE = 255 * 1024
+BODY_FIELDS = ("content", "content_ref", "content_file")
+# Fields summarizing a pastie's body, kept up to date whenever it is
+# written so that listings never need to read the body itself.
+SUMMARY_FIELDS = ("size_bytes", "line_count", "preview")
+# Number of characters of a body kept as its preview.
+PREVIEW_LENGTH = 200
+# A preview is never longer than this many bytes of UTF-8.
+PREVIEW_BYTES = PREVIEW_LENGTH * 4
+
+
+def count_lines(data):
+    """Count the lines in a byte string, counting a last line with no line
+    ending."""
+
+    return data.count(b"\n") + int(bool(data) and not data.endswith(b"\n"))
+
+
+def make_summary(size, line_count, head):
+    """Make the summary fields of a body of size bytes and line_count
+    lines, starting with the bytes in head."""
+
+    return {
+        "size_bytes": size,
+        "line_count": line_count,
+        "preview": head[:PREVIEW_BYTES].decode(
+            "utf-8", errors="ignore")[:PREVIEW_LENGTH],
+    }
+
+
+def _compress(codec, data):
+    """Compress a byte string with the named codec."""
+
+    if codec == "zlib":
+        return zlib.compress(data)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def _decompress(codec, data):
+    """Decompress a byte string compressed with the named codec."""
+
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return bytes(data)
+
+
+class ContentStore:
+    """Moves large pastie bodies out of the pastie documents.
+
+    When a pastie is written, a content field of at least threshold bytes
+    (UTF-8 encoded) is replaced with a content_ref field holding the SHA-256
+    digest of the body. The body itself is compressed with the configured
+    codec ("zlib", "zstd" or "none") and stored in the engine's body store,
+    where identical bodies share one copy and a reference count. Bodies
+    are only fetched and decompressed again when a pastie's content is
+    read.
+
+    Bodies written from a stream with write_stream are instead split into
+    chunks of chunk_size bytes, each compressed and stored separately
+    under a key of its own, and the pastie gets a content_file field
+    listing the keys of the full chunks and of the shorter tail chunk, if
+    any. Such bodies are not filled back in by unpack; they are read a
+    chunk at a time with iter_content. Since chunks are never changed once
+    written, an edit (see patch) only writes the chunks it touches under
+    new keys, and appending to a body only rewrites its tail."""
+
+    def __init__(self, engine, threshold=4096, codec="zlib",
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        """Create a content store for a storage engine. If threshold is
+        None, new bodies are always kept inline."""
+
+        if codec not in ("zlib", "zstd", "none"):
+            raise ValueError(f"Unknown compression codec {codec}")
+        if codec == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        self._engine = engine
+        self._threshold = threshold
+        self._codec = codec
+        self._chunk_size = chunk_size
+
+    @property
+    def threshold(self):
+        """Get the size, in bytes, from which bodies are stored
+        separately."""
+
+        return self._threshold
+
+    @property
+    def codec(self):
+        """Get the name of the compression codec for new bodies."""
+
+        return self._codec
+
+    @property
+    def chunk_size(self):
+        """Get the size, in bytes, of the chunks streamed bodies are split
+        into."""
+
+        return self._chunk_size
+
+    def pack(self, pastie):
+        """Get the form of a pastie to be written to the database, storing
+        its body separately if it is large enough. The pastie passed in is
+        not changed."""
+
+        if self._threshold is None:
+            return pastie
+        content = pastie.get("content")
+        if not isinstance(content, str) or len(content) < self._threshold:
+            return pastie
+        data = content.encode("utf-8")
+        if len(data) < self._threshold:
+            return pastie
+
+        digest = hashlib.sha256(data).hexdigest()
+        self._engine.add_body_ref(digest, {
+            "data": _compress(self._codec, data),
+            "codec": self._codec,
+            "size": len(data),
+        })
+        packed = dict(pastie, content_ref=digest)
+        del packed["content"]
+        return packed
+
+    def unpack(self, pastie):
+        """Get a pastie read from the database with its body filled back
+        in. If the pastie's body is stored inline, it is returned as-is."""
+
+        if pastie is None or "content_ref" not in pastie:
+            return pastie
+        body = self._engine.get_body(pastie["content_ref"])
+        unpacked = dict(pastie)
+        del unpacked["content_ref"]
+        if body is None:
+            unpacked["content"] = None
+        else:
+            unpacked["content"] = _decompress(
+                body["codec"], body["data"]).decode("utf-8")
+        return unpacked
+
+    def _read_chunk(self, stream):
+        """Read up to chunk_size bytes from a stream, stopping short only at
+        the end of the stream."""
+
+        parts = []
+        remaining = self._chunk_size
+        while remaining > 0:
+            data = stream.read(remaining)
+            if not data:
+                break
+            parts.append(data)
+            remaining -= len(data)
+        return b"".join(parts)
+
+    def _write_chunks(self, pieces, codec, chunk_size):
+        """Write a body, given as an iterable of byte strings, as a series
+        of chunks of chunk_size bytes (the last of which may be shorter).
+        Returns the list of the chunks' keys."""
+
+        keys = []
+
+        def put(data):
+            key = uuid.uuid4().hex
+            self._engine.put_chunk(key, _compress(codec, data))
+            keys.append(key)
+
+        buffer = b""
+        try:
+            for piece in pieces:
+                buffer += piece
+                pos = 0
+                while len(buffer) - pos >= chunk_size:
+                    put(buffer[pos:pos + chunk_size])
+                    pos += chunk_size
+                buffer = buffer[pos:]
+            if buffer:
+                put(buffer)
+        except BaseException:
+            self._engine.delete_chunks(keys)
+            raise
+        return keys
+
+    @staticmethod
+    def _file_info(keys, length, chunk_size, codec):
+        """Make the content_file field for a chunked body."""
+
+        full = length // chunk_size
+        return {
+            "length": length,
+            "chunk_size": chunk_size,
+            "codec": codec,
+            "chunks": keys[:full],
+            "tail": keys[full] if len(keys) > full else None,
+        }
+
+    @staticmethod
+    def _chunk_keys(info):
+        """Get the keys of all of a chunked body's chunks, in order."""
+
+        return info.get("chunks", []) + ([info["tail"]]
+                                         if info.get("tail") else [])
+
+    def write_stream(self, stream):
+        """Store a body read from a binary stream (anything with a read
+        method) and return the body fields for its pastie.
+
+        A body shorter than one chunk which is valid UTF-8 is decoded and
+        returned as an ordinary content field, to be stored by pack like
+        any other. Longer bodies, and short ones which aren't text, are
+        written a chunk at a time and returned as a content_file field, so
+        they are stored byte for byte; only one chunk is in memory at
+        once."""
+
+        data = self._read_chunk(stream)
+        if len(data) < self._chunk_size:
+            try:
+                return {"content": data.decode("utf-8")}
+            except UnicodeDecodeError:
+                pass
+
+        length = 0
+        newlines = 0
+        last = b""
+        head = b""
+
+        def pieces():
+            nonlocal length, newlines, last, head
+            chunk = data
+            while chunk:
+                length += len(chunk)
+                newlines += chunk.count(b"\n")
+                last = chunk[-1:]
+                if len(head) < PREVIEW_BYTES:
+                    head += chunk[:PREVIEW_BYTES - len(head)]
+                yield chunk
+                chunk = self._read_chunk(stream)
+
+        keys = self._write_chunks(pieces(), self._codec, self._chunk_size)
+        return dict(make_summary(length, newlines + int(last != b"\n"), head),
+                    content_file=self._file_info(
+                        keys, length, self._chunk_size, self._codec))
+
+    @staticmethod
+    def summarize(pastie):
+        """Get the summary fields (size_bytes, line_count and preview) of a
+        pastie's body. They are worked out from the content field if there
+        is one; otherwise they are the ones write_stream or patch returned
+        along with the body."""
+
+        if "content" not in pastie:
+            return {field: pastie[field] for field in SUMMARY_FIELDS
+                    if field in pastie}
+        data = (pastie["content"] or "").encode("utf-8")
+        return make_summary(len(data), count_lines(data), data)
+
+    def content_length(self, pastie):
+        """Get the length, in bytes, of a pastie's UTF-8 encoded body."""
+
+        if "content_file" in pastie:
+            return pastie["content_file"]["length"]
+        return len((pastie.get("content") or "").encode("utf-8"))
+
+    def iter_content(self, pastie, start=0, end=None):
+        """Iterate over the bytes of an unpacked pastie's body from offset
+        start to end (inclusive; None meaning the end of the body), as a
+        series of byte strings. Chunked bodies are read from the engine one
+        chunk at a time."""
+
+        if "content_file" not in pastie:
+            data = (pastie.get("content") or "").encode("utf-8")
+            yield data[start:None if end is None else end + 1]
+            return
+
+        info = pastie["content_file"]
+        if end is None or end >= info["length"]:
+            end = info["length"] - 1
+        if start > end:
+            return
+        chunk_size = info["chunk_size"]
+        keys = self._chunk_keys(info)[start // chunk_size:
+                                      end // chunk_size + 1]
+        offset = start - start % chunk_size
+        for data in self._engine.get_chunks(keys):
+            data = _decompress(info["codec"], data)
+            yield data[max(start - offset, 0):end - offset + 1]
+            offset += chunk_size
+
+    @staticmethod
+    def _check_range(start, stop, length):
+        """Check the range of an edit against the length of the body it
+        applies to. A start of None means the end of the body."""
+
+        if start is None:
+            return length, length
+        if not 0 <= start <= stop <= length:
+            raise ValueError(f"The range {start}-{stop} is outside the "
+                             f"content ({length} bytes)")
+        return start, stop
+
+    def _splice_chunks(self, keys, codec, start, stop, data):
+        """Iterate over the bytes of a run of chunks, with the bytes from
+        offset start up to stop (relative to the first chunk) replaced by
+        data."""
+
+        offset = 0
+        spliced = False
+        for chunk in self._engine.get_chunks(keys):
+            chunk = _decompress(codec, chunk)
+            size = len(chunk)
+            yield chunk[:min(max(start - offset, 0), size)]
+            if not spliced and start - offset <= size:
+                yield data
+                spliced = True
+            yield chunk[min(max(stop - offset, 0), size):]
+            offset += size
+        if not spliced:
+            yield data
+
+    def patch(self, pastie, operations):
+        """Work out how to apply a series of edits to a stored pastie's
+        body, without rewriting all of it.
+
+        Each operation is a (start, stop, data) tuple, replacing the bytes
+        from offset start up to (not including) stop of the UTF-8 encoded
+        body with the byte string data; a start of None appends data to
+        the body. A ValueError is raised if a range is out of bounds.
+
+        Returns an (update, written, replaced) tuple: update is the
+        mongodb-style update to apply to the pastie, written holds the body
+        fields to release if the update can't be applied, and replaced
+        holds the ones to release once it has been. Inline bodies which
+        grow to a chunk or more are moved into chunks."""
+
+        if "content_file" in pastie:
+            return self._patch_chunks(pastie, operations)
+
+        data = (self.unpack(pastie).get("content") or "").encode("utf-8")
+        for start, stop, new_data in operations:
+            start, stop = self._check_range(start, stop, len(data))
+            data = data[:start] + new_data + data[stop:]
+        if len(data) >= self._chunk_size:
+            keys = self._write_chunks([data], self._codec, self._chunk_size)
+            body = {"content_file": self._file_info(
+                keys, len(data), self._chunk_size, self._codec)}
+        else:
+            try:
+                body = self.pack({"content": data.decode("utf-8")})
+            except UnicodeDecodeError:
+                raise ValueError("The edited content is not valid UTF-8")
+        update = {"$set": dict(body, **make_summary(
+            len(data), count_lines(data), data))}
+        unset = {field: "" for field in ("content", "content_ref")
+                 if field in pastie and field not in body}
+        if unset:
+            update["$unset"] = unset
+        replaced = {field: pastie[field] for field in ("content_ref",)
+                    if field in pastie}
+        return update, body, replaced
+
+    def _last_byte(self, info):
+        """Read the last byte of a chunked body."""
+
+        if not info["length"]:
+            return b""
+        return b"".join(self.iter_content({"content_file": info},
+                                          info["length"] - 1))
+
+    def _patch_chunks(self, pastie, operations):
+        """Work out how to apply a series of edits to a chunked body, as
+        for patch. Only the chunks an edit touches are rewritten, or, if it
+        changes the body's length, the chunks from the edit onwards. The
+        summary fields are updated from the bytes the edits remove and add,
+        without reading the rest of the body."""
+
+        info = pastie["content_file"]
+        chunk_size = info["chunk_size"]
+        codec = info["codec"]
+        keys = self._chunk_keys(info)
+        length = info["length"]
+        if "line_count" in pastie:
+            newlines = pastie["line_count"] - \
+                int(self._last_byte(info) not in (b"", b"\n"))
+        else:
+            newlines = sum(data.count(b"\n")
+                           for data in self.iter_content(pastie))
+        preview_start = length
+        written = []
+        replaced = []
+        for start, stop, new_data in operations:
+            start, stop = self._check_range(start, stop, length)
+            if stop - start == len(new_data) == 0:
+                continue
+            if stop > start:
+                current = {"content_file": self._file_info(
+                    keys, length, chunk_size, codec)}
+                newlines -= sum(data.count(b"\n") for data in
+                                self.iter_content(current, start, stop - 1))
+            newlines += new_data.count(b"\n")
+            preview_start = min(preview_start, start)
+            first = start // chunk_size
+            if stop - start == len(new_data):
+                last = (stop - 1) // chunk_size + 1
+            else:
+                last = len(keys)
+            offset = first * chunk_size
+            new_keys = self._write_chunks(
+                self._splice_chunks(keys[first:last], codec, start - offset,
+                                    stop - offset, new_data),
+                codec, chunk_size)
+            for key in keys[first:last]:
+                if key in written:
+                    written.remove(key)
+                    self._engine.delete_chunks([key])
+                else:
+                    replaced.append(key)
+            keys = keys[:first] + new_keys + keys[last:]
+            written.extend(new_keys)
+            length += len(new_data) - (stop - start)
+
+        new_info = self._file_info(keys, length, chunk_size, codec)
+        fields = {"content_file.length": length,
+                  "content_file.tail": new_info["tail"],
+                  "size_bytes": length,
+                  "line_count": newlines + int(
+                      self._last_byte(new_info) not in (b"", b"\n"))}
+        if preview_start < PREVIEW_BYTES or "preview" not in pastie:
+            fields["preview"] = make_summary(0, 0, b"".join(
+                self.iter_content({"content_file": new_info}, 0,
+                                  PREVIEW_BYTES - 1)))["preview"]
+        update = {"$set": fields}
+        old_chunks = info.get("chunks", [])
+        new_chunks = new_info["chunks"]
+        common = 0
+        while (common < min(len(old_chunks), len(new_chunks)) and
+               old_chunks[common] == new_chunks[common]):
+            common += 1
+        if common == len(old_chunks):
+            if new_chunks[common:]:
+                update["$push"] = {"content_file.chunks":
+                                   {"$each": new_chunks[common:]}}
+        elif len(old_chunks) == len(new_chunks):
+            for index in range(common, len(new_chunks)):
+                if old_chunks[index] != new_chunks[index]:
+                    fields[f"content_file.chunks.{index}"] = \
+                        new_chunks[index]
+        else:
+            fields["content_file.chunks"] = new_chunks
+        return (update, {"content_file": {"chunks": written}},
+                {"content_file": {"chunks": replaced}})
+
+    def release(self, pastie):
+        """Drop a stored pastie's reference to its body, if it has one. This
+        is called after the pastie is deleted or its content replaced."""
+
+        if pastie is None:
+            return
+        if "content_ref" in pastie:
+            self._engine.release_body_ref(pastie["content_ref"])
+        if "content_file" in pastie:
+            self._engine.delete_chunks(
+                self._chunk_keys(pastie["content_file"]))
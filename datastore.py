@@ -28,91 +28,400 @@ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import copy
 import datetime
-from pymongo import MongoClient, ReturnDocument
-from pymongo.errors import ServerSelectionTimeoutError
+import itertools
+import time
 import yaml
 
+from allocator import IdAllocator
+from cache import PastieCache
+from content import BODY_FIELDS, DEFAULT_CHUNK_SIZE, SUMMARY_FIELDS, \
+    ContentStore
+from search import DEFAULT_MAX_INDEXED_BYTES, SearchIndex
+from sharding import ShardedEngine
+from stats import PastieStats
+from storage import apply_update, make_engine
+from writebehind import WriteBehindQueue
+
+# Number of times an edit is retried when the pastie is changed by another
+# client between reading and writing it.
+PATCH_RETRIES = 3
+# Fields kept by update_pastie, which otherwise rewrites the whole pastie.
+KEPT_FIELDS = ("expires_at", "owner")
+
+
+class ConflictError(Exception):
+    """Raised when a pastie has been changed since the version an update
+    was based on."""
+
 
 class Datastore:
     """"Datastore class for the tammypaste app.
 
-    Handles all storage of pasties. Currently implemented with a mongodb
-    back-end datastroe. The datastore can be created using the create_db.py
-    script."""
+    Handles all storage of pasties. The pasties themselves are kept by a
+    storage engine (see storage.py), selected with the database.engine key
+    in the configuration file: "mongo" (the default) for a mongodb back-end
+    datastore, "sqlite" for an embedded SQLite database, or "memory" for a
+    non-persistent in-process store. The mongodb datastore can be created
+    using the create_db.py script."""
 
-    def __init__(self, config_path="config.yaml"):
+    def __init__(self, config_path="config.yaml", engine=None):
         """Create a new Datastore class.
 
         The database configuration is read from the file pointed to by the
-        config_path parameter."""
+        config_path parameter. If an engine is passed in, it is used instead
+        of the one named in the configuration. If database.shards is set,
+        the pasties are spread over the shards it lists (see sharding.py).
+
+        New pastie IDs are reserved from the database counter in blocks of
+        database.id_block_size IDs (1 if not set); see allocator.py.
+
+        If the cache section of the configuration is enabled, pasties looked
+        up by numeric ID are kept in a PastieCache (see cache.py).
+
+        Pastie bodies of at least content.threshold bytes are compressed
+        with the content.compression codec and stored once per distinct
+        body (see content.py). If no threshold is set, bodies are always
+        stored inline. Bodies uploaded as a stream are stored in chunks of
+        content.chunk_size bytes.
+
+        If the search section of the configuration is enabled, the first
+        search.max_indexed_bytes bytes of every pastie are kept in a
+        full-text SearchIndex (see search.py).
+
+        The number of pasties, their total size and the number owned by
+        each user are kept in a PastieStats (see stats.py).
+
+        If the write_behind section of the configuration is enabled, new
+        pasties are acknowledged once they are queued, and inserted in
+        batches in the background (see writebehind.py); close must be
+        called before the process exits to insert any still queued."""
 
         with open(config_path) as cfg_file:
             self._config = yaml.load(cfg_file, Loader=yaml.FullLoader)
 
         db_config = self._config['database']
-        self._client = MongoClient(
-            db_config['hostname'],
-            db_config['port'],
-            username=db_config['api_server']['username'],
-            password=db_config['api_server']['password'],
-            authSource=db_config['auth_source'],
-            authMechanism=db_config['auth_mechanism'])
-
-        self._db = self._client[db_config['db_name']]
-        self._pasties = self._db.pasties
-        self._counters = self._db.counters
+        if engine is None:
+            if db_config.get('shards'):
+                engine = ShardedEngine.from_config(db_config)
+            else:
+                engine = make_engine(db_config)
+        self._engine = engine
+        self._id_allocator = IdAllocator(self._engine,
+                                         db_config.get('id_block_size', 1))
+
+        cache_config = self._config.get('cache') or {}
+        self._cache = None
+        if cache_config.get('enabled', False):
+            self._cache = PastieCache(
+                max_bytes=cache_config.get('max_bytes', 64 * 1024 * 1024),
+                ttl=cache_config.get('ttl'),
+                negative_ttl=cache_config.get('negative_ttl', 5))
+
+        content_config = self._config.get('content') or {}
+        self._content = ContentStore(
+            self._engine,
+            threshold=content_config.get('threshold'),
+            codec=content_config.get('compression', 'zlib'),
+            chunk_size=content_config.get('chunk_size', DEFAULT_CHUNK_SIZE))
+
+        search_config = self._config.get('search') or {}
+        self._search = None
+        if search_config.get('enabled', False):
+            self._search = SearchIndex(
+                self._engine,
+                search_config.get('max_indexed_bytes',
+                                  DEFAULT_MAX_INDEXED_BYTES),
+                self.get_pasties_count)
+
+        self._stats = PastieStats()
+
+        write_behind_config = self._config.get('write_behind') or {}
+        self._write_behind = None
+        if write_behind_config.get('enabled', False):
+            self._write_behind = WriteBehindQueue(
+                self._engine,
+                max_pending=write_behind_config.get('max_pending', 10000),
+                batch_size=write_behind_config.get('batch_size', 500),
+                flush_interval=write_behind_config.get('flush_interval',
+                                                       0.05),
+                put_timeout=write_behind_config.get('put_timeout', 1.0),
+                on_rejected=self._reject_queued)
+        self._close_timeout = write_behind_config.get('close_timeout', 10)
+
+    @property
+    def config(self):
+        """Get the configuration the datastore was created with."""
+
+        return self._config
+
+    @property
+    def engine(self):
+        """Get the storage engine holding the pasties."""
+
+        return self._engine
+
+    @property
+    def id_allocator(self):
+        """Get the IdAllocator used to assign new pastie IDs."""
+
+        return self._id_allocator
+
+    @property
+    def cache(self):
+        """Get the PastieCache, or None if caching is disabled."""
+
+        return self._cache
+
+    @property
+    def search_index(self):
+        """Get the SearchIndex, or None if search is disabled."""
+
+        return self._search
+
+    @property
+    def write_behind(self):
+        """Get the WriteBehindQueue, or None if new pasties are written
+        straight away."""
+
+        return self._write_behind
 
     @property
     def is_connected(self):
         """Check if we're connected to the database."""
 
-        try:
-            svr_info = self._client.server_info()
-            if svr_info["version"] is not None:
-                return True
-            return False
-        except KeyError:
-            return False
-        except ServerSelectionTimeoutError:
-            return False
+        return self._engine.is_connected
 
     @property
     def connection(self):
         """Get the MongoClient instance representing the database
         connection."""
 
-        return self._client
+        return self._engine.connection
 
     @property
     def database(self):
         """Get the mongodb database for the current connection."""
 
-        return self._db
+        return self._engine.database
 
-    def get_pasties_count(self):
-        """Get the number of pasties in the database."""
+    def ensure_indexes(self):
+        """Create the indexes the datastore relies on, if they don't already
+        exist. This is safe to call every time the application starts."""
+
+        self._engine.ensure_indexes()
+
+    def warm_up(self):
+        """Get ready to serve requests: connect to the database and create
+        the indexes, so the first request doesn't wait for either."""
+
+        self._engine.warm_up()
+        self.ensure_indexes()
+
+    def close(self):
+        """Insert any pasties still in the write-behind queue, and stop its
+        background thread. Pasties can't be created afterwards."""
+
+        if self._write_behind is not None:
+            self._write_behind.close(self._close_timeout)
+
+    def _get_stored(self, pastie_id):
+        """Get a pastie's stored document, including one which is still
+        waiting in the write-behind queue."""
+
+        if self._write_behind is not None:
+            # The queue is checked first: a pastie only leaves it once it
+            # has been inserted.
+            doc = self._write_behind.get(pastie_id)
+            if doc is not None:
+                return dict(doc)
+        return self._engine.get(pastie_id)
+
+    def _reject_queued(self, pastie_id, doc, error):
+        """Undo the side effects of creating a queued pastie which the
+        storage engine then rejected."""
+
+        self._content.release(doc)
+        self._stats.add(doc.get("owner"), -doc.get("size_bytes", 0),
+                        count=-1)
+        self._invalidate(pastie_id)
+        if self._search is not None:
+            # The postings belong to whichever pastie holds the ID now.
+            stored = self._content.unpack(self._engine.get(pastie_id))
+            if stored is None:
+                self._search.remove(pastie_id)
+            else:
+                self._index(stored)
 
-        return self._pasties.count_documents({})
+    def _flush_pending(self, pastie_id):
+        """Make sure a pastie has left the write-behind queue, before it is
+        changed in the storage engine. Raises a QueueFullError if it is
+        still queued after the queue's put_timeout."""
+
+        if self._write_behind is not None:
+            self._write_behind.flush(pastie_id)
+
+    def get_pasties_count(self):
+        """Get the number of pasties in the database, from the aggregate
+        statistics (see get_stats)."""
+
+        return self.get_stats()["pasties"]
+
+    def get_stats(self):
+        """Get the aggregate statistics about the stored pasties, as a
+        dictionary of pasties (the number of pasties, including expired
+        ones not yet reaped), bytes (their total content size), per_user
+        (the number of pasties each user owns) and reconciled_at (when the
+        statistics were last worked out from the stored pasties).
+
+        The statistics are kept up to date as pasties are written through
+        this datastore, so this doesn't touch the database, except the
+        first time it is called, when they are reconciled. Writes made by
+        other processes are only counted when reconcile_stats is next
+        called."""
+
+        if not self._stats.reconciled:
+            self.reconcile_stats()
+        return self._stats.snapshot()
+
+    def reconcile_stats(self):
+        """Work out the aggregate statistics from the stored pasties,
+        reading just their owner and size fields. Returns the number of
+        pasties the statistics were out by."""
+
+        def sizes():
+            for pastie in self._engine.find(
+                    fields=["id", "owner", "size_bytes"]):
+                size = pastie.get("size_bytes")
+                if size is None:
+                    # Written before pasties recorded their size.
+                    size = self._content.summarize(self._content.unpack(
+                        self._engine.get(pastie["id"]) or {}
+                    )).get("size_bytes", 0)
+                yield pastie.get("owner"), size
+
+        return self._stats.reconcile(sizes())
 
     def get_new_pastie_id(self):
-        """Increment the next pastie counter and get the new value."""
+        """Get the next pastie ID from the ID allocator."""
+
+        return self._id_allocator.allocate()
+
+    @staticmethod
+    def _is_expired(pastie, now=None):
+        """Check if a pastie has passed its expires_at time (a Unix
+        timestamp), if it has one."""
 
-        res = self._counters.find_one_and_update(
-            filter={"counterName": "pasties"},
-            update={"$inc": {"counterValue": 1}},
-            projection=["counterName", "counterValue"],
-            upsert=False,
-            return_document=ReturnDocument.AFTER
-        )
-        return res["counterValue"]
+        expires_at = pastie.get("expires_at")
+        return expires_at is not None and \
+            expires_at <= (time.time() if now is None else now)
+
+    def _live(self, pastie):
+        """Get a pastie read from the database, or None if it has expired
+        and just hasn't been deleted yet."""
+
+        if pastie is None or self._is_expired(pastie):
+            return None
+        return pastie
 
     def get_pastie(self, pastie_id, search_by_unique_id=False):
-        """Look up a pastie by its numeric ID or its unique mongo ID."""
+        """Look up a pastie by its numeric ID or its unique mongo ID.
+        Expired pasties are never returned, even before they are
+        deleted."""
 
         if search_by_unique_id:
-            return self._pasties.find_one({"_id": pastie_id})
-        return self._pasties.find_one({"id": pastie_id})
+            doc = None
+            if self._write_behind is not None:
+                doc = self._write_behind.get_by_unique_id(pastie_id)
+            if doc is None:
+                doc = self._engine.get_by_unique_id(pastie_id)
+            else:
+                doc = dict(doc)
+            return self._live(self._content.unpack(doc))
+        if self._cache is None:
+            return self._live(self._content.unpack(
+                self._get_stored(pastie_id)))
+
+        found, pastie = self._cache.get(pastie_id)
+        if found:
+            return self._live(pastie)
+        generation = self._cache.generation
+        pastie = self._content.unpack(self._get_stored(pastie_id))
+        self._cache.put(pastie_id, pastie, generation)
+        return self._live(pastie)
+
+    def get_pasties(self, pastie_ids):
+        """Look up several pasties by numeric ID at once.
+
+        Pasties which aren't in the cache are fetched with a single query.
+        Returns a dictionary mapping each ID which was found to its
+        pastie."""
+
+        found = {}
+        wanted = []
+        for pastie_id in pastie_ids:
+            if self._cache is not None:
+                hit, pastie = self._cache.get(pastie_id)
+                if hit:
+                    if self._live(pastie) is not None:
+                        found[pastie_id] = pastie
+                    continue
+            wanted.append(pastie_id)
+        if not wanted:
+            return found
+
+        generation = self._cache.generation if self._cache else None
+        fetched = {}
+        if self._write_behind is not None:
+            for pastie_id in wanted:
+                doc = self._write_behind.get(pastie_id)
+                if doc is not None:
+                    fetched[pastie_id] = self._content.unpack(dict(doc))
+        fetched.update(
+            (pastie["id"], self._content.unpack(pastie)) for pastie in
+            self._engine.get_many([pastie_id for pastie_id in wanted
+                                   if pastie_id not in fetched]))
+        if self._cache is not None:
+            for pastie_id in wanted:
+                self._cache.put(pastie_id, fetched.get(pastie_id),
+                                generation)
+        found.update((pastie_id, pastie) for pastie_id, pastie
+                     in fetched.items() if self._live(pastie) is not None)
+        return found
+
+    def _invalidate(self, pastie_id):
+        """Drop a pastie from the cache after it has been changed."""
+
+        if self._cache is not None:
+            self._cache.invalidate(pastie_id)
+
+    def _index(self, pastie):
+        """Bring the search index up to date with a newly written
+        pastie."""
+
+        if self._search is None:
+            return
+        max_bytes = self._search.max_indexed_bytes
+        text = b"".join(self._content.iter_content(
+            pastie, 0, None if max_bytes is None else max_bytes - 1))
+        self._search.index(pastie["id"],
+                           text.decode("utf-8", errors="ignore"))
+
+    @staticmethod
+    def _fill_in_timestamps(pastie_data):
+        """Fill in the created_at and updated_at fields of a new pastie if
+        they are missing or None."""
+
+        if "created_at" not in pastie_data:
+            pastie_data["created_at"] = str(datetime.datetime.now())
+        if pastie_data["created_at"] is None:
+            pastie_data["created_at"] = str(datetime.datetime.now())
+
+        if "updated_at" not in pastie_data:
+            pastie_data["updated_at"] = str(datetime.datetime.now())
+        if pastie_data["updated_at"] is None:
+            pastie_data["updated_at"] = str(datetime.datetime.now())
 
     def create_pastie(self, pastie_data):
         """Create a new pastie.
@@ -128,46 +437,234 @@ class Datastore:
         - updated_at: The timestamp when the pastie was last updated. If the
           value is None  or the key is not present, the current time will be
           used.
+        - expires_at: Optionally, the time (as a Unix timestamp) after which
+          the pastie is treated as deleted, until reap_expired deletes it.
+
+        The pastie is written with a single insert; uniqueness of the ID is
+        enforced by the storage engine (for mongodb, by the unique index
+        created by ensure_indexes), and a ValueError is raised if the ID is
+        already taken. The inserted pastie is returned without being read
+        back from the database.
 
-        After the pastie is inserted, it is retrieved and returned."""
+        In write-behind mode, a pastie given a new ID is queued instead of
+        being inserted straight away; a QueueFullError is raised if the
+        queue stays full. Pasties with an ID given in pastie_data are
+        always inserted straight away, so a clash is still reported."""
 
+        queue = self._write_behind
         if ("id" not in pastie_data) or (pastie_data["id"] is None):
             pastie_data["id"] = self.get_new_pastie_id()
+        elif queue is not None:
+            queue.flush(pastie_data["id"])
+            queue = None
+        self._fill_in_timestamps(pastie_data)
+        pastie_data.update(self._content.summarize(pastie_data))
 
-        if "created_at" not in pastie_data:
-            pastie_data["created_at"] = str(datetime.datetime.now())
-        if pastie_data["created_at"] is None:
-            pastie_data["created_at"] = str(datetime.datetime.now())
-
-        if "updated_at" not in pastie_data:
-            pastie_data["updated_at"] = str(datetime.datetime.now())
-        if pastie_data["updated_at"] is None:
-            pastie_data["updated_at"] = str(datetime.datetime.now())
-
-        if self.pastie_exists(int(pastie_data["id"])):
-            raise ValueError(f"A pastie with ID {pastie_data['id']} exists")
-
-        new_pastie_id = self._pasties.insert_one(pastie_data)
-        return self._pasties.find_one({"_id": new_pastie_id})
+        stored = self._content.pack(pastie_data)
+        try:
+            if queue is None:
+                self._engine.insert(stored)
+            else:
+                stored["_id"] = self._engine.new_unique_id()
+                queue.put(pastie_data["id"], stored)
+        except Exception:
+            self._content.release(stored)
+            raise
+        pastie_data["_id"] = stored["_id"]
+        self._invalidate(pastie_data["id"])
+        self._index(pastie_data)
+        self._stats.add(pastie_data.get("owner"),
+                        pastie_data.get("size_bytes", 0))
+        return pastie_data
+
+    def create_pasties(self, pasties_data):
+        """Create several new pasties at once.
+
+        Each item of pasties_data is a dictionary as for create_pastie. New
+        IDs for all of the pasties which need one are reserved in a single
+        step, and the pasties are written with one bulk insert. A failure
+        to insert one pastie doesn't stop the others being inserted.
+
+        In write-behind mode, the pasties are still inserted straight away,
+        after any queued pastie with one of the IDs given has been, so a
+        clash is reported.
+
+        Returns a list with a (pastie, error) tuple for each item, in the
+        same order: error is None if the pastie was created, or a ValueError
+        describing why it wasn't."""
+
+        needs_id = [pastie_data for pastie_data in pasties_data
+                    if pastie_data.get("id") is None]
+        for pastie_data in pasties_data:
+            if pastie_data.get("id") is not None:
+                self._flush_pending(pastie_data["id"])
+        new_ids = self._id_allocator.allocate_many(len(needs_id)) \
+            if needs_id else []
+        for pastie_data, new_id in zip(needs_id, new_ids):
+            pastie_data["id"] = new_id
+        for pastie_data in pasties_data:
+            self._fill_in_timestamps(pastie_data)
+            pastie_data.update(self._content.summarize(pastie_data))
+
+        stored = [self._content.pack(pastie_data)
+                  for pastie_data in pasties_data]
+        errors = self._engine.insert_many(stored)
+        results = []
+        for index, pastie_data in enumerate(pasties_data):
+            if index in errors:
+                self._content.release(stored[index])
+                results.append((None, errors[index]))
+            else:
+                pastie_data["_id"] = stored[index]["_id"]
+                self._invalidate(pastie_data["id"])
+                self._index(pastie_data)
+                self._stats.add(pastie_data.get("owner"),
+                                pastie_data.get("size_bytes", 0))
+                results.append((pastie_data, None))
+        return results
+
+    def create_pastie_from_stream(self, stream, pastie_data=None):
+        """Create a new pastie whose content is read from a binary stream.
+        Large bodies are stored in chunks as they are read (see
+        ContentStore.write_stream). Any other fields of the new pastie can
+        be given in pastie_data, as for create_pastie. Returns the new
+        pastie."""
+
+        return self.create_pastie(dict(pastie_data or {},
+                                       **self._content.write_stream(stream)))
 
     def update_pastie(self, pastie_id, pastie_data):
         """Update a pastie's data. The created_at, updated_at, and content fields
-        are the only fields which will be updated. If no pastie with the
-        numeric ID pastie_id is found, a KeyError will be raised."""
-
-        rec = self._pasties.find_one({"id": pastie_id})
+        are the only fields which will be updated; any of them missing from
+        pastie_data keep their current values, except updated_at, which
+        defaults to the current time. A content_file field written by
+        ContentStore.write_stream may be given in place of content. The
+        summary fields (size_bytes, line_count and preview) follow the
+        content, and expires_at and owner are left as they were. If no
+        pastie with the numeric ID pastie_id is found, a KeyError will be
+        raised. Returns the updated pastie."""
+
+        self._flush_pending(pastie_id)
+        rec = self._live(self._engine.get(pastie_id))
         if rec is None:
             raise KeyError(f"Pastie with id {pastie_id} not found")
-        return self._pasties.replace_one({"id": pastie_id}, {
-            "created_at": pastie_data.created_at,
-            "updated_at": pastie_data.updated_at,
-            "content": pastie_data.content
-        })
+        body = {field: pastie_data[field] for field in BODY_FIELDS
+                if field in pastie_data}
+        updated = {
+            "created_at": pastie_data.get("created_at", rec.get("created_at")),
+            "updated_at": (pastie_data.get("updated_at") or
+                           str(datetime.datetime.now())),
+        }
+        updated.update({field: rec[field] for field in KEPT_FIELDS
+                        if field in rec})
+        new_body = bool(body)
+        if new_body:
+            updated.update(self._content.summarize(pastie_data))
+            stored = dict(updated, **self._content.pack(body))
+        else:
+            updated.update({field: rec[field] for field in SUMMARY_FIELDS
+                            if field in rec})
+            stored = dict(updated, **{field: rec[field] for field in
+                                      BODY_FIELDS if field in rec})
+            body = {field: value for field, value in
+                    self._content.unpack(stored).items()
+                    if field in BODY_FIELDS}
+        self._engine.replace(pastie_id, stored)
+        if new_body:
+            self._content.release(rec)
+            self._stats.add(None, updated.get("size_bytes", 0) -
+                            rec.get("size_bytes", 0), count=0)
+        self._invalidate(pastie_id)
+        updated = dict(updated, id=pastie_id, _id=rec["_id"], **body)
+        if new_body:
+            self._index(updated)
+        return updated
+
+    def patch_pastie(self, pastie_id, operations, expected_updated_at=None):
+        """Apply a series of edits to a pastie's content in place.
+
+        Each operation is a (start, stop, data) tuple, replacing the bytes
+        from offset start up to stop of the pastie's UTF-8 encoded content
+        with the byte string data; a start of None appends data to the
+        content. Only the changed fields are written (see
+        ContentStore.patch), so an append costs time in proportion to the
+        appended data, not to the size of the pastie.
+
+        The edit is only applied if the pastie hasn't changed since it was
+        read, judged by its updated_at field. If expected_updated_at is
+        given and the pastie's updated_at differs from it, a ConflictError
+        is raised; otherwise the edit is retried up to PATCH_RETRIES times.
+        A KeyError is raised if the pastie doesn't exist, and a ValueError
+        if an edit's range is out of bounds. Returns the updated pastie."""
+
+        self._flush_pending(pastie_id)
+        for _ in range(PATCH_RETRIES):
+            rec = self._live(self._engine.get(pastie_id))
+            if rec is None:
+                raise KeyError(f"Pastie with id {pastie_id} not found")
+            if expected_updated_at is not None and \
+                    rec.get("updated_at") != expected_updated_at:
+                raise ConflictError(f"Pastie {pastie_id} has been updated "
+                                    f"since {expected_updated_at}")
+            update, written, replaced = self._content.patch(rec, operations)
+            update["$set"]["updated_at"] = str(datetime.datetime.now())
+            if self._engine.update(pastie_id, update,
+                                   {"updated_at": rec.get("updated_at")}):
+                self._content.release(replaced)
+                self._invalidate(pastie_id)
+                patched = self._content.unpack(
+                    apply_update(copy.deepcopy(rec), update))
+                self._index(patched)
+                self._stats.add(None, patched.get("size_bytes", 0) -
+                                rec.get("size_bytes", 0), count=0)
+                return patched
+            self._content.release(written)
+        raise ConflictError(f"Pastie {pastie_id} kept changing during the "
+                            f"update")
+
+    def update_pastie_from_stream(self, pastie_id, stream):
+        """Replace a pastie's content with a body read from a binary stream,
+        as for create_pastie_from_stream. If no pastie with the numeric ID
+        pastie_id is found, a KeyError will be raised. Returns the updated
+        pastie."""
+
+        self._flush_pending(pastie_id)
+        if self._live(self._engine.get(pastie_id)) is None:
+            raise KeyError(f"Pastie with id {pastie_id} not found")
+        body = self._content.write_stream(stream)
+        try:
+            return self.update_pastie(pastie_id, body)
+        except KeyError:
+            self._content.release(body)
+            raise
 
-    def delete_pastie(self, pastie_id):
-        """Delete a pastie by its numeric ID."""
+    def pastie_content_length(self, pastie):
+        """Get the length, in bytes, of a pastie's UTF-8 encoded content."""
 
-        return self._pasties.delete_one({"id": pastie_id})
+        return self._content.content_length(pastie)
+
+    def iter_pastie_content(self, pastie, start=0, end=None):
+        """Iterate over a pastie's UTF-8 encoded content from byte offset
+        start to end (inclusive; None meaning the end of the content), a
+        chunk at a time."""
+
+        return self._content.iter_content(pastie, start, end)
+
+    def delete_pastie(self, pastie_id):
+        """Delete a pastie by its numeric ID. Returns the number of pasties
+        deleted."""
+
+        self._flush_pending(pastie_id)
+        deleted = self._engine.delete(pastie_id)
+        self._content.release(deleted)
+        self._invalidate(pastie_id)
+        if deleted is None:
+            return 0
+        if self._search is not None:
+            self._search.remove(pastie_id)
+        self._stats.add(deleted.get("owner"), -deleted.get("size_bytes", 0),
+                        count=-1)
+        return 1
 
     def pastie_exists(self, pastie_id):
         """Check if a pastie with the given numeric ID exists."""
@@ -175,13 +672,87 @@ class Datastore:
         res = self.get_pastie(pastie_id)
         return res is not None
 
-    def list_pasties(self, query=None, max_records=None):
+    def list_pasties(self, query=None, max_records=None, after_id=None,
+                     fields=None):
         """Retrieve a list of pasties in the database.
 
         Optionally, the list can be filtered by passing in a query, and the
         results can be limited to a certain number of records by passing in a
-        value for max_records."""
-        filt_expr = query or {}
-        if max_records is not None:
-            return self._pasties.find(filt_expr).limit(max_records).sort("id")
-        return self._pasties.find(filt_expr).sort("id")
+        value for max_records. Passing after_id returns only the pasties
+        whose numeric ID is greater than after_id, which allows the list to
+        be read a page at a time. Passing fields (a list of field names)
+        returns only those fields of each pastie; unless "content" is one
+        of them, the pasties' bodies aren't read at all. The pasties are
+        returned in ID order as an iterator, so they are only read from the
+        database as they are consumed. Expired pasties are skipped, as are
+        pasties still in the write-behind queue."""
+        if after_id is not None:
+            query = dict(query or {})
+            id_cond = query.get("id", {})
+            if not isinstance(id_cond, dict):
+                id_cond = {"$in": [id_cond]}
+            if "$gt" in id_cond:
+                after_id = max(after_id, id_cond["$gt"])
+            query["id"] = dict(id_cond, **{"$gt": after_id})
+        now = time.time()
+        if fields is None:
+            live = (pastie for pastie in self._engine.find(query)
+                    if not self._is_expired(pastie, now))
+            return (self._content.unpack(pastie)
+                    for pastie in itertools.islice(live, max_records))
+
+        wanted = set(fields)
+        needed = wanted | {"id", "expires_at"}
+        if "content" in wanted:
+            needed.update(BODY_FIELDS)
+        live = (pastie for pastie in self._engine.find(query,
+                                                       fields=sorted(needed))
+                if not self._is_expired(pastie, now))
+        if "content" in wanted:
+            live = (self._content.unpack(pastie) for pastie in live)
+        return ({field: value for field, value in pastie.items()
+                 if field in wanted or field in BODY_FIELDS}
+                for pastie in itertools.islice(live, max_records))
+
+    def reap_expired(self, limit):
+        """Delete up to limit expired pasties, soonest expiry first.
+        Returns the number of pasties deleted."""
+
+        reaped = 0
+        for pastie_id in self._engine.expired_ids(time.time(), limit):
+            reaped += self.delete_pastie(pastie_id)
+        return reaped
+
+    def count_expired(self, limit):
+        """Count the expired pasties waiting to be deleted, counting no
+        further than limit."""
+
+        return len(self._engine.expired_ids(time.time(), limit))
+
+    def search_pasties(self, text, limit, offset=0):
+        """Search the content of the pasties for all of the words in text.
+
+        Returns a (pasties, total) tuple: pasties is a list of up to limit
+        of the matching pasties, best match first, starting offset matches
+        in, each with a score field added; total is the number of pasties
+        which matched. A RuntimeError is raised if search is disabled."""
+
+        if self._search is None:
+            raise RuntimeError("Search is not enabled")
+        results, total = self._search.search(text, limit, offset)
+        found = self.get_pasties([pastie_id for pastie_id, _ in results])
+        return [dict(found[pastie_id], score=round(score, 4))
+                for pastie_id, score in results if pastie_id in found], total
+
+    def rebuild_search_index(self):
+        """Rebuild the search index from scratch from the stored pasties.
+        Returns the number of pasties indexed."""
+
+        if self._search is None:
+            raise RuntimeError("Search is not enabled")
+        self._search.clear()
+        indexed = 0
+        for pastie in self.list_pasties():
+            self._index(pastie)
+            indexed += 1
+        return indexed
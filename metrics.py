@@ -0,0 +1,383 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : metrics.py
+Description : Low-overhead metrics (counters, gauges and histograms) for the
+              REST API (api.py) and the Datastore, rendered in the
+              Prometheus text exposition format.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import bisect
+import itertools
+import threading
+import time
+import types
+import weakref
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 10000)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    """Format a set of labels for the Prometheus text format."""
+
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"')
+               .replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _ShardOwner:
+    """Holds a thread's shard of a metric in its thread-local data, so the
+    shard can be retired when the thread exits."""
+
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self):
+        self.shard = {}
+
+
+class _Metric:
+    """Base class for the metric types.
+
+    Each thread records into its own shard (a dictionary from label values
+    to the values for that series), so recording never takes a lock; the
+    shards are only merged when the metrics are collected. A lock is only
+    taken the first time a thread records into a metric, to register the
+    thread's shard, and when the thread exits, to fold its shard into the
+    totals of the threads which have gone."""
+
+    metric_type = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards = {}
+        self._shard_keys = itertools.count()
+        self._retired = {}
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        """Get the current thread's shard."""
+
+        try:
+            return self._local.owner.shard
+        except AttributeError:
+            # The owner is dropped with the thread's other thread-local
+            # data when the thread exits, which retires the shard.
+            owner = _ShardOwner()
+            with self._shards_lock:
+                key = next(self._shard_keys)
+                self._shards[key] = owner.shard
+            weakref.finalize(owner, self._retire, key)
+            self._local.owner = owner
+            return owner.shard
+
+    def _retire(self, key):
+        """Fold the shard of a thread which has exited into the retired
+        totals."""
+
+        with self._shards_lock:
+            self._add(self._retired, self._shards.pop(key))
+
+    @staticmethod
+    def _add(totals, shard):
+        """Add the values of a shard to a dictionary of totals. Must be
+        overridden."""
+
+        raise NotImplementedError
+
+    def _merged(self):
+        """Merge the shards of every thread."""
+
+        totals = {}
+        with self._shards_lock:
+            self._add(totals, self._retired)
+            shards = list(self._shards.values())
+        for shard in shards:
+            self._add(totals, shard)
+        return totals
+
+    def render(self):
+        """Render the metric in the Prometheus text format."""
+
+        raise NotImplementedError
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help_text}",
+                f"# TYPE {self.name} {self.metric_type}"]
+
+
+class Counter(_Metric):
+    """A monotonically increasing counter."""
+
+    metric_type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        """Add to the counter for the given label values."""
+
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    @staticmethod
+    def _add(totals, shard):
+        for labels, value in list(shard.items()):
+            totals[labels] = totals.get(labels, 0) + value
+
+    def value(self, *label_values):
+        """Get the current total for the given label values."""
+
+        return self._merged().get(label_values, 0)
+
+    def render(self):
+        lines = self._header()
+        for labels, value in sorted(self._merged().items()):
+            lines.append(f"{self.name}"
+                         f"{_format_labels(self.label_names, labels)} "
+                         f"{value}")
+        return lines
+
+
+class Histogram(_Metric):
+    """A histogram of observed values, with fixed bucket boundaries."""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        """Record a value for the given label values."""
+
+        shard = self._shard()
+        series = shard.get(label_values)
+        if series is None:
+            # One count per bucket, plus +Inf, then the sum of the values
+            series = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[label_values] = series
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @staticmethod
+    def _add(totals, shard):
+        for labels, series in list(shard.items()):
+            total = totals.get(labels)
+            if total is None:
+                totals[labels] = list(series)
+            else:
+                for index, value in enumerate(series):
+                    total[index] += value
+
+    def count(self, *label_values):
+        """Get the number of values recorded for the given label values."""
+
+        series = self._merged().get(label_values)
+        return 0 if series is None else sum(series[:-1])
+
+    def render(self):
+        lines = self._header()
+        for labels, series in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                label_text = _format_labels(self.label_names, labels,
+                                            ("le", bound))
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {series[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose values are read from a callback when the metrics are
+    collected. The callback returns a dictionary mapping tuples of label
+    values to the current values."""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, help_text, label_names, callback):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._callback = callback
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} {self.metric_type}"]
+        for labels, value in sorted(self._callback().items()):
+            lines.append(f"{self.name}"
+                         f"{_format_labels(self.label_names, labels)} "
+                         f"{value}")
+        return lines
+
+
+class MetricsRegistry:
+    """A collection of metrics, which can be rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, label_names=()):
+        """Get (creating if need be) the counter with the given name."""
+
+        return self._register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=LATENCY_BUCKETS):
+        """Get (creating if need be) the histogram with the given name."""
+
+        return self._register(Histogram(name, help_text, label_names,
+                                        buckets))
+
+    def gauge(self, name, help_text, label_names, callback):
+        """Register a gauge whose values are read from callback."""
+
+        with self._lock:
+            gauge = Gauge(name, help_text, label_names, callback)
+            self._metrics[name] = gauge
+            return gauge
+
+    def get(self, name):
+        """Get a registered metric by name, or None."""
+
+        return self._metrics.get(name)
+
+    def render(self):
+        """Render every metric in the Prometheus text format."""
+
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _count_documents(result):
+    """Work out how many documents a Datastore method returned."""
+
+    if result is None or isinstance(result, (bool, int)):
+        return 0
+    if isinstance(result, dict):
+        return 1 if "id" in result else len(result)
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 1
+
+
+class TimedProxy:
+    """Wraps an object (normally the Datastore) so that every call to one
+    of its public methods is counted and timed, and the number of
+    documents it returns recorded, with the method name as a label.
+    Attributes other than methods are passed straight through.
+
+    Methods returning an iterator (such as list_pasties) are timed until
+    the iterator is used up (or closed early, which is recorded with an
+    outcome of "closed"), and their documents counted as they are read."""
+
+    def __init__(self, target, registry, component="datastore"):
+        self._target = target
+        self._calls = registry.counter(
+            f"tammypaste_{component}_calls_total",
+            f"Number of {component} operations", ("operation", "outcome"))
+        self._latency = registry.histogram(
+            f"tammypaste_{component}_operation_seconds",
+            f"Latency of {component} operations", ("operation",))
+        self._documents = registry.histogram(
+            f"tammypaste_{component}_documents_returned",
+            f"Number of documents returned by {component} operations",
+            ("operation",), buckets=COUNT_BUCKETS)
+
+    @property
+    def target(self):
+        """Get the wrapped object."""
+
+        return self._target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not isinstance(attr, types.MethodType):
+            return attr
+        wrapper = self._wrap(name, attr)
+        self.__dict__[name] = wrapper
+        return wrapper
+
+    def _record(self, name, started, outcome, documents):
+        self._latency.observe(time.perf_counter() - started, name)
+        self._calls.inc(name, outcome)
+        self._documents.observe(documents, name)
+
+    def _wrap(self, name, method):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                self._record(name, started, "error", 0)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return self._timed_iterator(name, started, result)
+            self._record(name, started, "ok", _count_documents(result))
+            return result
+
+        timed.__name__ = name
+        timed.__doc__ = method.__doc__
+        return timed
+
+    def _timed_iterator(self, name, started, iterator):
+        documents = 0
+        outcome = "error"
+        try:
+            for item in iterator:
+                documents += 1
+                yield item
+            outcome = "ok"
+        except GeneratorExit:
+            outcome = "closed"
+            raise
+        finally:
+            self._record(name, started, outcome, documents)
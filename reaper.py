@@ -0,0 +1,126 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : reaper.py
+Description : Background deletion of expired pasties, a bounded batch at a
+              time so it never holds up the API for long.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The backlog of expired pasties is counted no further than this.
+BACKLOG_LIMIT = 10000
+
+
+class Reaper:
+    """Deletes expired pasties in the background.
+
+    Every interval seconds, the reaper deletes expired pasties (see
+    Datastore.reap_expired) in batches of batch_size, pausing batch_pause
+    seconds between batches so the database isn't kept busy, and stopping
+    after max_batches batches until the next pass. Expired pasties are
+    already hidden from the API, so a backlog only costs storage.
+
+    The stats property reports the number of passes and pasties reaped,
+    the number reaped and time taken by the last pass, and the backlog of
+    expired pasties left over after it."""
+
+    def __init__(self, datastore, batch_size=100, max_batches=50,
+                 batch_pause=0.05):
+        """Create a reaper for a Datastore (or a proxy for one)."""
+
+        self._datastore = datastore
+        self._batch_size = batch_size
+        self._max_batches = max_batches
+        self._batch_pause = batch_pause
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            "passes": 0,
+            "reaped": 0,
+            "last_pass_reaped": 0,
+            "last_pass_seconds": 0.0,
+            "backlog": 0,
+        }
+
+    @property
+    def stats(self):
+        """Get the reaper's statistics."""
+
+        return dict(self._stats)
+
+    def run_once(self):
+        """Make one pass over the expired pasties. Returns the number of
+        pasties deleted."""
+
+        started = time.perf_counter()
+        reaped = 0
+        backlog = 0
+        for batch in range(self._max_batches):
+            if batch and self._stop.wait(self._batch_pause):
+                break
+            deleted = self._datastore.reap_expired(self._batch_size)
+            reaped += deleted
+            if deleted < self._batch_size:
+                break
+        else:
+            backlog = self._datastore.count_expired(BACKLOG_LIMIT)
+        self._stats["passes"] += 1
+        self._stats["reaped"] += reaped
+        self._stats["last_pass_reaped"] = reaped
+        self._stats["last_pass_seconds"] = time.perf_counter() - started
+        self._stats["backlog"] = backlog
+        return reaped
+
+    def start(self, interval=60):
+        """Start a background thread which makes a pass every interval
+        seconds."""
+
+        if self._thread is not None:
+            return
+
+        def reap():
+            while not self._stop.wait(interval):
+                try:
+                    self.run_once()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Reaping expired pasties failed")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=reap, daemon=True,
+                                        name="pastie-reaper")
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, if it is running."""
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,369 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : schema.py
+Description : Request validation and pastie serialization shared by the
+              WSGI (api.py) and ASGI (asgi_api.py) API servers.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import hashlib
+import json
+import math
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_MAX_BATCH_SIZE = 1000
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+# The fields of each pastie in a list requested with view=summary.
+SUMMARY_VIEW_FIELDS = ['id', 'created_at', 'updated_at', 'expires_at',
+                       'size_bytes', 'line_count', 'preview']
+
+
+class RequestError(Exception):
+    """An error in a client's request, carrying the HTTP status code and
+    message to return to the client, and any extra response headers."""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+def _parse_int(value, name):
+    """Parse an integer request parameter."""
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"{name} must be an integer")
+
+
+def _parse_number(value, name):
+    """Parse a numeric request parameter, which must be finite."""
+
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"{name} must be a number")
+    if not math.isfinite(number):
+        raise RequestError(400, f"{name} must be a finite number")
+    return number
+
+
+def parse_expiry(values):
+    """Parse the optional expiry time of a new pastie from a mapping of
+    request parameters or JSON fields: either expires_at, a Unix
+    timestamp, or expires_in, a number of seconds from now. Returns the
+    expires_at timestamp, or None if the pastie doesn't expire."""
+
+    now = time.time()
+    if values.get('expires_in') is not None:
+        expires_in = _parse_number(values.get('expires_in'), 'expires_in')
+        if expires_in <= 0:
+            raise RequestError(400, 'expires_in must be positive')
+        return now + expires_in
+    if values.get('expires_at') is not None:
+        expires_at = _parse_number(values.get('expires_at'), 'expires_at')
+        if expires_at <= now:
+            raise RequestError(400, 'expires_at must be in the future')
+        return expires_at
+    return None
+
+
+def parse_list_args(args):
+    """Parse the query parameters of a pastie list request.
+
+    args is a mapping of parameter names to (string) values. Returns an
+    (after_id, limit) tuple; after_id is None if the list should start at
+    the beginning, and limit is clamped to MAX_PAGE_SIZE."""
+
+    after_id = None
+    if args.get('after_id') is not None:
+        after_id = _parse_int(args.get('after_id'), 'after_id')
+    limit = DEFAULT_PAGE_SIZE
+    if args.get('limit') is not None:
+        limit = _parse_int(args.get('limit'), 'limit')
+    if limit < 1:
+        raise RequestError(400, 'limit must be at least 1')
+    return after_id, min(limit, MAX_PAGE_SIZE)
+
+
+def parse_view(args):
+    """Parse the view query parameter of a pastie list request: "full" (the
+    default) for whole pasties, or "summary" for their IDs, URLs,
+    timestamps, sizes and previews, without their content. Returns the
+    list of fields to fetch, or None for every field."""
+
+    view = args.get('view') or 'full'
+    if view == 'full':
+        return None
+    if view == 'summary':
+        return SUMMARY_VIEW_FIELDS
+    raise RequestError(400, 'view must be "full" or "summary"')
+
+
+def parse_search_args(args):
+    """Parse the query parameters of a search request.
+
+    Returns a (query, limit, offset) tuple; limit is clamped to
+    MAX_PAGE_SIZE."""
+
+    query = (args.get('q') or '').strip()
+    if not query:
+        raise RequestError(400, 'A search needs a q parameter')
+    limit = DEFAULT_PAGE_SIZE
+    if args.get('limit') is not None:
+        limit = _parse_int(args.get('limit'), 'limit')
+    offset = 0
+    if args.get('offset') is not None:
+        offset = _parse_int(args.get('offset'), 'offset')
+    if limit < 1 or offset < 0:
+        raise RequestError(400, 'limit must be at least 1 and offset at '
+                                'least 0')
+    return query, min(limit, MAX_PAGE_SIZE), offset
+
+
+def make_search_page(pasties, total, limit, offset):
+    """Make the response body for one page of search results."""
+
+    next_offset = offset + limit if offset + limit < total else None
+    return {'pasties': pasties, 'total': total, 'next_offset': next_offset}
+
+
+def parse_ids(ids_arg, max_ids=DEFAULT_MAX_BATCH_SIZE):
+    """Parse a comma-separated list of up to max_ids pastie IDs."""
+
+    try:
+        pastie_ids = [int(i) for i in ids_arg.split(',') if i.strip()]
+    except ValueError:
+        raise RequestError(400, 'ids must be a list of integers')
+    if not pastie_ids:
+        raise RequestError(400, 'No ids were given')
+    if len(pastie_ids) > max_ids:
+        raise RequestError(400, f'At most {max_ids} ids may be fetched')
+    return pastie_ids
+
+
+def parse_new_pastie(body):
+    """Validate the JSON body of a create or update request, returning the
+    pastie data to store. The body may set the pastie's expiry time, as
+    for parse_expiry; it is only used when the pastie is created."""
+
+    if not body or not isinstance(body, dict) or 'content' not in body:
+        raise RequestError(400, 'A pastie must have content')
+    if not isinstance(body['content'], str):
+        raise RequestError(400, 'A pastie\'s content must be a string')
+    pastie = {'content': body['content']}
+    expires_at = parse_expiry(body)
+    if expires_at is not None:
+        pastie['expires_at'] = expires_at
+    return pastie
+
+
+def parse_patch(body):
+    """Validate the JSON body of a patch request.
+
+    The body holds a list of operations, each either {"op": "append",
+    "content": ...} or {"op": "replace", "start": ..., "end": ...,
+    "content": ...}, where start and end are byte offsets into the UTF-8
+    encoded content (end being exclusive), and optionally the updated_at
+    value of the version of the pastie the edit is based on.
+
+    Returns an (updated_at, operations) tuple, with the operations in the
+    form taken by Datastore.patch_pastie."""
+
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('operations'), list) or \
+            not body['operations']:
+        raise RequestError(400, 'A patch must have a list of operations')
+    operations = []
+    for oper in body['operations']:
+        if not isinstance(oper, dict) or \
+                not isinstance(oper.get('content'), str):
+            raise RequestError(400, 'Each operation must have content')
+        data = oper['content'].encode('utf-8')
+        if oper.get('op') == 'append':
+            operations.append((None, None, data))
+        elif oper.get('op') == 'replace':
+            start = _parse_int(oper.get('start'), 'start')
+            end = _parse_int(oper.get('end'), 'end')
+            operations.append((start, end, data))
+        else:
+            raise RequestError(400, 'op must be append or replace')
+    return body.get('updated_at'), operations
+
+
+def parse_batch(items, max_items=DEFAULT_MAX_BATCH_SIZE):
+    """Validate the JSON body of a batch create request.
+
+    Returns a (results, valid) tuple. results has an entry for every item,
+    filled in with an error result for each invalid item and None for the
+    rest; valid is a list of (index, pastie data) tuples for the items to
+    create."""
+
+    if not isinstance(items, list) or not items:
+        raise RequestError(400, 'The request must be a list of pasties')
+    if len(items) > max_items:
+        raise RequestError(413, f'At most {max_items} pasties may be '
+                                f'created at once')
+
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, parse_new_pastie(item)))
+        except RequestError as err:
+            results[index] = {'status': err.status, 'error': err.message}
+    return results, valid
+
+
+def batch_results(results, valid, created, public):
+    """Fill in the results of a batch create.
+
+    results and valid are as returned by parse_batch, and created is the
+    list of (pastie, error) tuples returned by Datastore.create_pasties.
+    public is the function making a public version of a pastie. Returns
+    the response body and HTTP status code."""
+
+    for (index, _), (the_pastie, error) in zip(valid, created):
+        if error is None:
+            results[index] = {'status': 201, 'pastie': public(the_pastie)}
+        else:
+            results[index] = {'status': 409, 'error': str(error)}
+    all_created = all(result['status'] == 201 for result in results)
+    return {'results': results}, 201 if all_created else 207
+
+
+def pastie_etag(pastie):
+    """Compute the entity tag for a pastie, from its ID and the time it was
+    last updated."""
+
+    tag = f"{pastie['id']}:{pastie.get('updated_at')}"
+    return hashlib.sha1(tag.encode()).hexdigest()[:20]
+
+
+def parse_range(range_header, length):
+    """Parse the Range header of a request for a body of length bytes.
+
+    Returns a (start, end) tuple of the first and last byte offsets
+    requested, or None if the whole body should be sent: when there is no
+    header, or it isn't a single byte range this server understands.
+    Raises a 416 RequestError if the range lies outside the body."""
+
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+    spec = range_header[len('bytes='):].strip()
+    if ',' in spec or '-' not in spec:
+        return None
+    first, last = (part.strip() for part in spec.split('-', 1))
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else length - 1
+        else:
+            start = max(length - int(last), 0)
+            end = length - 1
+    except ValueError:
+        return None
+    if start >= length:
+        raise RequestError(416, 'Requested range not satisfiable',
+                           {'Content-Range': f'bytes */{length}'})
+    if start < 0 or end < start:
+        return None
+    return start, min(end, length - 1)
+
+
+def make_public_pastie(pastie, url):
+    """Make the public version of a pastie, with its URL added. Pasties
+    whose content is stored in chunks get their content_length and the
+    raw_url to download the content from instead of the content itself."""
+
+    public = dict(pastie)
+    if 'id' in public:
+        public['url'] = url
+    if '_id' in public:
+        public['_id'] = str(public['_id'])
+    info = public.pop('content_file', None)
+    if info is not None:
+        public['content_length'] = info['length']
+        public['raw_url'] = url + '/raw'
+    return public
+
+
+def public_pastie_maker(url_prefix):
+    """Make a function which makes the public version of a pastie, as for
+    make_public_pastie, whose URL is url_prefix followed by its ID. Lists
+    of pasties are made with one of these, so the URL is only worked out
+    once, not once per pastie."""
+
+    def make(pastie):
+        return make_public_pastie(pastie, url_prefix + str(pastie['id']))
+    return make
+
+
+def make_stats(stats, reconcile_interval):
+    """Make the response body for the aggregate statistics, noting how
+    often they are reconciled with the stored pasties: writes made through
+    other servers may take up to that long to be counted."""
+
+    return dict(stats, reconcile_interval=reconcile_interval)
+
+
+def make_page(pasties, limit):
+    """Make the response body for one page of a pastie list, from up to
+    limit + 1 public pasties; the extra pastie, if present, shows that
+    there is another page."""
+
+    next_cursor = None
+    if len(pasties) > limit:
+        pasties = pasties[:limit]
+        next_cursor = pasties[-1]['id']
+    return {'pasties': pasties, 'next_cursor': next_cursor}
+
+
+def dump_json(body):
+    """Serialize a response body as UTF-8 encoded JSON, with orjson if it
+    is installed (it is several times faster), or else the json module.
+    Anything orjson can't serialize is left to the json module."""
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(body)
+        except TypeError:
+            pass
+    return _JSON_ENCODER.encode(body).encode('utf-8')
+
+
+def ndjson_line(public_pastie):
+    """Serialize a public pastie as one line of newline-delimited JSON."""
+
+    return dump_json(public_pastie) + b"\n"
@@ -0,0 +1,208 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : search.py
+Description : Full-text search over pastie content, using an inverted
+              index of word and trigram postings kept in the storage
+              engine. Run this file with "rebuild" to rebuild the index.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import math
+import re
+import sys
+import time
+
+DEFAULT_MAX_INDEXED_BYTES = 1024 * 1024
+# Words longer than this (base64 blobs, hashes and the like) aren't indexed.
+MAX_TOKEN_LENGTH = 64
+# Only the first words of a query are used.
+MAX_QUERY_TOKENS = 16
+# Score weight of a word matched only by its trigrams, relative to an
+# exact match.
+TRIGRAM_WEIGHT = 0.5
+# BM25 term frequency saturation.
+K1 = 1.2
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Split text into lower-case words."""
+
+    return [token for token in _TOKEN_RE.findall(text.lower())
+            if len(token) <= MAX_TOKEN_LENGTH]
+
+
+def trigrams(token):
+    """Get the distinct three-character substrings of a word."""
+
+    return sorted({token[i:i + 3] for i in range(len(token) - 2)})
+
+
+def make_postings(text):
+    """Make the postings for a pastie's content: a dictionary mapping each
+    term to its frequency. Words are indexed as "w:<word>" and their
+    trigrams as "g:<trigram>"."""
+
+    postings = collections.Counter()
+    for token in tokenize(text):
+        postings["w:" + token] += 1
+        for gram in trigrams(token):
+            postings["g:" + gram] += 1
+    return dict(postings)
+
+
+class SearchIndex:
+    """An inverted index over pastie content.
+
+    Every word of a pastie's content, and every trigram of each word, gets
+    a posting recording how often it occurs in the pastie. The postings
+    are stored by the storage engine and updated whenever a pastie is
+    written, only adding, changing and removing the postings which differ
+    from those already stored.
+
+    A search finds the pasties containing every word of the query, either
+    as a whole word or, with a lower score, as a substring (a pastie
+    containing all of the word's trigrams). Matches are ranked with BM25
+    term weights, without length normalization. Only the first
+    max_indexed_bytes bytes of each pastie are indexed."""
+
+    def __init__(self, engine, max_indexed_bytes=DEFAULT_MAX_INDEXED_BYTES,
+                 count_pasties=None):
+        """Create a search index kept in a storage engine. count_pasties is
+        a function returning the number of pasties, for the term weights;
+        by default the engine counts them, which may mean a scan."""
+
+        self._engine = engine
+        self._max_indexed_bytes = max_indexed_bytes
+        self._count_pasties = count_pasties or engine.count
+
+    @property
+    def max_indexed_bytes(self):
+        """Get the number of bytes of each pastie which are indexed."""
+
+        return self._max_indexed_bytes
+
+    def index(self, pastie_id, text):
+        """Index (or re-index) a pastie's content."""
+
+        new = make_postings(text)
+        old = self._engine.get_postings(pastie_id)
+        removed = [term for term in old if term not in new]
+        if removed:
+            self._engine.delete_postings(pastie_id, removed)
+        changed = {term: freq for term, freq in new.items()
+                   if old.get(term) != freq}
+        if changed:
+            self._engine.put_postings(pastie_id, changed)
+
+    def remove(self, pastie_id):
+        """Drop a pastie from the index."""
+
+        self._engine.delete_postings(pastie_id)
+
+    def clear(self):
+        """Drop every pastie from the index."""
+
+        self._engine.clear_postings()
+
+    @staticmethod
+    def _weight(freq, doc_freq, total):
+        """The BM25 weight of a term occurring freq times in a pastie, and
+        in doc_freq of the total pasties."""
+
+        idf = math.log(1 + (total - doc_freq + 0.5) / (doc_freq + 0.5))
+        return idf * freq * (K1 + 1) / (freq + K1)
+
+    def _match_token(self, token, total, candidates):
+        """Score the pasties matching one query word, looking only at the
+        candidates if that isn't None."""
+
+        term = "w:" + token
+        postings = self._engine.find_postings(term, candidates)
+        doc_freq = self._engine.count_postings(term) if postings else 0
+        scores = {pastie_id: self._weight(freq, doc_freq, total)
+                  for pastie_id, freq in postings.items()}
+
+        grams = trigrams(token)
+        if not grams:
+            return scores
+        # Intersect the trigram postings rarest first, so the candidate set
+        # is as small as possible from the start.
+        doc_freqs = sorted((self._engine.count_postings("g:" + gram), gram)
+                           for gram in grams)
+        if doc_freqs[0][0] == 0:
+            return scores
+        matched = candidates
+        partial = collections.Counter()
+        for doc_freq, gram in doc_freqs:
+            postings = self._engine.find_postings("g:" + gram, matched)
+            matched = set(postings)
+            if not matched:
+                return scores
+            for pastie_id, freq in postings.items():
+                partial[pastie_id] += self._weight(freq, doc_freq, total)
+        for pastie_id in matched:
+            if pastie_id not in scores:
+                scores[pastie_id] = \
+                    TRIGRAM_WEIGHT * partial[pastie_id] / len(grams)
+        return scores
+
+    def search(self, text, limit, offset=0):
+        """Search for the pasties containing all of the words of a query.
+
+        Returns a (results, total) tuple: results is a list of up to limit
+        (pastie ID, score) tuples, best first, starting offset results in,
+        and total is the number of pasties which matched."""
+
+        tokens = list(dict.fromkeys(tokenize(text)))[:MAX_QUERY_TOKENS]
+        if not tokens:
+            return [], 0
+        total = max(self._count_pasties(), 1)
+        scores = None
+        for token in tokens:
+            token_scores = self._match_token(
+                token, total, None if scores is None else list(scores))
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {pastie_id: score + token_scores[pastie_id]
+                          for pastie_id, score in scores.items()
+                          if pastie_id in token_scores}
+            if not scores:
+                return [], 0
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[offset:offset + limit], len(ranked)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "rebuild":
+        sys.exit(f"Usage: {sys.argv[0]} rebuild [config.yaml]")
+    from datastore import Datastore
+    started = time.perf_counter()
+    indexed = Datastore(*sys.argv[2:]).rebuild_search_index()
+    print(f"Indexed {indexed} pasties in "
+          f"{time.perf_counter() - started:.1f}s")
@@ -0,0 +1,395 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : sharding.py
+Description : Storage engine spreading pasties over several shards by
+              consistent hashing of their IDs. Run this file with
+              "rebalance" to move pasties onto the shards which own them
+              after a shard is added.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import bisect
+import collections
+import hashlib
+import heapq
+import itertools
+import sys
+import time
+
+import yaml
+
+from storage import SCAN_BATCH_SIZE, StorageEngine, make_engine
+
+DEFAULT_VIRTUAL_NODES = 64
+
+
+def _hash(key):
+    """Hash a string to a 64-bit integer, the same way in every process."""
+
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """A consistent hash ring mapping pastie IDs to shard names.
+
+    Each shard is placed on the ring at virtual_nodes points, and a key
+    belongs to the shard at the first point after the key's hash. Adding a
+    shard only takes keys from the other shards, roughly 1/n of them,
+    and never moves keys between the shards which were already there."""
+
+    def __init__(self, nodes, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        """Create a ring over a list of shard names."""
+
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+        points = sorted((_hash(f"{node}#{index}"), node)
+                        for node in nodes for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        """Get the name of the shard owning a key."""
+
+        index = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+class ShardedEngine(StorageEngine):
+    """Storage engine spreading pasties over several other engines.
+
+    Each pastie, with its search postings, lives on the shard its ID maps
+    to on a HashRing, so operations on a single pastie go to exactly one
+    shard. Listings and counts are sent to every shard, and listings are
+    merged in ID order as they are read. The counters, the deduplicated
+    pastie bodies and the body chunks, which aren't tied to one pastie,
+    are kept on the first shard.
+
+    While rebalancing is set, a pastie which isn't found on its shard is
+    looked for on the others, so pasties can still be found while rebalance
+    moves them onto the shard owning them."""
+
+    name = "sharded"
+
+    def __init__(self, shards, virtual_nodes=DEFAULT_VIRTUAL_NODES,
+                 rebalancing=False):
+        """Create a sharded engine over a dictionary of engines by shard
+        name; the first is the primary shard."""
+
+        self._shards = dict(shards)
+        self._primary = next(iter(self._shards.values()))
+        self._ring = HashRing(list(self._shards), virtual_nodes)
+        self.rebalancing = rebalancing
+        self.blocking = any(shard.blocking for shard in self._shards.values())
+
+    @classmethod
+    def from_config(cls, db_config):
+        """Create a sharded engine from the database configuration. Each
+        item of the shards list names a shard and overrides any of the
+        other database settings for it."""
+
+        base_config = {key: value for key, value in db_config.items()
+                       if key != "shards"}
+        shards = {}
+        for shard_config in db_config["shards"]:
+            shard_config = dict(base_config, **shard_config)
+            shards[shard_config["name"]] = make_engine(shard_config)
+        return cls(shards,
+                   db_config.get("virtual_nodes", DEFAULT_VIRTUAL_NODES),
+                   db_config.get("rebalancing", False))
+
+    @property
+    def shards(self):
+        """Get the dictionary of engines by shard name."""
+
+        return self._shards
+
+    def shard_for(self, pastie_id):
+        """Get the name of the shard owning a pastie ID."""
+
+        return self._ring.node_for(pastie_id)
+
+    def _owner(self, pastie_id):
+        """Get the engine owning a pastie ID."""
+
+        return self._shards[self._ring.node_for(pastie_id)]
+
+    def _others(self, engine):
+        """Get the shards other than engine, if rebalancing is set."""
+
+        if not self.rebalancing:
+            return []
+        return [shard for shard in self._shards.values()
+                if shard is not engine]
+
+    def _group(self, pastie_ids):
+        """Group pastie IDs by the engine owning them."""
+
+        groups = collections.defaultdict(list)
+        for pastie_id in pastie_ids:
+            groups[self._ring.node_for(pastie_id)].append(pastie_id)
+        return [(self._shards[name], ids) for name, ids in groups.items()]
+
+    @property
+    def is_connected(self):
+        return all(shard.is_connected for shard in self._shards.values())
+
+    @property
+    def connection(self):
+        return self._primary.connection
+
+    @property
+    def database(self):
+        return self._primary.database
+
+    def ensure_indexes(self):
+        for shard in self._shards.values():
+            shard.ensure_indexes()
+
+    def warm_up(self):
+        for shard in self._shards.values():
+            shard.warm_up()
+
+    def count(self, query=None):
+        return sum(shard.count(query) for shard in self._shards.values())
+
+    def increment_counter(self, counter_name, amount=1):
+        return self._primary.increment_counter(counter_name, amount)
+
+    def get(self, pastie_id):
+        owner = self._owner(pastie_id)
+        doc = owner.get(pastie_id)
+        for shard in self._others(owner) if doc is None else []:
+            doc = shard.get(pastie_id)
+            if doc is not None:
+                break
+        return doc
+
+    def get_by_unique_id(self, unique_id):
+        for shard in self._shards.values():
+            doc = shard.get_by_unique_id(unique_id)
+            if doc is not None:
+                return doc
+        return None
+
+    def new_unique_id(self):
+        return self._primary.new_unique_id()
+
+    def insert(self, doc):
+        owner = self._owner(doc["id"])
+        for shard in self._others(owner):
+            if shard.get(doc["id"]) is not None:
+                raise ValueError(f"A pastie with ID {doc['id']} exists")
+        return owner.insert(doc)
+
+    def insert_many(self, docs):
+        if self.rebalancing:
+            return super().insert_many(docs)
+        groups = collections.defaultdict(list)
+        for index, doc in enumerate(docs):
+            groups[self._ring.node_for(doc["id"])].append(index)
+        errors = {}
+        for name, indexes in groups.items():
+            shard_errors = self._shards[name].insert_many(
+                [docs[index] for index in indexes])
+            errors.update((indexes[position], err)
+                          for position, err in shard_errors.items())
+        return errors
+
+    def get_many(self, pastie_ids):
+        docs = []
+        for shard, ids in self._group(pastie_ids):
+            docs.extend(shard.get_many(ids))
+        if self.rebalancing:
+            found = {doc["id"] for doc in docs}
+            missing = (self.get(pastie_id) for pastie_id in pastie_ids
+                       if pastie_id not in found)
+            docs.extend(doc for doc in missing if doc is not None)
+        return docs
+
+    def replace(self, pastie_id, doc):
+        owner = self._owner(pastie_id)
+        return owner.replace(pastie_id, doc) or any(
+            shard.replace(pastie_id, doc) for shard in self._others(owner))
+
+    def update(self, pastie_id, update, expected=None):
+        owner = self._owner(pastie_id)
+        return owner.update(pastie_id, update, expected) or any(
+            shard.update(pastie_id, update, expected)
+            for shard in self._others(owner))
+
+    def delete(self, pastie_id):
+        owner = self._owner(pastie_id)
+        doc = owner.delete(pastie_id)
+        for shard in self._others(owner) if doc is None else []:
+            doc = shard.delete(pastie_id)
+            if doc is not None:
+                break
+        return doc
+
+    def find(self, query=None, max_records=None, fields=None):
+        wanted = fields
+        if fields is not None and "id" not in fields:
+            wanted = list(fields) + ["id"]
+        merged = heapq.merge(
+            *(shard.find(query, max_records, wanted)
+              for shard in self._shards.values()),
+            key=lambda doc: doc["id"])
+        # A pastie being moved can briefly be on two shards at once.
+        unique = (next(docs) for _, docs in
+                  itertools.groupby(merged, key=lambda doc: doc["id"]))
+        if wanted is not fields:
+            unique = ({field: doc[field] for field in fields if field in doc}
+                      for doc in unique)
+        return itertools.islice(unique, max_records)
+
+    def expired_ids(self, now, limit):
+        expired = []
+        for shard in self._shards.values():
+            ids = shard.expired_ids(now, limit)
+            if ids:
+                expired.extend(
+                    (doc["expires_at"], doc["id"]) for doc in
+                    shard.find({"id": {"$in": ids}},
+                               fields=["id", "expires_at"]))
+        return [pastie_id for _, pastie_id in sorted(expired)[:limit]]
+
+    def add_body_ref(self, digest, body):
+        self._primary.add_body_ref(digest, body)
+
+    def get_body(self, digest):
+        return self._primary.get_body(digest)
+
+    def release_body_ref(self, digest):
+        self._primary.release_body_ref(digest)
+
+    def put_chunk(self, key, data):
+        self._primary.put_chunk(key, data)
+
+    def get_chunks(self, keys):
+        return self._primary.get_chunks(keys)
+
+    def delete_chunks(self, keys):
+        self._primary.delete_chunks(keys)
+
+    def put_postings(self, pastie_id, postings):
+        self._owner(pastie_id).put_postings(pastie_id, postings)
+
+    def delete_postings(self, pastie_id, terms=None):
+        owner = self._owner(pastie_id)
+        owner.delete_postings(pastie_id, terms)
+        for shard in self._others(owner):
+            shard.delete_postings(pastie_id, terms)
+
+    def get_postings(self, pastie_id):
+        owner = self._owner(pastie_id)
+        postings = owner.get_postings(pastie_id)
+        for shard in self._others(owner) if not postings else []:
+            postings = shard.get_postings(pastie_id)
+            if postings:
+                break
+        return postings
+
+    def find_postings(self, term, pastie_ids=None):
+        if pastie_ids is None or self.rebalancing:
+            groups = [(shard, pastie_ids) for shard in self._shards.values()]
+        else:
+            groups = self._group(pastie_ids)
+        found = {}
+        for shard, ids in groups:
+            found.update(shard.find_postings(term, ids))
+        return found
+
+    def count_postings(self, term):
+        return sum(shard.count_postings(term)
+                   for shard in self._shards.values())
+
+    def clear_postings(self):
+        for shard in self._shards.values():
+            shard.clear_postings()
+
+    def _move(self, pastie_id, source, target):
+        """Move a pastie and its postings from one shard to another."""
+
+        doc = source.get(pastie_id)
+        if doc is None:
+            return False
+        try:
+            target.insert(doc)
+        except ValueError:
+            # Copied by an earlier, interrupted pass, and possibly changed
+            # on the target since; the target's copy is the one to keep.
+            pass
+        else:
+            # Catch changes made to the old copy while it was being copied.
+            current = source.get(pastie_id)
+            while current is not None and current != doc:
+                target.replace(pastie_id, current)
+                doc, current = current, source.get(pastie_id)
+            postings = source.get_postings(pastie_id)
+            if postings and not target.get_postings(pastie_id):
+                target.put_postings(pastie_id, postings)
+        source.delete(pastie_id)
+        source.delete_postings(pastie_id)
+        return True
+
+    def rebalance(self, batch_size=SCAN_BATCH_SIZE):
+        """Move every pastie which isn't on the shard owning it there,
+        reading batch_size pastie IDs at a time. Only pasties whose owner
+        has changed are touched. Returns a dictionary with the number of
+        pasties moved onto each shard.
+
+        Every process using the shards should have rebalancing set until
+        this has finished."""
+
+        moved = dict.fromkeys(self._shards, 0)
+        for name, shard in self._shards.items():
+            last_id = None
+            while True:
+                query = None if last_id is None else {"id": {"$gt": last_id}}
+                ids = [doc["id"] for doc in
+                       shard.find(query, batch_size, ["id"])]
+                if not ids:
+                    break
+                last_id = ids[-1]
+                for pastie_id in ids:
+                    owner = self._ring.node_for(pastie_id)
+                    if owner != name and \
+                            self._move(pastie_id, shard, self._shards[owner]):
+                        moved[owner] += 1
+        return moved
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "rebalance":
+        sys.exit(f"Usage: {sys.argv[0]} rebalance [config.yaml]")
+    with open(sys.argv[2] if len(sys.argv) == 3 else "config.yaml") as cfg:
+        db_settings = yaml.load(cfg, Loader=yaml.FullLoader)['database']
+    if not db_settings.get('shards'):
+        sys.exit("No shards are configured")
+    started = time.perf_counter()
+    moved_to = ShardedEngine.from_config(db_settings).rebalance()
+    for shard_name, count in moved_to.items():
+        print(f"{shard_name}: {count} pasties moved in")
+    print(f"Rebalanced in {time.perf_counter() - started:.1f}s")
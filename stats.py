@@ -0,0 +1,183 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : stats.py
+Description : Aggregate statistics about the stored pasties (how many there
+              are, how many bytes they hold, and how many each user owns),
+              kept up to date as pasties are written and reconciled with
+              the stored data in the background.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PastieStats:
+    """Running totals of the number of pasties, their total size in bytes,
+    and the number of pasties owned by each user.
+
+    The Datastore adjusts the totals as it creates, updates and deletes
+    pasties, so reading them costs nothing. They only cover writes made
+    through this process, though, so they are replaced from time to time
+    with totals worked out from the stored pasties (see reconcile); the
+    totals are never older than that."""
+
+    def __init__(self):
+        """Create an empty set of totals, which is filled in by the first
+        reconciliation."""
+
+        self._lock = threading.Lock()
+        self._count = 0
+        self._bytes = 0
+        self._owners = {}
+        self._reconciled_at = None
+
+    @property
+    def reconciled(self):
+        """Check if the totals have been reconciled yet."""
+
+        return self._reconciled_at is not None
+
+    def add(self, owner, size, count=1):
+        """Adjust the totals for count pasties (negative when they are
+        deleted) owned by owner (None if nobody) holding size bytes."""
+
+        with self._lock:
+            self._count += count
+            self._bytes += size
+            if owner is not None and count:
+                owned = self._owners.get(owner, 0) + count
+                if owned > 0:
+                    self._owners[owner] = owned
+                else:
+                    self._owners.pop(owner, None)
+
+    def reconcile(self, pasties):
+        """Replace the totals with ones worked out from an iterable of
+        (owner, size) tuples, one for each stored pastie. Returns the
+        number of pasties the old totals were out by."""
+
+        count = 0
+        size = 0
+        owners = {}
+        for owner, pastie_size in pasties:
+            count += 1
+            size += pastie_size
+            if owner is not None:
+                owners[owner] = owners.get(owner, 0) + 1
+        with self._lock:
+            drift = abs(self._count - count)
+            self._count = count
+            self._bytes = size
+            self._owners = owners
+            self._reconciled_at = time.time()
+        return drift
+
+    @property
+    def count(self):
+        """Get the number of pasties."""
+
+        return self._count
+
+    def snapshot(self):
+        """Get the totals as a dictionary: pasties, bytes, per_user (a
+        dictionary mapping each owner to their number of pasties), and
+        reconciled_at, the time of the last reconciliation."""
+
+        with self._lock:
+            return {
+                "pasties": self._count,
+                "bytes": self._bytes,
+                "per_user": dict(self._owners),
+                "reconciled_at": self._reconciled_at,
+            }
+
+
+class StatsReconciler:
+    """Reconciles a Datastore's aggregate statistics with the stored
+    pasties in the background, every interval seconds (see
+    Datastore.reconcile_stats).
+
+    The stats property reports the number of passes, the time taken by the
+    last pass, and how many pasties the totals were out by before it."""
+
+    def __init__(self, datastore):
+        """Create a reconciler for a Datastore (or a proxy for one)."""
+
+        self._datastore = datastore
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            "passes": 0,
+            "last_pass_seconds": 0.0,
+            "last_drift": 0,
+        }
+
+    @property
+    def stats(self):
+        """Get the reconciler's statistics."""
+
+        return dict(self._stats)
+
+    def run_once(self):
+        """Reconcile the statistics once. Returns the drift found."""
+
+        started = time.perf_counter()
+        drift = self._datastore.reconcile_stats()
+        self._stats["passes"] += 1
+        self._stats["last_pass_seconds"] = time.perf_counter() - started
+        self._stats["last_drift"] = drift
+        return drift
+
+    def start(self, interval=300):
+        """Start a background thread which reconciles the statistics every
+        interval seconds."""
+
+        if self._thread is not None:
+            return
+
+        def reconcile():
+            while not self._stop.wait(interval):
+                try:
+                    self.run_once()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Reconciling the pastie statistics failed")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=reconcile, daemon=True,
+                                        name="stats-reconciler")
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, if it is running."""
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
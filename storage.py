@@ -0,0 +1,1008 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : storage.py
+Description : Storage engines used by the Datastore (datastore.py). Each
+              engine implements the same small set of primitives over a
+              different back end: MongoDB, an embedded SQLite database, or a
+              plain in-process dictionary.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import bisect
+import copy
+import json
+import sqlite3
+import threading
+import uuid
+
+from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, \
+    ServerSelectionTimeoutError
+
+# The mongodb error code for a duplicate key in a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+# Number of rows the embedded engines fetch per step when iterating over a
+# result set, so a full listing never has to be held in memory at once.
+SCAN_BATCH_SIZE = 500
+
+# Number of body chunks the mongodb engine fetches per query.
+CHUNK_BATCH_SIZE = 8
+
+# Connection pool settings read from the database.pool section of the
+# configuration, and the MongoClient options they set.
+MONGO_POOL_OPTIONS = {
+    "max_pool_size": "maxPoolSize",
+    "min_pool_size": "minPoolSize",
+    "max_idle_time_ms": "maxIdleTimeMS",
+    "wait_queue_timeout_ms": "waitQueueTimeoutMS",
+    "server_selection_timeout_ms": "serverSelectionTimeoutMS",
+    "connect_timeout_ms": "connectTimeoutMS",
+    "socket_timeout_ms": "socketTimeoutMS",
+}
+
+_COMPARISONS = {
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+    "$ne": lambda value, arg: value != arg,
+    "$in": lambda value, arg: value in arg,
+    "$nin": lambda value, arg: value not in arg,
+}
+
+
+def match_query(doc, query):
+    """Check whether a document matches a (simple) mongodb-style query.
+
+    The embedded engines support field equality and the $gt, $gte, $lt,
+    $lte, $ne, $in, $nin and $exists operators, which covers every query
+    the application itself issues."""
+
+    for field, cond in (query or {}).items():
+        value = doc.get(field)
+        if isinstance(cond, dict):
+            for oper, arg in cond.items():
+                if oper == "$exists":
+                    if (field in doc) != bool(arg):
+                        return False
+                elif oper in _COMPARISONS:
+                    if not _COMPARISONS[oper](value, arg):
+                        return False
+                else:
+                    raise ValueError(f"Unsupported query operator {oper}")
+        elif value != cond:
+            return False
+    return True
+
+
+def _path_parent(doc, path):
+    """Find the container holding the field named by a dotted path, along
+    with the last part of the path (an index, for a list)."""
+
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc[int(part)] if isinstance(doc, list) else doc[part]
+    key = parts[-1]
+    return doc, int(key) if isinstance(doc, list) else key
+
+
+def apply_update(doc, update):
+    """Apply a (simple) mongodb-style update to a document in place.
+
+    The embedded engines support the $set, $unset and $push (with $each)
+    operators on dotted field paths, which covers every update the
+    application itself issues."""
+
+    for oper, fields in update.items():
+        for path, arg in fields.items():
+            parent, key = _path_parent(doc, path)
+            if oper == "$set":
+                parent[key] = arg
+            elif oper == "$unset":
+                parent.pop(key, None)
+            elif oper == "$push":
+                parent.setdefault(key, []).extend(arg["$each"])
+            else:
+                raise ValueError(f"Unsupported update operator {oper}")
+    return doc
+
+
+def project(doc, fields):
+    """Get the fields of a document named in a projection (a list of field
+    names), or the whole document if fields is None."""
+
+    if fields is None:
+        return doc
+    return {field: doc[field] for field in fields if field in doc}
+
+
+def _id_lower_bound(query):
+    """Work out the smallest pastie ID a query could possibly match.
+
+    Used by the embedded engines to start an ID-ordered scan part-way
+    through the collection instead of at the beginning."""
+
+    cond = (query or {}).get("id")
+    if cond is None:
+        return None
+    if not isinstance(cond, dict):
+        return cond
+    if "$gt" in cond:
+        return cond["$gt"] + 1
+    if "$gte" in cond:
+        return cond["$gte"]
+    if "$in" in cond and cond["$in"]:
+        return min(cond["$in"])
+    return None
+
+
+class StorageEngine:
+    """Base class for the storage engines.
+
+    An engine stores pastie documents (dictionaries keyed by field name)
+    indexed by their numeric "id" field, plus a set of named counters. The
+    Datastore class implements all of the application logic on top of
+    these primitives, so an engine only has to know how to move documents
+    in and out of its back end.
+
+    The blocking attribute says whether the engine's operations wait on
+    I/O; the async datastore runs the operations of blocking engines on a
+    thread pool, and those of other engines directly."""
+
+    name = None
+    blocking = True
+
+    @property
+    def is_connected(self):
+        """Check if the engine can reach its back end."""
+
+        return True
+
+    @property
+    def connection(self):
+        """Get the underlying connection object, if the engine has one."""
+
+        return None
+
+    @property
+    def database(self):
+        """Get the underlying database object, if the engine has one."""
+
+        return None
+
+    def ensure_indexes(self):
+        """Create any indexes the engine needs. This must be idempotent."""
+
+    def warm_up(self):
+        """Open the engine's connections ahead of the first request."""
+
+    def count(self, query=None):
+        """Count the documents matching a query."""
+
+        raise NotImplementedError
+
+    def increment_counter(self, counter_name, amount=1):
+        """Increment a named counter and return its new value."""
+
+        raise NotImplementedError
+
+    def get(self, pastie_id):
+        """Get a document by its numeric ID, or None if there isn't one."""
+
+        raise NotImplementedError
+
+    def get_by_unique_id(self, unique_id):
+        """Get a document by its unique (_id) key, or None."""
+
+        raise NotImplementedError
+
+    def new_unique_id(self):
+        """Make a new unique _id for a document, for documents whose _id
+        must be known before they are inserted."""
+
+        return uuid.uuid4().hex
+
+    def insert(self, doc):
+        """Insert a new document. The document is returned, with its unique
+        _id key filled in (unless it already has one). If a document with
+        the same numeric ID already exists, a ValueError is raised."""
+
+        raise NotImplementedError
+
+    def insert_many(self, docs):
+        """Insert several new documents, filling in their _id keys. A
+        failure to insert one document doesn't stop the rest being
+        inserted. Returns a dictionary mapping the index of each document
+        which couldn't be inserted to a ValueError describing why."""
+
+        errors = {}
+        for index, doc in enumerate(docs):
+            try:
+                self.insert(doc)
+            except ValueError as err:
+                errors[index] = err
+        return errors
+
+    def get_many(self, pastie_ids):
+        """Get the documents with any of the given numeric IDs."""
+
+        docs = (self.get(pastie_id) for pastie_id in pastie_ids)
+        return [doc for doc in docs if doc is not None]
+
+    def replace(self, pastie_id, doc):
+        """Replace the document with a given numeric ID. Returns True if a
+        document was replaced, or False if there was nothing to replace."""
+
+        raise NotImplementedError
+
+    def update(self, pastie_id, update, expected=None):
+        """Apply a mongodb-style update (see apply_update) to the document
+        with a given numeric ID, without rewriting the rest of it. If
+        expected is given, the update is only applied if the document's
+        fields have the values in it. Returns True if a document was
+        updated."""
+
+        raise NotImplementedError
+
+    def delete(self, pastie_id):
+        """Delete a document by numeric ID, returning the deleted document,
+        or None if there was no such document."""
+
+        raise NotImplementedError
+
+    def find(self, query=None, max_records=None, fields=None):
+        """Iterate over the documents matching a query, in ID order. If
+        fields (a list of field names) is given, only those fields of the
+        documents are returned."""
+
+        raise NotImplementedError
+
+    def expired_ids(self, now, limit):
+        """Get the IDs of up to limit documents whose expires_at field (a
+        Unix timestamp) is at or before now, soonest expiry first."""
+
+        raise NotImplementedError
+
+    def add_body_ref(self, digest, body):
+        """Add a reference to a pastie body stored under its digest. If no
+        body with that digest is stored yet, body (a dictionary holding the
+        encoded data, the codec used, and the decoded size) is stored with
+        a reference count of 1; otherwise the count is incremented."""
+
+        raise NotImplementedError
+
+    def get_body(self, digest):
+        """Get the body stored under a digest, or None if there isn't one."""
+
+        raise NotImplementedError
+
+    def release_body_ref(self, digest):
+        """Drop a reference to a stored body, deleting the body once no
+        references are left."""
+
+        raise NotImplementedError
+
+    def put_chunk(self, key, data):
+        """Store one chunk (a byte string) of a chunked body under a new,
+        unique key."""
+
+        raise NotImplementedError
+
+    def get_chunks(self, keys):
+        """Iterate over the data of the chunks with the given keys, in the
+        same order. Only a few chunks are read at a time."""
+
+        raise NotImplementedError
+
+    def delete_chunks(self, keys):
+        """Delete the chunks with the given keys."""
+
+        raise NotImplementedError
+
+    def put_postings(self, pastie_id, postings):
+        """Add (or update) search index postings for a pastie. postings is
+        a dictionary mapping each term to its frequency in the pastie."""
+
+        raise NotImplementedError
+
+    def delete_postings(self, pastie_id, terms=None):
+        """Delete a pastie's postings for the given terms, or all of its
+        postings if terms is None."""
+
+        raise NotImplementedError
+
+    def get_postings(self, pastie_id):
+        """Get a dictionary mapping each term indexed for a pastie to its
+        frequency."""
+
+        raise NotImplementedError
+
+    def find_postings(self, term, pastie_ids=None):
+        """Get a dictionary mapping the ID of each pastie containing a term
+        to the term's frequency in it. If pastie_ids is given, only those
+        pasties are looked at."""
+
+        raise NotImplementedError
+
+    def count_postings(self, term):
+        """Count the pasties containing a term."""
+
+        raise NotImplementedError
+
+    def clear_postings(self):
+        """Delete the whole search index."""
+
+        raise NotImplementedError
+
+
+class MongoEngine(StorageEngine):
+    """Storage engine backed by a mongodb server."""
+
+    name = "mongo"
+
+    def __init__(self, db_config):
+        """Set up a client for the mongodb server described by db_config
+        (the database section of config.yaml), with the connection pool
+        settings in its pool section (see MONGO_POOL_OPTIONS).
+
+        No connection is made until the client is first used (or
+        warm_up is called), so an engine created before a server forks its
+        worker processes doesn't hand them a client whose connections and
+        monitoring threads belong to the parent."""
+
+        pool_config = db_config.get('pool') or {}
+        self._client = MongoClient(
+            db_config['hostname'],
+            db_config['port'],
+            username=db_config['api_server']['username'],
+            password=db_config['api_server']['password'],
+            authSource=db_config['auth_source'],
+            authMechanism=db_config['auth_mechanism'],
+            connect=False,
+            **{option: pool_config[setting]
+               for setting, option in MONGO_POOL_OPTIONS.items()
+               if pool_config.get(setting) is not None})
+
+        self._db = self._client[db_config['db_name']]
+        self._pasties = self._db.pasties
+        self._counters = self._db.counters
+        self._bodies = self._db.bodies
+        self._chunks = self._db.chunks
+        self._postings = self._db.postings
+
+    @property
+    def is_connected(self):
+        try:
+            svr_info = self._client.server_info()
+            if svr_info["version"] is not None:
+                return True
+            return False
+        except KeyError:
+            return False
+        except ServerSelectionTimeoutError:
+            return False
+
+    @property
+    def connection(self):
+        return self._client
+
+    @property
+    def database(self):
+        return self._db
+
+    def warm_up(self):
+        self._client.admin.command("ping")
+
+    def new_unique_id(self):
+        return ObjectId()
+
+    def ensure_indexes(self):
+        self._pasties.create_index("id", unique=True)
+        self._postings.create_index([("term", 1), ("id", 1)], unique=True)
+        self._postings.create_index("id")
+        self._pasties.create_index("expires_at", sparse=True)
+
+    def count(self, query=None):
+        if not query:
+            # From the collection metadata, rather than a scan
+            return self._pasties.estimated_document_count()
+        return self._pasties.count_documents(query)
+
+    def increment_counter(self, counter_name, amount=1):
+        # Upserted, as the other engines do, so a fresh database (which an
+        # import ends by moving the counter of) needs no counter set up.
+        res = self._counters.find_one_and_update(
+            filter={"counterName": counter_name},
+            update={"$inc": {"counterValue": amount}},
+            projection=["counterName", "counterValue"],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return res["counterValue"]
+
+    def get(self, pastie_id):
+        return self._pasties.find_one({"id": pastie_id})
+
+    def get_by_unique_id(self, unique_id):
+        return self._pasties.find_one({"_id": unique_id})
+
+    def insert(self, doc):
+        try:
+            self._pasties.insert_one(doc)
+        except DuplicateKeyError:
+            raise ValueError(f"A pastie with ID {doc['id']} exists")
+        return doc
+
+    def insert_many(self, docs):
+        if not docs:
+            return {}
+        try:
+            self._pasties.insert_many(docs, ordered=False)
+        except BulkWriteError as err:
+            errors = {}
+            for write_error in err.details.get("writeErrors", []):
+                index = write_error["index"]
+                if write_error.get("code") == DUPLICATE_KEY_ERROR:
+                    message = f"A pastie with ID {docs[index]['id']} exists"
+                else:
+                    message = write_error.get("errmsg", "Write failed")
+                errors[index] = ValueError(message)
+            return errors
+        return {}
+
+    def get_many(self, pastie_ids):
+        return list(self._pasties.find({"id": {"$in": list(pastie_ids)}}))
+
+    def replace(self, pastie_id, doc):
+        res = self._pasties.replace_one({"id": pastie_id},
+                                        dict(doc, id=pastie_id))
+        return res.matched_count > 0
+
+    def update(self, pastie_id, update, expected=None):
+        res = self._pasties.update_one(dict(expected or {}, id=pastie_id),
+                                       update)
+        return res.matched_count > 0
+
+    def delete(self, pastie_id):
+        return self._pasties.find_one_and_delete({"id": pastie_id})
+
+    def find(self, query=None, max_records=None, fields=None):
+        projection = None
+        if fields is not None:
+            projection = dict({field: 1 for field in fields},
+                              _id=int("_id" in fields))
+        cursor = self._pasties.find(query or {}, projection).sort("id")
+        if max_records is not None:
+            cursor = cursor.limit(max_records)
+        return cursor
+
+    def expired_ids(self, now, limit):
+        return [doc["id"] for doc in
+                self._pasties.find({"expires_at": {"$lte": now}},
+                                   {"_id": 0, "id": 1})
+                .sort("expires_at").limit(limit)]
+
+    def add_body_ref(self, digest, body):
+        self._bodies.update_one(
+            {"_id": digest},
+            {"$inc": {"refcount": 1}, "$setOnInsert": body},
+            upsert=True)
+
+    def get_body(self, digest):
+        return self._bodies.find_one({"_id": digest})
+
+    def release_body_ref(self, digest):
+        res = self._bodies.find_one_and_update(
+            {"_id": digest}, {"$inc": {"refcount": -1}},
+            return_document=ReturnDocument.AFTER)
+        if res is not None and res["refcount"] <= 0:
+            self._bodies.delete_one({"_id": digest,
+                                     "refcount": {"$lte": 0}})
+
+    def put_chunk(self, key, data):
+        self._chunks.insert_one({"_id": key, "data": data})
+
+    def get_chunks(self, keys):
+        for start in range(0, len(keys), CHUNK_BATCH_SIZE):
+            batch = keys[start:start + CHUNK_BATCH_SIZE]
+            found = {chunk["_id"]: bytes(chunk["data"]) for chunk in
+                     self._chunks.find({"_id": {"$in": batch}})}
+            for key in batch:
+                yield found.get(key, b"")
+
+    def delete_chunks(self, keys):
+        self._chunks.delete_many({"_id": {"$in": list(keys)}})
+
+    def put_postings(self, pastie_id, postings):
+        if postings:
+            self._postings.bulk_write([
+                UpdateOne({"term": term, "id": pastie_id},
+                          {"$set": {"tf": freq}}, upsert=True)
+                for term, freq in postings.items()], ordered=False)
+
+    def delete_postings(self, pastie_id, terms=None):
+        query = {"id": pastie_id}
+        if terms is not None:
+            query["term"] = {"$in": list(terms)}
+        self._postings.delete_many(query)
+
+    def get_postings(self, pastie_id):
+        return {posting["term"]: posting["tf"] for posting in
+                self._postings.find({"id": pastie_id},
+                                    {"_id": 0, "term": 1, "tf": 1})}
+
+    def find_postings(self, term, pastie_ids=None):
+        query = {"term": term}
+        if pastie_ids is not None:
+            query["id"] = {"$in": list(pastie_ids)}
+        return {posting["id"]: posting["tf"] for posting in
+                self._postings.find(query, {"_id": 0, "id": 1, "tf": 1})}
+
+    def count_postings(self, term):
+        return self._postings.count_documents({"term": term})
+
+    def clear_postings(self):
+        self._postings.delete_many({})
+
+
+class MemoryEngine(StorageEngine):
+    """Storage engine which keeps everything in a dictionary in the current
+    process. Nothing is persisted; this is intended for tests, benchmarks
+    and throwaway deployments."""
+
+    name = "memory"
+    blocking = False
+
+    def __init__(self, db_config=None):
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._ids = []
+        self._unique_ids = {}
+        self._counters = {}
+        self._bodies = {}
+        self._chunks = {}
+        self._postings = {}
+        self._pastie_terms = {}
+
+    def count(self, query=None):
+        if not query:
+            return len(self._docs)
+        return sum(1 for _ in self.find(query))
+
+    def increment_counter(self, counter_name, amount=1):
+        with self._lock:
+            value = self._counters.get(counter_name, 0) + amount
+            self._counters[counter_name] = value
+            return value
+
+    def get(self, pastie_id):
+        doc = self._docs.get(pastie_id)
+        return dict(doc) if doc is not None else None
+
+    def get_by_unique_id(self, unique_id):
+        pastie_id = self._unique_ids.get(unique_id)
+        if pastie_id is None:
+            return None
+        return self.get(pastie_id)
+
+    def insert(self, doc):
+        doc.setdefault("_id", uuid.uuid4().hex)
+        with self._lock:
+            if doc["id"] in self._docs:
+                raise ValueError(f"A pastie with ID {doc['id']} exists")
+            self._docs[doc["id"]] = dict(doc)
+            self._unique_ids[doc["_id"]] = doc["id"]
+            bisect.insort(self._ids, doc["id"])
+        return doc
+
+    def replace(self, pastie_id, doc):
+        with self._lock:
+            old_doc = self._docs.get(pastie_id)
+            if old_doc is None:
+                return False
+            new_doc = dict(doc, id=pastie_id, _id=old_doc["_id"])
+            self._docs[pastie_id] = new_doc
+            return True
+
+    def update(self, pastie_id, update, expected=None):
+        with self._lock:
+            doc = self._docs.get(pastie_id)
+            if doc is None or not match_query(doc, expected):
+                return False
+            self._docs[pastie_id] = apply_update(copy.deepcopy(doc), update)
+            return True
+
+    def delete(self, pastie_id):
+        with self._lock:
+            doc = self._docs.pop(pastie_id, None)
+            if doc is None:
+                return None
+            del self._unique_ids[doc["_id"]]
+            del self._ids[bisect.bisect_left(self._ids, pastie_id)]
+            return doc
+
+    def find(self, query=None, max_records=None, fields=None):
+        lower = _id_lower_bound(query)
+        returned = 0
+        while max_records is None or returned < max_records:
+            with self._lock:
+                if lower is None:
+                    start = 0
+                else:
+                    start = bisect.bisect_left(self._ids, lower)
+                batch = [self._docs[pastie_id] for pastie_id in
+                         self._ids[start:start + SCAN_BATCH_SIZE]]
+            if not batch:
+                return
+            for doc in batch:
+                if match_query(doc, query):
+                    yield dict(project(doc, fields))
+                    returned += 1
+                    if max_records is not None and returned >= max_records:
+                        return
+            lower = batch[-1]["id"] + 1
+
+    def expired_ids(self, now, limit):
+        with self._lock:
+            expired = [(doc["expires_at"], pastie_id) for pastie_id, doc
+                       in self._docs.items()
+                       if doc.get("expires_at") is not None and
+                       doc["expires_at"] <= now]
+        return [pastie_id for _, pastie_id in sorted(expired)[:limit]]
+
+    def add_body_ref(self, digest, body):
+        with self._lock:
+            stored = self._bodies.setdefault(digest, dict(body, refcount=0))
+            stored["refcount"] += 1
+
+    def get_body(self, digest):
+        return self._bodies.get(digest)
+
+    def release_body_ref(self, digest):
+        with self._lock:
+            stored = self._bodies.get(digest)
+            if stored is not None:
+                stored["refcount"] -= 1
+                if stored["refcount"] <= 0:
+                    del self._bodies[digest]
+
+    def put_chunk(self, key, data):
+        with self._lock:
+            self._chunks[key] = bytes(data)
+
+    def get_chunks(self, keys):
+        for key in keys:
+            yield self._chunks.get(key, b"")
+
+    def delete_chunks(self, keys):
+        with self._lock:
+            for key in keys:
+                self._chunks.pop(key, None)
+
+    def put_postings(self, pastie_id, postings):
+        with self._lock:
+            for term, freq in postings.items():
+                self._postings.setdefault(term, {})[pastie_id] = freq
+            self._pastie_terms.setdefault(pastie_id, {}).update(postings)
+
+    def delete_postings(self, pastie_id, terms=None):
+        with self._lock:
+            pastie_terms = self._pastie_terms.get(pastie_id, {})
+            for term in list(pastie_terms) if terms is None else terms:
+                pasties = self._postings.get(term, {})
+                pasties.pop(pastie_id, None)
+                if not pasties:
+                    self._postings.pop(term, None)
+                pastie_terms.pop(term, None)
+            if not pastie_terms:
+                self._pastie_terms.pop(pastie_id, None)
+
+    def get_postings(self, pastie_id):
+        return dict(self._pastie_terms.get(pastie_id, {}))
+
+    def find_postings(self, term, pastie_ids=None):
+        pasties = self._postings.get(term, {})
+        if pastie_ids is None:
+            return dict(pasties)
+        return {pastie_id: pasties[pastie_id] for pastie_id in pastie_ids
+                if pastie_id in pasties}
+
+    def count_postings(self, term):
+        return len(self._postings.get(term, {}))
+
+    def clear_postings(self):
+        with self._lock:
+            self._postings.clear()
+            self._pastie_terms.clear()
+
+
+class SQLiteEngine(StorageEngine):
+    """Storage engine backed by an embedded SQLite database.
+
+    Documents are stored as JSON, keyed by their numeric ID, so lookups by
+    ID never leave the process. The database path is read from the sqlite
+    section of the database configuration; ":memory:" gives a private
+    in-memory database."""
+
+    name = "sqlite"
+
+    def __init__(self, db_config=None):
+        sqlite_config = (db_config or {}).get("sqlite") or {}
+        self._path = sqlite_config.get("path", ":memory:")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self._path, check_same_thread=False,
+                                     isolation_level=None)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pasties ("
+                "id INTEGER PRIMARY KEY, "
+                "unique_id TEXT NOT NULL UNIQUE, "
+                "doc TEXT NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                "name TEXT PRIMARY KEY, "
+                "value INTEGER NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS bodies ("
+                "digest TEXT PRIMARY KEY, "
+                "data BLOB NOT NULL, "
+                "codec TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "refcount INTEGER NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "key TEXT PRIMARY KEY, "
+                "data BLOB NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS postings ("
+                "term TEXT NOT NULL, "
+                "id INTEGER NOT NULL, "
+                "tf INTEGER NOT NULL, "
+                "PRIMARY KEY (term, id)) WITHOUT ROWID")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS pasties_expires_at ON pasties "
+                "(json_extract(doc, '$.expires_at')) "
+                "WHERE json_extract(doc, '$.expires_at') IS NOT NULL")
+
+    @property
+    def connection(self):
+        return self._conn
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def count(self, query=None):
+        if not query:
+            return self._query("SELECT COUNT(*) FROM pasties")[0][0]
+        return sum(1 for _ in self.find(query))
+
+    def increment_counter(self, counter_name, amount=1):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                (counter_name, amount, amount))
+            return self._conn.execute(
+                "SELECT value FROM counters WHERE name = ?",
+                (counter_name,)).fetchone()[0]
+
+    def get(self, pastie_id):
+        rows = self._query("SELECT doc FROM pasties WHERE id = ?",
+                           (pastie_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_by_unique_id(self, unique_id):
+        rows = self._query("SELECT doc FROM pasties WHERE unique_id = ?",
+                           (unique_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_many(self, pastie_ids):
+        pastie_ids = list(pastie_ids)
+        if not pastie_ids:
+            return []
+        placeholders = ", ".join("?" * len(pastie_ids))
+        rows = self._query(f"SELECT doc FROM pasties "
+                           f"WHERE id IN ({placeholders})", pastie_ids)
+        return [json.loads(row[0]) for row in rows]
+
+    def insert(self, doc):
+        doc.setdefault("_id", uuid.uuid4().hex)
+        try:
+            self._query("INSERT INTO pasties (id, unique_id, doc) "
+                        "VALUES (?, ?, ?)",
+                        (doc["id"], doc["_id"], json.dumps(doc)))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"A pastie with ID {doc['id']} exists")
+        return doc
+
+    def replace(self, pastie_id, doc):
+        old_doc = self.get(pastie_id)
+        if old_doc is None:
+            return False
+        new_doc = dict(doc, id=pastie_id, _id=old_doc["_id"])
+        self._query("UPDATE pasties SET doc = ? WHERE id = ?",
+                    (json.dumps(new_doc), pastie_id))
+        return True
+
+    def update(self, pastie_id, update, expected=None):
+        with self._lock:
+            row = self._conn.execute("SELECT doc FROM pasties WHERE id = ?",
+                                     (pastie_id,)).fetchone()
+            if row is None:
+                return False
+            doc = json.loads(row[0])
+            if not match_query(doc, expected):
+                return False
+            self._conn.execute("UPDATE pasties SET doc = ? WHERE id = ?",
+                               (json.dumps(apply_update(doc, update)),
+                                pastie_id))
+            return True
+
+    def delete(self, pastie_id):
+        with self._lock:
+            row = self._conn.execute("SELECT doc FROM pasties WHERE id = ?",
+                                     (pastie_id,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM pasties WHERE id = ?",
+                               (pastie_id,))
+            return json.loads(row[0])
+
+    def find(self, query=None, max_records=None, fields=None):
+        lower = _id_lower_bound(query)
+        if lower is None:
+            lower = -(2 ** 63)
+        returned = 0
+        while True:
+            rows = self._query("SELECT id, doc FROM pasties WHERE id >= ? "
+                               "ORDER BY id LIMIT ?",
+                               (lower, SCAN_BATCH_SIZE))
+            if not rows:
+                return
+            for _, doc_text in rows:
+                doc = json.loads(doc_text)
+                if match_query(doc, query):
+                    yield project(doc, fields)
+                    returned += 1
+                    if max_records is not None and returned >= max_records:
+                        return
+            lower = rows[-1][0] + 1
+
+    def expired_ids(self, now, limit):
+        return [row[0] for row in self._query(
+            "SELECT id FROM pasties "
+            "WHERE json_extract(doc, '$.expires_at') <= ? "
+            "ORDER BY json_extract(doc, '$.expires_at') LIMIT ?",
+            (now, limit))]
+
+    def add_body_ref(self, digest, body):
+        self._query("INSERT INTO bodies (digest, data, codec, size, refcount) "
+                    "VALUES (?, ?, ?, ?, 1) "
+                    "ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1",
+                    (digest, body["data"], body["codec"], body["size"]))
+
+    def get_body(self, digest):
+        rows = self._query("SELECT data, codec, size FROM bodies "
+                           "WHERE digest = ?", (digest,))
+        if not rows:
+            return None
+        data, codec, size = rows[0]
+        return {"data": data, "codec": codec, "size": size}
+
+    def release_body_ref(self, digest):
+        with self._lock:
+            self._conn.execute("UPDATE bodies SET refcount = refcount - 1 "
+                               "WHERE digest = ?", (digest,))
+            self._conn.execute("DELETE FROM bodies "
+                               "WHERE digest = ? AND refcount <= 0",
+                               (digest,))
+
+    def put_chunk(self, key, data):
+        self._query("INSERT INTO chunks (key, data) VALUES (?, ?)",
+                    (key, data))
+
+    def get_chunks(self, keys):
+        for key in keys:
+            rows = self._query("SELECT data FROM chunks WHERE key = ?",
+                               (key,))
+            yield rows[0][0] if rows else b""
+
+    def delete_chunks(self, keys):
+        with self._lock:
+            self._conn.executemany("DELETE FROM chunks WHERE key = ?",
+                                   [(key,) for key in keys])
+
+    def _execute_many(self, sql, rows):
+        """Run a statement for many rows in a single transaction."""
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(sql, rows)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def put_postings(self, pastie_id, postings):
+        self._execute_many(
+            "INSERT OR REPLACE INTO postings (term, id, tf) VALUES (?, ?, ?)",
+            [(term, pastie_id, freq) for term, freq in postings.items()])
+
+    def delete_postings(self, pastie_id, terms=None):
+        if terms is None:
+            self._query("DELETE FROM postings WHERE id = ?", (pastie_id,))
+        else:
+            self._execute_many(
+                "DELETE FROM postings WHERE term = ? AND id = ?",
+                [(term, pastie_id) for term in terms])
+
+    def get_postings(self, pastie_id):
+        return dict(self._query("SELECT term, tf FROM postings "
+                                "WHERE id = ?", (pastie_id,)))
+
+    def find_postings(self, term, pastie_ids=None):
+        if pastie_ids is None:
+            return dict(self._query("SELECT id, tf FROM postings "
+                                    "WHERE term = ?", (term,)))
+        pastie_ids = list(pastie_ids)
+        found = {}
+        for start in range(0, len(pastie_ids), SCAN_BATCH_SIZE):
+            batch = pastie_ids[start:start + SCAN_BATCH_SIZE]
+            found.update(self._query(
+                f"SELECT id, tf FROM postings WHERE term = ? AND id IN "
+                f"({', '.join('?' * len(batch))})", [term] + batch))
+        return found
+
+    def count_postings(self, term):
+        return self._query("SELECT COUNT(*) FROM postings WHERE term = ?",
+                           (term,))[0][0]
+
+    def clear_postings(self):
+        self._query("DELETE FROM postings")
+
+
+ENGINES = {
+    MongoEngine.name: MongoEngine,
+    SQLiteEngine.name: SQLiteEngine,
+    MemoryEngine.name: MemoryEngine,
+}
+
+
+def make_engine(db_config):
+    """Create the storage engine selected by the "engine" key of the
+    database configuration. If no engine is named, mongodb is used."""
+
+    engine_name = db_config.get("engine", MongoEngine.name)
+    try:
+        engine_class = ENGINES[engine_name]
+    except KeyError:
+        raise ValueError(f"Unknown storage engine {engine_name}")
+    return engine_class(db_config)
@@ -0,0 +1,88 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_admission.py
+Description : Unit tests for API admission control.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import time
+import unittest
+
+from admission import AdmissionController
+from schema import RequestError
+
+
+class TestAdmissionController(unittest.TestCase):
+    """Tests for the AdmissionController class."""
+
+    def test_unlimited_by_default(self):
+        """Verify that a controller with no limits admits everything."""
+        admission = AdmissionController.from_config({})
+        for _ in range(1000):
+            admission.acquire_slot()
+            admission.check_rate("tammy")
+        self.assertEqual(admission.stats["admitted"], 1000)
+
+    def test_token_bucket(self):
+        """Verify that each user's bucket empties and refills on its
+        own."""
+        admission = AdmissionController(rate=50, burst=2)
+        admission.check_rate("tammy")
+        admission.check_rate("tammy")
+        with self.assertRaises(RequestError) as caught:
+            admission.check_rate("tammy")
+        self.assertEqual(caught.exception.status, 429)
+        self.assertEqual(caught.exception.headers["Retry-After"], "1")
+        admission.check_rate("alex")
+        time.sleep(0.05)
+        admission.check_rate("tammy")
+        self.assertEqual(admission.stats["rate_limited"], 1)
+
+    def test_zero_rate(self):
+        """Verify that a rate of 0 turns rate limiting off, and that a
+        negative one is refused."""
+        admission = AdmissionController.from_config(
+            {"admission": {"enabled": True, "rate": 0, "burst": 1}})
+        for _ in range(10):
+            admission.check_rate("tammy")
+        self.assertEqual(admission.stats["rate_limited"], 0)
+        with self.assertRaises(ValueError):
+            AdmissionController(rate=-1)
+
+    def test_in_flight_cap(self):
+        """Verify that requests over the in-flight cap are shed."""
+        admission = AdmissionController(max_in_flight=2)
+        admission.acquire_slot()
+        admission.acquire_slot()
+        with self.assertRaises(RequestError) as caught:
+            admission.acquire_slot()
+        self.assertEqual(caught.exception.status, 503)
+        admission.release_slot()
+        admission.acquire_slot()
+        self.assertEqual(admission.stats["in_flight"], 2)
+        self.assertEqual(admission.stats["shed"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
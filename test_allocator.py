@@ -0,0 +1,99 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_allocator.py
+Description : Unit tests for the pastie ID allocator.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import threading
+import unittest
+
+from allocator import IdAllocator
+from storage import MemoryEngine
+
+
+class TestIdAllocator(unittest.TestCase):
+    """Tests for the IdAllocator class."""
+
+    def setUp(self):
+        self.engine = MemoryEngine()
+        self.allocator = IdAllocator(self.engine, block_size=10)
+
+    def test_allocate_reserves_blocks(self):
+        """Verify that the counter is only bumped once per block."""
+        ids = [self.allocator.allocate() for _ in range(25)]
+        self.assertEqual(ids, list(range(1, 26)))
+        self.assertEqual(self.engine.increment_counter("pasties", 0), 30)
+        stats = self.allocator.stats
+        self.assertEqual(stats["blocks_reserved"], 3)
+        self.assertEqual(stats["ids_issued"], 25)
+        self.assertEqual(stats["ids_remaining"], 5)
+
+    def test_allocators_sharing_a_counter_never_collide(self):
+        """Check that two allocators on one counter hand out distinct IDs."""
+        other = IdAllocator(self.engine, block_size=3)
+        ids = [self.allocator.allocate() for _ in range(5)]
+        ids += [other.allocate() for _ in range(5)]
+        self.assertEqual(len(set(ids)), 10)
+
+    def test_allocate_many(self):
+        """Verify that allocate_many uses up the block, then reserves one
+        large enough for the rest."""
+        self.assertEqual(self.allocator.allocate(), 1)
+        ids = self.allocator.allocate_many(30)
+        self.assertEqual(ids, list(range(2, 11)) + list(range(11, 32)))
+        self.assertEqual(self.allocator.stats["blocks_reserved"], 2)
+
+    def test_allocate_is_thread_safe(self):
+        """Check that concurrent allocations never hand out an ID twice."""
+        ids = []
+
+        def worker():
+            for _ in range(200):
+                ids.append(self.allocator.allocate())
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(ids), list(range(1, 801)))
+
+    def test_reserve_through(self):
+        """Verify that IDs up to an imported pastie's are skipped."""
+        self.assertEqual(self.allocator.allocate(), 1)
+        self.assertEqual(self.allocator.reserve_through(5), 10)
+        self.assertEqual(self.allocator.allocate(), 6)
+        self.assertEqual(self.allocator.reserve_through(42), 42)
+        self.assertEqual(self.allocator.allocate(), 43)
+
+    def test_invalid_block_size(self):
+        """Check that a block size below 1 is rejected."""
+        with self.assertRaises(ValueError):
+            IdAllocator(self.engine, block_size=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -27,12 +27,338 @@ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import base64
+import json
+import time
 import unittest
+from unittest import mock
+
+from admission import AdmissionController
+import api
+from auth import UserDB
 from datastore import Datastore
+from storage import MemoryEngine
 
 
 class TestAPI(unittest.TestCase):
     """Tests for the API service (mocked unit tests)."""
 
     def setUp(self):
-        self.datastore = Datastore()
+        self.datastore = Datastore(engine=MemoryEngine())
+        api.db = self.datastore
+        api.user_db = UserDB.from_dict({'tester': 'secret'})
+        api.admission = AdmissionController()
+        self.client = api.api_app.test_client()
+        token = base64.b64encode(b'tester:secret').decode()
+        self.headers = {'Authorization': f'Basic {token}'}
+
+    def create_pasties(self, count):
+        """Create some pasties directly in the datastore."""
+        for i in range(count):
+            self.datastore.create_pastie({'content': f'pastie {i}'})
+
+    def test_list_pasties_is_paginated(self):
+        """Verify that the pastie list can be read a page at a time."""
+        self.create_pasties(5)
+        resp = self.client.get('/api/pasties?limit=2', headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([p['id'] for p in resp.json['pasties']], [1, 2])
+        self.assertEqual(resp.json['next_cursor'], 2)
+
+        resp = self.client.get('/api/pasties?limit=2&after_id=4',
+                               headers=self.headers)
+        self.assertEqual([p['id'] for p in resp.json['pasties']], [5])
+        self.assertIsNone(resp.json['next_cursor'])
+
+    def test_list_pasties_with_bad_cursor(self):
+        """Check that an invalid cursor or limit is rejected."""
+        resp = self.client.get('/api/pasties?after_id=abc',
+                               headers=self.headers)
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/pasties?limit=0', headers=self.headers)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_list_pasties_as_ndjson(self):
+        """Verify that the pastie list can be streamed as NDJSON."""
+        self.create_pasties(3)
+        resp = self.client.get('/api/pasties?format=ndjson&after_id=1',
+                               headers=self.headers)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(l)['id'] for l in lines], [2, 3])
+        self.assertTrue(json.loads(lines[0])['url'].endswith('/pasties/2'))
+
+    def test_list_pasties_summary_view(self):
+        """Verify that view=summary lists pasties without their content."""
+        self.create_pasties(2)
+        resp = self.client.get('/api/pasties?view=summary',
+                               headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        pastie = resp.json['pasties'][0]
+        self.assertNotIn('content', pastie)
+        self.assertTrue(pastie['url'].endswith('/pasties/1'))
+        self.assertEqual(pastie['preview'], 'pastie 0')
+        self.assertEqual(pastie['size_bytes'], 8)
+        resp = self.client.get('/api/pasties?view=bogus',
+                               headers=self.headers)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_stats(self):
+        """Verify that the statistics count pasties by their owner."""
+        self.create_pasties(1)
+        self.client.post('/api/pastie', json={'content': 'mine'},
+                         headers=self.headers)
+        resp = self.client.get('/api/stats', headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['pasties'], 2)
+        self.assertEqual(resp.json['bytes'], 12)
+        self.assertEqual(resp.json['per_user'], {'tester': 1})
+        self.assertIn('reconcile_interval', resp.json)
+
+    def test_rate_limit(self):
+        """Verify that a user over their rate limit gets a 429 error."""
+        api.admission = AdmissionController(rate=0.5, burst=2)
+        for _ in range(2):
+            resp = self.client.get('/api/stats', headers=self.headers)
+            self.assertEqual(resp.status_code, 200)
+        resp = self.client.get('/api/stats', headers=self.headers)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '2')
+
+    def test_load_shedding(self):
+        """Verify that requests over the in-flight cap get a 503 error."""
+        api.admission = AdmissionController(max_in_flight=1, retry_after=3)
+        api.admission.acquire_slot()
+        resp = self.client.get('/api/stats', headers=self.headers)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '3')
+        api.admission.release_slot()
+        resp = self.client.get('/api/stats', headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(api.admission.stats['in_flight'], 0)
+
+    def test_warm_up_failure_backs_off(self):
+        """Verify that a failed warm-up turns requests away with an HTTP
+        503 error, and isn't retried by every request."""
+        with mock.patch.object(api, '_warm_up_on_first_request', True), \
+                mock.patch.object(api, '_warmed_up_pid', None), \
+                mock.patch.object(api, '_warm_up_failed_at', None), \
+                mock.patch.object(self.datastore, 'warm_up',
+                                  side_effect=ConnectionError) as warm_up:
+            with self.assertLogs(api.api_app.logger, 'ERROR'):
+                resp = self.client.get('/api/pasties/1', headers=self.headers)
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn('Retry-After', resp.headers)
+            resp = self.client.get('/api/pasties/1', headers=self.headers)
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(warm_up.call_count, 1)
+
+    def test_get_missing_pastie(self):
+        """Check that a missing pastie gives an HTTP 404 error."""
+        resp = self.client.get('/api/pasties/42', headers=self.headers)
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json['error'], 'Not Found')
+
+    def test_content_must_be_text(self):
+        """Check that non-string content is an HTTP 400 error."""
+        for content in (123, None, ['a'], {'a': 1}):
+            resp = self.client.post('/api/pastie', json={'content': content},
+                                    headers=self.headers)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_conditional_get(self):
+        """Verify that a matching If-None-Match gives a 304 with no body."""
+        self.create_pasties(1)
+        resp = self.client.get('/api/pasties/1', headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+
+        resp = self.client.get('/api/pasties/1',
+                               headers=dict(self.headers,
+                                            **{'If-None-Match': etag}))
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        resp = self.client.get('/api/pasties/1',
+                               headers=dict(self.headers,
+                                            **{'If-None-Match': '"stale"'}))
+        self.assertEqual(resp.status_code, 200)
+
+    def test_raw_binary_upload(self):
+        """Verify that a short binary body is downloaded unchanged."""
+        data = bytes(range(256)) * 4
+        resp = self.client.post('/api/pastie', data=data,
+                                content_type='application/octet-stream',
+                                headers=self.headers)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json['pastie']['content_length'], len(data))
+        resp = self.client.get('/api/pasties/1/raw', headers=self.headers)
+        self.assertEqual(resp.data, data)
+
+    def test_raw_upload_and_download(self):
+        """Verify that a pastie can be uploaded and fetched as a raw body,
+        in chunks, with byte ranges."""
+        self.datastore._content._chunk_size = 16
+        data = b'0123456789' * 10
+        resp = self.client.post('/api/pastie', data=data,
+                                content_type='application/octet-stream',
+                                headers=self.headers)
+        self.assertEqual(resp.status_code, 201)
+        pastie = resp.json['pastie']
+        self.assertEqual(pastie['content_length'], 100)
+        self.assertTrue(pastie['raw_url'].endswith('/api/pasties/1/raw'))
+
+        resp = self.client.get('/api/pasties/1/raw', headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, data)
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+
+        resp = self.client.get('/api/pasties/1/raw',
+                               headers=dict(self.headers,
+                                            Range='bytes=15-34'))
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, data[15:35])
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 15-34/100')
+
+        resp = self.client.get('/api/pasties/1/raw',
+                               headers=dict(self.headers, Range='bytes=-5'))
+        self.assertEqual(resp.data, data[-5:])
+
+        resp = self.client.get('/api/pasties/1/raw',
+                               headers=dict(self.headers,
+                                            Range='bytes=100-'))
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */100')
+
+    def test_raw_update(self):
+        """Verify that a raw body replaces a pastie's content."""
+        self.create_pasties(1)
+        resp = self.client.put('/api/pastie/1', data='new content',
+                               content_type='text/plain',
+                               headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['pastie']['content'], 'new content')
+        resp = self.client.get('/api/pasties/1/raw', headers=self.headers)
+        self.assertEqual(resp.data, b'new content')
+
+    def test_update_pastie_deleted_elsewhere(self):
+        """Verify that updating a cached pastie which another worker has
+        deleted is a 404 error."""
+        self.create_pasties(1)
+        self.assertEqual(self.datastore.get_pastie(1)['id'], 1)
+        self.datastore.engine.delete(1)
+        resp = self.client.put('/api/pastie/1', json={'content': 'new'},
+                               headers=self.headers)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_patch_pastie(self):
+        """Verify that a pastie can be appended to and edited by range,
+        with conflicting edits refused."""
+        self.create_pasties(1)
+        updated_at = self.datastore.get_pastie(1)['updated_at']
+        resp = self.client.patch(
+            '/api/pastie/1', headers=self.headers,
+            json={'updated_at': updated_at, 'operations': [
+                {'op': 'append', 'content': ' more'},
+                {'op': 'replace', 'start': 0, 'end': 6, 'content': 'P'}]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['pastie']['content'], 'P 0 more')
+
+        resp = self.client.patch(
+            '/api/pastie/1', headers=self.headers,
+            json={'updated_at': updated_at, 'operations': [
+                {'op': 'append', 'content': 'x'}]})
+        self.assertEqual(resp.status_code, 409)
+        resp = self.client.patch(
+            '/api/pastie/1', headers=self.headers,
+            json={'operations': [{'op': 'replace', 'start': 0, 'end': 99,
+                                  'content': 'x'}]})
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.patch(
+            '/api/pastie/2', headers=self.headers,
+            json={'operations': [{'op': 'append', 'content': 'x'}]})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_search(self):
+        """Verify that pasties can be searched, a page at a time."""
+        for content in ('error: disk full', 'all fine', 'error again'):
+            self.datastore.create_pastie({'content': content})
+        resp = self.client.get('/api/pasties/search?q=error&limit=1',
+                               headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['total'], 2)
+        self.assertEqual(resp.json['next_offset'], 1)
+        self.assertEqual(len(resp.json['pasties']), 1)
+        resp = self.client.get('/api/pasties/search', headers=self.headers)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_expiring_pastie(self):
+        """Verify that a pastie can be given an expiry time, and that an
+        expired pastie is not found."""
+        resp = self.client.post('/api/pastie', headers=self.headers,
+                                json={'content': 'x', 'expires_in': 60})
+        self.assertEqual(resp.status_code, 201)
+        self.assertGreater(resp.json['pastie']['expires_at'], time.time())
+        resp = self.client.post('/api/pastie', headers=self.headers,
+                                json={'content': 'x', 'expires_at': 1})
+        self.assertEqual(resp.status_code, 400)
+        for expiry in ({'expires_in': 'nan'}, {'expires_in': 'inf'},
+                       {'expires_at': '1e309'}):
+            resp = self.client.post('/api/pastie', headers=self.headers,
+                                    json=dict(expiry, content='x'))
+            self.assertEqual(resp.status_code, 400)
+
+        self.datastore.create_pastie({'content': 'old',
+                                      'expires_at': time.time() - 1})
+        resp = self.client.get('/api/pasties/2', headers=self.headers)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_batch_create(self):
+        """Verify that a batch of pasties can be created, with per-item
+        results for the items which fail."""
+        resp = self.client.post('/api/pasties/batch',
+                                json=[{'content': 'one'}, {'bad': 1},
+                                      {'content': 'two'}, {'content': 3}],
+                                headers=self.headers)
+        self.assertEqual(resp.status_code, 207)
+        statuses = [r['status'] for r in resp.json['results']]
+        self.assertEqual(statuses, [201, 400, 201, 400])
+        self.assertEqual(resp.json['results'][2]['pastie']['id'], 2)
+        self.assertEqual(self.datastore.get_pasties_count(), 2)
+
+    def test_batch_create_too_large(self):
+        """Check that batches over the configured size are rejected."""
+        api.db.config['api']['max_batch_create'] = 2
+        resp = self.client.post('/api/pasties/batch',
+                                json=[{'content': 'x'}] * 3,
+                                headers=self.headers)
+        self.assertEqual(resp.status_code, 413)
+
+    def test_batch_fetch(self):
+        """Verify that pasties can be fetched by a list of IDs."""
+        self.create_pasties(3)
+        resp = self.client.get('/api/pasties?ids=3,1,9',
+                               headers=self.headers)
+        self.assertEqual([p['id'] for p in resp.json['pasties']], [3, 1])
+        self.assertEqual(resp.json['missing'], [9])
+        resp = self.client.get('/api/pasties?ids=1,x', headers=self.headers)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bad_token_is_unauthorized(self):
+        """Check that a wrong token gives an HTTP 401 error."""
+        token = base64.b64encode(b'tester:wrong').decode()
+        resp = self.client.get('/api/pasties',
+                               headers={'Authorization': f'Basic {token}'})
+        self.assertEqual(resp.status_code, 401)
+
+    def test_metrics(self):
+        """Verify that request metrics are served in Prometheus format."""
+        self.create_pasties(1)
+        self.client.get('/api/pasties/1', headers=self.headers)
+        resp = self.client.get('/api/metrics', headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        text = resp.get_data(as_text=True)
+        self.assertIn('tammypaste_http_requests_total{route='
+                      '"/api/pasties/<int:pastie_id>",method="GET",'
+                      'status="200"}', text)
+        self.assertIn('tammypaste_pastie_cache{stat="hits"}', text)
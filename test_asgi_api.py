@@ -0,0 +1,236 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_asgi_api.py
+Description : Unit tests for the ASGI API server and async datastore.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import asyncio
+import base64
+import json
+import threading
+import unittest
+
+from admission import AdmissionController
+from asgi_api import PastieASGIApp
+from async_datastore import AsyncDatastore
+from auth import UserDB
+from datastore import Datastore
+from storage import MemoryEngine, SQLiteEngine
+
+AUTH = "Basic " + base64.b64encode(b"tester:secret").decode()
+
+
+async def call_app(app, method, path, body=None, headers=None):
+    """Send one request to an ASGI app, returning (status, headers, body)."""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http", "method": method, "path": path,
+        "query_string": query.encode(), "scheme": "http",
+        "server": ("testserver", 80),
+        "headers": [(name.lower().encode(), value.encode())
+                    for name, value in (headers or {}).items()],
+    }
+    payload = json.dumps(body).encode() if body is not None else b""
+    messages = [{"type": "http.request", "body": payload}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    start = sent[0]
+    resp_headers = {name.decode(): value.decode()
+                    for name, value in start["headers"]}
+    resp_body = b"".join(m.get("body", b"") for m in sent[1:])
+    return start["status"], resp_headers, resp_body
+
+
+class TestASGIApp(unittest.TestCase):
+    """Tests for the ASGI API server."""
+
+    def setUp(self):
+        self.datastore = Datastore(engine=MemoryEngine())
+        self.user_db = UserDB.from_dict({"tester": "secret"})
+        self.app = PastieASGIApp(datastore=self.datastore,
+                                 user_db=self.user_db)
+        self.addCleanup(self.app.shutdown)
+
+    def request(self, method, path, body=None, headers=None):
+        """Send an authenticated request to the app."""
+        headers = dict({"Authorization": AUTH}, **(headers or {}))
+        return asyncio.run(call_app(self.app, method, path, body, headers))
+
+    def test_create_and_get_pastie(self):
+        """Verify that a pastie can be created and fetched."""
+        status, _, body = self.request("POST", "/api/pastie",
+                                       {"content": "hello"})
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(body)["pastie"]["url"],
+                         "http://testserver:80/api/pasties/1")
+
+        status, headers, body = self.request("GET", "/api/pasties/1")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["pastie"]["content"], "hello")
+        status, _, body = self.request(
+            "GET", "/api/pasties/1",
+            headers={"If-None-Match": headers["etag"]})
+        self.assertEqual((status, body), (304, b""))
+
+    def test_stats(self):
+        """Verify that created pasties are counted against their owner."""
+        self.request("POST", "/api/pastie", {"content": "hello"})
+        status, _, body = self.request("GET", "/api/stats")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["per_user"], {"tester": 1})
+
+    def test_load_shedding(self):
+        """Verify that requests over the in-flight cap get a 503 error."""
+        admission = AdmissionController(max_in_flight=1)
+        app = PastieASGIApp(datastore=self.datastore,
+                            user_db=UserDB.from_dict({"tester": "secret"}),
+                            admission=admission)
+        self.addCleanup(app.shutdown)
+        admission.acquire_slot()
+        status, headers, _ = asyncio.run(call_app(
+            app, "GET", "/api/stats", headers={"Authorization": AUTH}))
+        self.assertEqual((status, headers["retry-after"]), (503, "1"))
+        admission.release_slot()
+        status, _, _ = asyncio.run(call_app(
+            app, "GET", "/api/stats", headers={"Authorization": AUTH}))
+        self.assertEqual(status, 200)
+
+    def test_raw_download(self):
+        """Verify that a pastie's content can be fetched raw, by range."""
+        self.request("POST", "/api/pastie", {"content": "hello, world"})
+        status, headers, body = self.request(
+            "GET", "/api/pasties/1/raw", headers={"Range": "bytes=7-"})
+        self.assertEqual((status, body), (206, b"world"))
+        self.assertEqual(headers["content-range"], "bytes 7-11/12")
+        status, headers, _ = self.request(
+            "GET", "/api/pasties/1/raw", headers={"Range": "bytes=20-"})
+        self.assertEqual(status, 416)
+        self.assertEqual(headers["content-range"], "bytes */12")
+
+    def test_unauthorized(self):
+        """Check that requests without valid credentials get a 401."""
+        status, _, _ = asyncio.run(call_app(self.app, "GET", "/api/pasties"))
+        self.assertEqual(status, 401)
+
+    def test_credentials_checked_off_the_loop(self):
+        """Verify that tokens are checked on a worker thread, not the
+        event loop's."""
+        verify = self.user_db.verify
+        threads = []
+
+        def recording_verify(username, token):
+            threads.append(threading.get_ident())
+            return verify(username, token)
+
+        self.user_db.verify = recording_verify
+        status, _, _ = self.request("GET", "/api/stats")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+
+    def test_response_size_metric(self):
+        """Verify that the sizes of response bodies are recorded, as the
+        Flask app does."""
+        _, _, body = self.request("POST", "/api/pastie", {"content": "hi"})
+        _, _, metrics = self.request("GET", "/api/metrics")
+        self.assertIn(
+            'tammypaste_http_response_bytes_sum{route="/api/pastie",'
+            f'method="POST"}} {len(body)}', metrics.decode())
+
+    def test_validation_errors(self):
+        """Check that invalid requests get the same errors as api.py."""
+        status, _, _ = self.request("POST", "/api/pastie", {"bad": 1})
+        self.assertEqual(status, 400)
+        status, _, _ = self.request("GET", "/api/pasties?limit=0")
+        self.assertEqual(status, 400)
+        status, _, _ = self.request("GET", "/api/pasties/99")
+        self.assertEqual(status, 404)
+        status, _, _ = self.request("PUT", "/api/pastie/99",
+                                    {"content": "x"})
+        self.assertEqual(status, 404)
+
+    def test_list_update_delete(self):
+        """Verify listing, streaming, updating and deleting pasties."""
+        for i in range(3):
+            self.datastore.create_pastie({"content": f"pastie {i}"})
+        status, _, body = self.request("GET", "/api/pasties?limit=2")
+        self.assertEqual(json.loads(body)["next_cursor"], 2)
+        status, headers, body = self.request(
+            "GET", "/api/pasties?format=ndjson&after_id=1")
+        self.assertEqual(headers["content-type"], "application/x-ndjson")
+        self.assertEqual([json.loads(l)["id"] for l in body.splitlines()],
+                         [2, 3])
+
+        status, _, body = self.request("PUT", "/api/pastie/2",
+                                       {"content": "changed"})
+        self.assertEqual(json.loads(body)["pastie"]["content"], "changed")
+        status, _, _ = self.request("DELETE", "/api/pastie/2")
+        self.assertEqual(status, 200)
+        status, _, _ = self.request("DELETE", "/api/pastie/2")
+        self.assertEqual(status, 404)
+
+    def test_batch(self):
+        """Verify the batch create and fetch routes."""
+        status, _, body = self.request(
+            "POST", "/api/pasties/batch", [{"content": "a"}, {}])
+        self.assertEqual(status, 207)
+        status, _, body = self.request("GET", "/api/pasties?ids=1,5")
+        self.assertEqual(json.loads(body)["missing"], [5])
+
+
+class TestAsyncDatastore(unittest.TestCase):
+    """Tests for the AsyncDatastore class on a blocking engine."""
+
+    def setUp(self):
+        engine = SQLiteEngine({"sqlite": {"path": ":memory:"}})
+        self.db = AsyncDatastore(Datastore(engine=engine), max_threads=2)
+        self.addCleanup(self.db.close)
+
+    def test_operations(self):
+        """Verify that operations run on the thread pool."""
+        async def scenario():
+            await self.db.create_pasties([{"content": str(i)}
+                                          for i in range(250)])
+            pastie = await self.db.get_pastie(7)
+            listed = [p["id"] async for p in self.db.list_pasties()]
+            count = await self.db.get_pasties_count()
+            return pastie, listed, count
+
+        pastie, listed, count = asyncio.run(scenario())
+        self.assertEqual(pastie["content"], "6")
+        self.assertEqual(listed, list(range(1, 251)))
+        self.assertEqual(count, 250)
+
+
+if __name__ == "__main__":
+    unittest.main()
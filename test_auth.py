@@ -0,0 +1,116 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_auth.py
+Description : Unit tests for the API user database.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from auth import UserDB, check_token, hash_token
+
+
+class TestTokens(unittest.TestCase):
+    """Tests for token hashing and checking."""
+
+    def test_hashed_token(self):
+        """Verify that a hashed token checks against the right token."""
+        stored = hash_token("secret", iterations=1000)
+        self.assertTrue(stored.startswith("pbkdf2_sha256$1000$"))
+        self.assertTrue(check_token("secret", stored))
+        self.assertFalse(check_token("wrong", stored))
+
+    def test_plaintext_token(self):
+        """Verify that legacy plaintext tokens still check."""
+        self.assertTrue(check_token("secret", "secret"))
+        self.assertFalse(check_token("wrong", "secret"))
+        self.assertFalse(check_token("secret", None))
+
+
+class TestUserDB(unittest.TestCase):
+    """Tests for the UserDB class."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.filename = os.path.join(tmp_dir.name, "users.yaml")
+        self.write_users(tester=hash_token("secret", iterations=1000))
+        self.user_db = UserDB(self.filename)
+
+    def write_users(self, **users):
+        """Write a users file, making sure its mtime changes."""
+        with open(self.filename, "w") as user_file:
+            for username, token in users.items():
+                user_file.write(f"{username}: {token}\n")
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 10 ** 9))
+
+    def test_verify(self):
+        """Verify that users are checked against the file."""
+        self.assertTrue(self.user_db.verify("tester", "secret"))
+        self.assertFalse(self.user_db.verify("tester", "wrong"))
+        self.assertFalse(self.user_db.verify("nobody", "secret"))
+
+    def test_verified_credentials_are_cached(self):
+        """Check that a verified token isn't hashed again."""
+        self.assertTrue(self.user_db.verify("tester", "secret"))
+        with mock.patch("auth.check_token") as slow_check:
+            self.assertTrue(self.user_db.verify("tester", "secret"))
+            slow_check.assert_not_called()
+
+    def test_reload_drops_cached_credentials(self):
+        """Check that a changed file is reloaded, and credentials verified
+        against the old file no longer pass."""
+        self.assertTrue(self.user_db.verify("tester", "secret"))
+        self.write_users(tester=hash_token("new-secret", iterations=1000))
+        self.assertTrue(self.user_db.check_for_changes())
+        self.assertFalse(self.user_db.verify("tester", "secret"))
+        self.assertTrue(self.user_db.verify("tester", "new-secret"))
+        self.assertFalse(self.user_db.check_for_changes())
+
+    def test_background_reload(self):
+        """Verify that the watcher thread picks up a changed file."""
+        self.user_db.start_watching(interval=0.01)
+        self.addCleanup(self.user_db.stop_watching)
+        self.write_users(other="token")
+        for _ in range(500):
+            if "other" in self.user_db.usernames:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.user_db.usernames, ["other"])
+
+    def test_missing_file(self):
+        """Check that a missing users file gives an empty database."""
+        user_db = UserDB(self.filename + ".missing")
+        self.assertEqual(user_db.usernames, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_bench.py
+Description : Unit tests for the benchmark suite.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import json
+import unittest
+
+import api
+import bench
+import schema
+
+
+class TestBench(unittest.TestCase):
+    """Tests for the benchmark suite."""
+
+    def setUp(self):
+        saved = (api.db, api.user_db, api.admission)
+        self.addCleanup(lambda: setattr(api, "db", saved[0]))
+        self.addCleanup(lambda: setattr(api, "user_db", saved[1]))
+        self.addCleanup(lambda: setattr(api, "admission", saved[2]))
+
+    def test_percentile(self):
+        """Verify the nearest-rank percentile calculation."""
+        values = list(range(1, 101))
+        self.assertEqual(bench.percentile(values, 0.5), 50)
+        self.assertEqual(bench.percentile(values, 0.99), 99)
+        self.assertIsNone(bench.percentile([], 0.5))
+
+    def test_small_run(self):
+        """Verify that a small run completes every operation cleanly."""
+        results = bench.run_benchmark(dataset_size=50, concurrency=2,
+                                      requests=20)
+        self.assertEqual(set(results["results"]), set(bench.OPERATIONS))
+        for res in results["results"].values():
+            self.assertEqual(res["requests"], 20)
+            self.assertEqual(res["errors"], 0)
+
+    def test_small_asgi_run(self):
+        """Verify that the ASGI transport runs every operation cleanly."""
+        results = bench.run_benchmark(dataset_size=50, concurrency=4,
+                                      requests=20, transport="asgi",
+                                      client_delay_ms=1)
+        for res in results["results"].values():
+            self.assertEqual(res["requests"], 20)
+            self.assertEqual(res["errors"], 0)
+
+    def test_serialization_matches_legacy(self):
+        """Verify that the fast serialization path gives the same pasties
+        as the old one, with and without orjson."""
+        pastie = {"_id": "abc", "id": 7, "content": "caf\u00e9",
+                  "created_at": "2020-04-15 12:00:00"}
+        with api.api_app.test_request_context("/api/pasties"):
+            legacy = bench.legacy_public_pastie(pastie)
+            self.assertEqual(api.make_public_pastie(pastie), legacy)
+        self.assertEqual(json.loads(schema.dump_json(legacy)), legacy)
+        saved = schema.orjson
+        self.addCleanup(lambda: setattr(schema, "orjson", saved))
+        schema.orjson = None
+        self.assertEqual(json.loads(schema.dump_json(legacy)), legacy)
+
+    def test_serialization_benchmark(self):
+        """Verify that the serialization benchmark reports each size."""
+        results = bench.run_serialization_benchmark(sizes=(10, 100),
+                                                    repeat=1)
+        self.assertEqual(set(results["results"]), {10, 100})
+        self.assertGreater(results["results"][100]["speedup"], 0)
+
+    def test_cold_start(self):
+        """Verify that importing the API doesn't create the datastore, and
+        that a fresh worker serves its first request."""
+        results = bench.measure_cold_start(runs=1)
+        self.assertFalse(results["connected_at_import"])
+        self.assertEqual(results["errors"], 0)
+        self.assertGreater(results["cold_start_seconds"], 0)
+
+    def test_compare(self):
+        """Check that slower results are reported as regressions."""
+        baseline = {"results": {"get": {"throughput": 1000, "p50_ms": 1,
+                                        "p99_ms": 10, "errors": 0}}}
+        same = {"results": {"get": {"throughput": 950, "p50_ms": 1.1,
+                                    "p99_ms": 30, "errors": 0}}}
+        slower = {"results": {"get": {"throughput": 400, "p50_ms": 3,
+                                      "p99_ms": 30, "errors": 0}}}
+        self.assertEqual(bench.compare(same, baseline), [])
+        self.assertEqual(len(bench.compare(slower, baseline)), 2)
+
+    def test_median_results(self):
+        """Check that repeated runs are combined by their medians."""
+        runs = [{"config": {"requests": 10}, "load_seconds": seconds,
+                 "results": {"get": {"throughput": throughput,
+                                     "p50_ms": 1, "errors": 0}}}
+                for seconds, throughput in ((1, 900), (3, 100), (2, 1000))]
+        combined = bench.median_results(runs)
+        self.assertEqual(combined["config"], {"requests": 10, "runs": 3})
+        self.assertEqual(combined["load_seconds"], 2)
+        self.assertEqual(combined["results"]["get"]["throughput"], 900)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_cache.py
+Description : Unit tests for the pastie cache.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import unittest
+from unittest import mock
+
+from cache import PastieCache, estimate_size
+
+
+class TestPastieCache(unittest.TestCase):
+    """Tests for the PastieCache class."""
+
+    def setUp(self):
+        self.cache = PastieCache(max_bytes=10000, ttl=60, negative_ttl=5)
+
+    def test_get_and_put(self):
+        """Verify that cached pasties are returned and counted as hits."""
+        self.assertEqual(self.cache.get(1), (False, None))
+        self.cache.put(1, {"id": 1, "content": "hello"})
+        self.assertEqual(self.cache.get(1), (True, {"id": 1,
+                                                    "content": "hello"}))
+        stats = self.cache.stats
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_negative_entries(self):
+        """Verify that missing pasties are cached as negative entries."""
+        self.cache.put(1, None)
+        self.assertEqual(self.cache.get(1), (True, None))
+        self.assertEqual(self.cache.stats["negative_hits"], 1)
+
+    def test_entries_expire(self):
+        """Check that entries expire after their TTL."""
+        self.cache.put(1, None)
+        with mock.patch("cache.time.monotonic", return_value=1e12):
+            self.assertEqual(self.cache.get(1), (False, None))
+        self.assertEqual(self.cache.stats["expirations"], 1)
+
+    def test_lru_eviction(self):
+        """Check that the least recently used entry is evicted first once
+        the byte budget is used up."""
+        doc = {"id": 0, "content": "x" * 2000}
+        cache = PastieCache(max_bytes=3 * estimate_size(doc))
+        for pastie_id in (1, 2, 3):
+            cache.put(pastie_id, dict(doc, id=pastie_id))
+        cache.get(1)
+        cache.put(4, dict(doc, id=4))
+        self.assertEqual(cache.get(2), (False, None))
+        self.assertTrue(cache.get(1)[0])
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertLessEqual(cache.stats["bytes"], cache.stats["max_bytes"])
+
+    def test_invalidate(self):
+        """Verify that invalidate drops an entry."""
+        self.cache.put(1, {"id": 1})
+        self.cache.invalidate(1)
+        self.assertEqual(self.cache.get(1), (False, None))
+
+    def test_stale_put_is_ignored(self):
+        """Check that a pastie read before an invalidation isn't cached."""
+        generation = self.cache.generation
+        self.cache.invalidate(1)
+        self.cache.put(1, {"id": 1}, generation)
+        self.assertEqual(self.cache.get(1), (False, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_content.py
+Description : Unit tests for the pastie body content store.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import copy
+import hashlib
+import io
+import unittest
+
+from content import ContentStore
+from storage import MemoryEngine, apply_update
+
+BIG_CONTENT = "Traceback (most recent call last):\n" * 200
+
+
+class TestContentStore(unittest.TestCase):
+    """Tests for the ContentStore class."""
+
+    def setUp(self):
+        self.engine = MemoryEngine()
+        self.store = ContentStore(self.engine, threshold=1024, codec="zlib")
+
+    def test_small_bodies_stay_inline(self):
+        """Verify that bodies under the threshold aren't moved."""
+        pastie = {"id": 1, "content": "short"}
+        self.assertIs(self.store.pack(pastie), pastie)
+
+    def test_large_bodies_are_compressed_and_shared(self):
+        """Verify that a large body is stored compressed, once."""
+        first = self.store.pack({"id": 1, "content": BIG_CONTENT})
+        second = self.store.pack({"id": 2, "content": BIG_CONTENT})
+        digest = hashlib.sha256(BIG_CONTENT.encode()).hexdigest()
+        self.assertNotIn("content", first)
+        self.assertEqual(first["content_ref"], digest)
+        self.assertEqual(second["content_ref"], digest)
+
+        body = self.engine.get_body(digest)
+        self.assertEqual(body["refcount"], 2)
+        self.assertLess(len(body["data"]), len(BIG_CONTENT) // 10)
+        self.assertEqual(self.store.unpack(first)["content"], BIG_CONTENT)
+
+    def test_release(self):
+        """Check that a body is deleted with its last reference."""
+        first = self.store.pack({"id": 1, "content": BIG_CONTENT})
+        second = self.store.pack({"id": 2, "content": BIG_CONTENT})
+        self.store.release(first)
+        self.assertEqual(self.store.unpack(second)["content"], BIG_CONTENT)
+        self.store.release(second)
+        self.assertIsNone(self.engine.get_body(first["content_ref"]))
+
+    def test_no_threshold_keeps_bodies_inline(self):
+        """Verify that a store with no threshold never moves bodies."""
+        store = ContentStore(self.engine, threshold=None)
+        pastie = {"id": 1, "content": BIG_CONTENT}
+        self.assertIs(store.pack(pastie), pastie)
+
+    def test_short_stream_is_inline(self):
+        """Verify that a stream shorter than a chunk becomes content."""
+        store = ContentStore(self.engine, chunk_size=64)
+        body = store.write_stream(io.BytesIO(b"hello"))
+        self.assertEqual(body, {"content": "hello"})
+
+    def test_short_binary_stream_is_kept(self):
+        """Verify that a short stream which isn't UTF-8 is stored byte for
+        byte."""
+        store = ContentStore(self.engine, chunk_size=64)
+        data = bytes(range(40)) + b"\xff\xfe"
+        body = store.write_stream(io.BytesIO(data))
+        self.assertEqual(body["content_file"]["length"], len(data))
+        self.assertEqual(b"".join(store.iter_content(body)), data)
+
+    def test_stream_is_chunked(self):
+        """Verify that a long stream is stored in chunks, and that any
+        byte range of it can be read back."""
+        store = ContentStore(self.engine, chunk_size=64)
+        data = BIG_CONTENT.encode()
+        body = store.write_stream(io.BytesIO(data))
+        info = body["content_file"]
+        self.assertEqual(info["length"], len(data))
+        self.assertEqual(len(info["chunks"]), len(data) // 64)
+        self.assertIsNotNone(info["tail"])
+        self.assertEqual(store.content_length(body), len(data))
+
+        self.assertEqual(b"".join(store.iter_content(body)), data)
+        for start, end in ((0, 0), (10, 200), (63, 64), (100, None)):
+            stop = None if end is None else end + 1
+            self.assertEqual(b"".join(store.iter_content(body, start, end)),
+                             data[start:stop])
+
+        store.release(body)
+        self.assertEqual(self.engine._chunks, {})
+
+    def patched(self, store, pastie, operations):
+        """Apply a patch to a pastie as the datastore would, returning the
+        patched pastie and its content."""
+        update, _, replaced = store.patch(pastie, operations)
+        pastie = apply_update(copy.deepcopy(pastie), update)
+        store.release(replaced)
+        return pastie, b"".join(store.iter_content(store.unpack(pastie)))
+
+    def test_patch_chunked_body(self):
+        """Verify that edits to a chunked body only rewrite the chunks they
+        touch, and that appends push new chunks."""
+        store = ContentStore(self.engine, chunk_size=64)
+        data = BIG_CONTENT.encode()
+        pastie = store.write_stream(io.BytesIO(data))
+        chunks = list(pastie["content_file"]["chunks"])
+
+        update, written, _ = store.patch(pastie, [(None, None, b"x" * 100)])
+        self.assertEqual(set(update), {"$set", "$push"})
+        store.release(written)
+        pastie, content = self.patched(store, pastie,
+                                       [(None, None, b"x" * 100)])
+        data += b"x" * 100
+        self.assertEqual(content, data)
+        self.assertEqual(pastie["content_file"]["chunks"][:len(chunks)],
+                         chunks)
+
+        pastie, content = self.patched(store, pastie, [(70, 75, b"HELLO")])
+        data = data[:70] + b"HELLO" + data[75:]
+        self.assertEqual(content, data)
+        changed = [a != b for a, b in zip(chunks,
+                                          pastie["content_file"]["chunks"])]
+        self.assertEqual(changed.count(True), 1)
+
+        pastie, content = self.patched(store, pastie, [(10, 20, b"")])
+        data = data[:10] + data[20:]
+        self.assertEqual(content, data)
+        self.assertEqual(pastie["content_file"]["length"], len(data))
+
+        with self.assertRaises(ValueError):
+            store.patch(pastie, [(0, len(data) + 1, b"")])
+        store.release(pastie)
+        self.assertEqual(self.engine._chunks, {})
+
+    def test_summaries(self):
+        """Verify that size, line count and preview are kept up to date as
+        a chunked body is written and edited."""
+        store = ContentStore(self.engine, chunk_size=64)
+        data = BIG_CONTENT.encode()
+        pastie = store.write_stream(io.BytesIO(data))
+        self.assertEqual(pastie["size_bytes"], len(data))
+        self.assertEqual(pastie["line_count"], 200)
+        self.assertEqual(pastie["preview"], BIG_CONTENT[:200])
+        self.assertEqual(store.summarize(pastie)["line_count"], 200)
+
+        for operations in ([(None, None, b"partial")],
+                           [(None, None, b" line\nand more\n")],
+                           [(0, 36, b"")],
+                           [(100, 300, b"x\ny\n")]):
+            pastie, content = self.patched(store, pastie, operations)
+            expected = store.summarize({"content": content.decode()})
+            self.assertEqual(store.summarize(pastie), expected)
+
+    def test_patch_inline_body(self):
+        """Verify that edits to an inline body are applied, and that the
+        body moves to chunks once it is big enough."""
+        store = ContentStore(self.engine, threshold=None, chunk_size=64)
+        pastie, content = self.patched(store, {"content": "hello world"},
+                                       [(0, 5, b"HELLO"), (None, None, b"!")])
+        self.assertEqual(pastie, {"content": "HELLO world!", "size_bytes": 12,
+                                  "line_count": 1, "preview": "HELLO world!"})
+        pastie, content = self.patched(store, pastie,
+                                       [(None, None, b"." * 100)])
+        self.assertNotIn("content", pastie)
+        self.assertEqual(content, b"HELLO world!" + b"." * 100)
+
+    def test_unknown_codec(self):
+        """Check that an unknown codec is rejected."""
+        with self.assertRaises(ValueError):
+            ContentStore(self.engine, codec="lzma")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -27,8 +27,10 @@ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import time
 import unittest
-from datastore import Datastore
+from datastore import ConflictError, Datastore
+from storage import MemoryEngine
 
 
 class TestDataStore(unittest.TestCase):
@@ -109,5 +111,141 @@ class TestDataStore(unittest.TestCase):
         pass
 
 
+class TestEmbeddedDataStore(unittest.TestCase):
+    """Tests for the Datastore class on the in-memory storage engine."""
+
+    def setUp(self):
+        self.datastore = Datastore(engine=MemoryEngine())
+
+    def test_is_connected(self):
+        """Verify that an embedded datastore is always connected."""
+        self.assertTrue(self.datastore.is_connected)
+
+    def test_can_create_pasties(self):
+        """Verify that we can create and look up a new pastie."""
+        pastie = self.datastore.create_pastie({"content": "hello"})
+        self.assertEqual(pastie["id"], 1)
+        self.assertEqual(self.datastore.get_pastie(1)["content"], "hello")
+        self.assertEqual(self.datastore.get_pasties_count(), 1)
+
+    def test_create_pastie_with_duplicate_id_throws_error(self):
+        """Check that creation enforces unique ids"""
+        self.datastore.create_pastie({"id": 7, "content": "hello"})
+        with self.assertRaises(ValueError):
+            self.datastore.create_pastie({"id": 7, "content": "again"})
+
+    def test_list_pasties_after_id(self):
+        """Verify that list_pasties can start after a given ID"""
+        for i in range(5):
+            self.datastore.create_pastie({"content": f"pastie {i}"})
+        pasties = self.datastore.list_pasties(
+            {"id": {"$lt": 5}}, max_records=2, after_id=2)
+        self.assertEqual([p["id"] for p in pasties], [3, 4])
+
+    def test_summary_fields(self):
+        """Verify that pasties are written with their size, line count and
+        preview, and can be listed with just those fields"""
+        self.datastore.create_pastie({"content": "one\ntwo\n",
+                                      "expires_at": time.time() + 60})
+        pastie = self.datastore.update_pastie(1, {"content": "one\ntwo"})
+        self.assertEqual(pastie["size_bytes"], 7)
+        self.assertEqual(pastie["line_count"], 2)
+        self.assertIn("expires_at", pastie)
+        self.datastore.patch_pastie(1, [(None, None, b"\nthree")])
+        listed = list(self.datastore.list_pasties(
+            fields=["id", "size_bytes", "line_count", "preview"]))
+        self.assertEqual(listed, [{"id": 1, "size_bytes": 13,
+                                   "line_count": 3,
+                                   "preview": "one\ntwo\nthree"}])
+
+    def test_cached_pastie_is_invalidated_on_delete(self):
+        """Verify that deleting a pastie drops it from the cache"""
+        self.datastore.create_pastie({"content": "hello"})
+        self.assertIsNotNone(self.datastore.get_pastie(1))
+        self.assertIsNotNone(self.datastore.get_pastie(1))
+        self.assertEqual(self.datastore.cache.stats["hits"], 1)
+        self.datastore.delete_pastie(1)
+        self.assertIsNone(self.datastore.get_pastie(1))
+
+    def test_create_replaces_negative_cache_entry(self):
+        """Verify that creating a pastie clears a cached miss for its ID"""
+        self.assertIsNone(self.datastore.get_pastie(1))
+        self.datastore.create_pastie({"content": "hello"})
+        self.assertIsNotNone(self.datastore.get_pastie(1))
+
+    def test_create_pasties_reports_failures_per_item(self):
+        """Verify that a failed item doesn't stop a batch create"""
+        self.datastore.create_pastie({"id": 99, "content": "taken"})
+        results = self.datastore.create_pasties([
+            {"content": "one"}, {"id": 99, "content": "dup"},
+            {"content": "three"}])
+        self.assertEqual([r[0]["id"] for r in results if r[0]], [1, 2])
+        self.assertIsInstance(results[1][1], ValueError)
+
+    def test_get_pasties(self):
+        """Verify that several pasties can be fetched at once"""
+        for i in range(3):
+            self.datastore.create_pastie({"content": f"pastie {i}"})
+        found = self.datastore.get_pasties([1, 3, 5])
+        self.assertEqual(sorted(found), [1, 3])
+
+    def test_large_bodies_are_stored_once(self):
+        """Verify that identical large bodies share one stored copy"""
+        content = "same log line\n" * 1000
+        self.datastore.create_pastie({"content": content})
+        self.datastore.create_pastie({"content": content})
+        self.assertEqual(self.datastore.get_pastie(2)["content"], content)
+        digest = self.datastore.engine.get(1)["content_ref"]
+        self.assertEqual(self.datastore.engine.get(2)["content_ref"], digest)
+        self.assertEqual(self.datastore.engine.get_body(digest)["refcount"],
+                         2)
+        self.datastore.delete_pastie(1)
+        self.datastore.delete_pastie(2)
+        self.assertIsNone(self.datastore.engine.get_body(digest))
+
+    def test_update_pastie(self):
+        """Verify that we can update a pastie"""
+        created = self.datastore.create_pastie({"content": "hello"})
+        self.assertEqual(self.datastore.get_pastie(1)["content"], "hello")
+        updated = self.datastore.update_pastie(1, {"content": "goodbye"})
+        self.assertEqual(updated["id"], 1)
+        self.assertEqual(updated["created_at"], created["created_at"])
+        self.assertEqual(self.datastore.get_pastie(1)["content"], "goodbye")
+        with self.assertRaises(KeyError):
+            self.datastore.update_pastie(2, {"content": "nothing"})
+
+    def test_patch_pastie(self):
+        """Verify that a pastie can be edited in place, and that an edit
+        based on an old version is refused"""
+        created = self.datastore.create_pastie({"content": "line 1\n"})
+        patched = self.datastore.patch_pastie(1, [(None, None, b"line 2\n")],
+                                              created["updated_at"])
+        self.assertEqual(patched["content"], "line 1\nline 2\n")
+        self.assertEqual(self.datastore.get_pastie(1)["content"],
+                         "line 1\nline 2\n")
+        with self.assertRaises(ConflictError):
+            self.datastore.patch_pastie(1, [(0, 1, b"L")],
+                                        created["updated_at"])
+        with self.assertRaises(ValueError):
+            self.datastore.patch_pastie(1, [(0, 100, b"")])
+        with self.assertRaises(KeyError):
+            self.datastore.patch_pastie(2, [(None, None, b"x")])
+
+    def test_expired_pasties_are_hidden(self):
+        """Verify that an expired pastie is gone before it is reaped"""
+        self.datastore.create_pastie({"content": "old",
+                                      "expires_at": time.time() - 1})
+        self.datastore.create_pastie({"content": "new"})
+        self.assertIsNone(self.datastore.get_pastie(1))
+        self.assertEqual(sorted(self.datastore.get_pasties([1, 2])), [2])
+        self.assertEqual([p["id"] for p in self.datastore.list_pasties()],
+                         [2])
+        with self.assertRaises(KeyError):
+            self.datastore.update_pastie(1, {"content": "again"})
+        self.assertEqual(self.datastore.count_expired(10), 1)
+        self.assertEqual(self.datastore.reap_expired(10), 1)
+        self.assertIsNone(self.datastore.engine.get(1))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,138 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_metrics.py
+Description : Unit tests for the metrics module.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import threading
+import unittest
+
+from datastore import Datastore
+from metrics import MetricsRegistry, TimedProxy
+from storage import MemoryEngine
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the metric types and their rendering."""
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter_merges_threads(self):
+        """Verify that counts recorded on several threads are merged."""
+        counter = self.registry.counter("test_total", "Test", ("kind",))
+
+        def worker():
+            for _ in range(1000):
+                counter.inc("a")
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value("a"), 4000)
+        self.assertIn('test_total{kind="a"} 4000', self.registry.render())
+
+    def test_exited_threads_are_folded(self):
+        """Verify that the shards of threads which have exited are merged
+        into one total rather than kept."""
+        histogram = self.registry.histogram("test_seconds", "Test")
+        for _ in range(200):
+            thread = threading.Thread(target=histogram.observe, args=(0.1,))
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(histogram._shards), 1)
+        self.assertEqual(histogram.count(), 200)
+        histogram.observe(0.1)
+        self.assertEqual(histogram.count(), 201)
+
+    def test_histogram_rendering(self):
+        """Verify the Prometheus rendering of a histogram."""
+        histogram = self.registry.histogram("test_seconds", "Test",
+                                            ("op",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "get")
+        histogram.observe(0.5, "get")
+        histogram.observe(5, "get")
+        lines = self.registry.render().splitlines()
+        self.assertIn("# TYPE test_seconds histogram", lines)
+        self.assertIn('test_seconds_bucket{op="get",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{op="get",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{op="get",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{op="get"} 3', lines)
+
+    def test_gauge(self):
+        """Verify that gauges are read from their callback."""
+        self.registry.gauge("test_gauge", "Test", ("stat",),
+                            lambda: {("hits",): 7})
+        self.assertIn('test_gauge{stat="hits"} 7', self.registry.render())
+
+
+class TestTimedProxy(unittest.TestCase):
+    """Tests for the TimedProxy class."""
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.datastore = TimedProxy(Datastore(engine=MemoryEngine()),
+                                    self.registry)
+
+    def test_calls_are_timed(self):
+        """Verify that method calls are counted and timed."""
+        self.datastore.create_pastie({"content": "hello"})
+        self.datastore.get_pastie(1)
+        self.datastore.get_pastie(2)
+        calls = self.registry.get("tammypaste_datastore_calls_total")
+        self.assertEqual(calls.value("get_pastie", "ok"), 2)
+        latency = self.registry.get("tammypaste_datastore_operation_seconds")
+        self.assertEqual(latency.count("create_pastie"), 1)
+
+    def test_iterators_are_counted(self):
+        """Verify that documents returned by an iterator are counted."""
+        for _ in range(3):
+            self.datastore.create_pastie({"content": "hello"})
+        self.assertEqual(len(list(self.datastore.list_pasties())), 3)
+        documents = self.registry.get(
+            "tammypaste_datastore_documents_returned")
+        self.assertIn('tammypaste_datastore_documents_returned_sum'
+                      '{operation="list_pasties"} 3', self.registry.render())
+        self.assertEqual(documents.count("list_pasties"), 1)
+
+    def test_errors_are_counted(self):
+        """Check that calls raising an exception are counted as errors."""
+        self.datastore.create_pastie({"id": 1, "content": "hello"})
+        with self.assertRaises(ValueError):
+            self.datastore.create_pastie({"id": 1, "content": "again"})
+        calls = self.registry.get("tammypaste_datastore_calls_total")
+        self.assertEqual(calls.value("create_pastie", "error"), 1)
+
+    def test_properties_pass_through(self):
+        """Verify that non-method attributes are passed through."""
+        self.assertTrue(self.datastore.is_connected)
+        self.assertIsNotNone(self.datastore.cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
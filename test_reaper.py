@@ -0,0 +1,96 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_reaper.py
+Description : Unit tests for the expired pastie reaper.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import time
+import unittest
+from unittest import mock
+
+from datastore import Datastore
+from reaper import Reaper
+from storage import MemoryEngine
+
+
+class TestReaper(unittest.TestCase):
+    """Tests for the Reaper class."""
+
+    def setUp(self):
+        self.datastore = Datastore(engine=MemoryEngine())
+        past = time.time() - 60
+        for i in range(7):
+            self.datastore.create_pastie({"content": f"old {i}",
+                                          "expires_at": past + i})
+        self.datastore.create_pastie({"content": "live",
+                                      "expires_at": time.time() + 3600})
+        self.datastore.create_pastie({"content": "forever"})
+
+    def test_run_once_reaps_in_batches(self):
+        """Verify that a pass deletes expired pasties a batch at a time,
+        stopping after max_batches and reporting the backlog."""
+        reaper = Reaper(self.datastore, batch_size=2, max_batches=2,
+                        batch_pause=0)
+        self.assertEqual(reaper.run_once(), 4)
+        self.assertEqual(reaper.stats["backlog"], 3)
+        self.assertEqual(self.datastore.get_pasties_count(), 5)
+
+        self.assertEqual(reaper.run_once(), 3)
+        self.assertEqual(reaper.stats["backlog"], 0)
+        self.assertEqual(reaper.stats["reaped"], 7)
+        self.assertEqual(reaper.stats["passes"], 2)
+        self.assertEqual(sorted(p["content"] for p in
+                                self.datastore.list_pasties()),
+                         ["forever", "live"])
+
+    def test_start_and_stop(self):
+        """Verify that the background thread reaps and stops cleanly."""
+        reaper = Reaper(self.datastore, batch_size=100)
+        reaper.start(interval=0.01)
+        deadline = time.time() + 5
+        while reaper.stats["reaped"] < 7 and time.time() < deadline:
+            time.sleep(0.01)
+        reaper.stop()
+        self.assertEqual(reaper.stats["reaped"], 7)
+
+    def test_failures_are_logged(self):
+        """Verify that a pass which fails is logged, and the thread keeps
+        going."""
+        reaper = Reaper(self.datastore)
+        with mock.patch.object(reaper, "run_once",
+                               side_effect=RuntimeError("database down")):
+            with self.assertLogs("reaper", "ERROR") as logs:
+                reaper.start(interval=0.01)
+                deadline = time.time() + 5
+                while len(logs.records) < 2 and time.time() < deadline:
+                    time.sleep(0.01)
+                reaper.stop()
+        self.assertGreaterEqual(len(logs.records), 2)
+        self.assertIn("database down", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_search.py
+Description : Unit tests for the full-text search index.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import unittest
+
+from datastore import Datastore
+from search import SearchIndex, make_postings, tokenize, trigrams
+from storage import MemoryEngine
+
+
+class TestTokenizer(unittest.TestCase):
+    """Tests for the search tokenizer."""
+
+    def test_tokenize(self):
+        """Verify that text is split into lower-case words."""
+        self.assertEqual(tokenize("Hello, World! x" + "y" * 80),
+                         ["hello", "world"])
+
+    def test_postings(self):
+        """Verify that words and their trigrams are counted."""
+        self.assertEqual(trigrams("abcd"), ["abc", "bcd"])
+        self.assertEqual(make_postings("ab abc ab"),
+                         {"w:ab": 2, "w:abc": 1, "g:abc": 1})
+
+
+class TestSearchIndex(unittest.TestCase):
+    """Tests for the SearchIndex class."""
+
+    def setUp(self):
+        self.engine = MemoryEngine()
+        self.index = SearchIndex(self.engine)
+        texts = ["connection refused by upstream server",
+                 "connection reset; connection refused again",
+                 "all good here"]
+        for pastie_id, text in enumerate(texts, 1):
+            self.engine.insert({"id": pastie_id, "content": text})
+            self.index.index(pastie_id, text)
+
+    def test_search_ranks_matches(self):
+        """Verify that every word must match, best matches first."""
+        results, total = self.index.search("Connection REFUSED", 10)
+        self.assertEqual(total, 2)
+        self.assertEqual([pastie_id for pastie_id, _ in results], [2, 1])
+        self.assertEqual(self.index.search("connection good", 10), ([], 0))
+
+    def test_search_matches_substrings(self):
+        """Verify that part of a word matches, with a lower score."""
+        results, _ = self.index.search("upstrea", 10)
+        self.assertEqual([pastie_id for pastie_id, _ in results], [1])
+        exact, _ = self.index.search("upstream", 10)
+        self.assertGreater(exact[0][1], results[0][1])
+
+    def test_search_is_paginated(self):
+        """Verify that results can be read a page at a time."""
+        results, total = self.index.search("connection", 1, offset=1)
+        self.assertEqual((results[0][0], total), (1, 2))
+
+    def test_count_pasties(self):
+        """Verify that the pastie count can come from elsewhere than the
+        engine."""
+        self.engine.count = None
+        index = SearchIndex(self.engine, count_pasties=lambda: 3)
+        results, _ = index.search("connection refused", 10)
+        self.assertEqual([pastie_id for pastie_id, _ in results], [2, 1])
+
+    def test_reindex_and_remove(self):
+        """Verify that re-indexing replaces a pastie's postings."""
+        self.index.index(3, "connection refused")
+        self.assertEqual(self.index.search("refused", 10)[1], 3)
+        self.assertEqual(self.index.search("good", 10), ([], 0))
+        self.index.remove(3)
+        self.assertEqual(self.index.search("refused", 10)[1], 2)
+        self.assertEqual(self.engine.get_postings(3), {})
+
+
+class TestSearchThroughDatastore(unittest.TestCase):
+    """Tests for searching through the Datastore."""
+
+    def setUp(self):
+        self.datastore = Datastore(engine=MemoryEngine())
+
+    def test_index_follows_writes(self):
+        """Verify that creates, updates, edits and deletes keep the index
+        up to date."""
+        self.datastore.create_pastie({"content": "disk full"})
+        self.datastore.create_pasties([{"content": "disk ok"}])
+        pasties, total = self.datastore.search_pasties("disk", 10)
+        self.assertEqual(total, 2)
+        self.assertIn("score", pasties[0])
+
+        self.datastore.update_pastie(1, {"content": "memory full"})
+        self.assertEqual(self.datastore.search_pasties("disk", 10)[1], 1)
+        self.datastore.patch_pastie(2, [(None, None, b" memory")])
+        self.assertEqual(self.datastore.search_pasties("memory", 10)[1], 2)
+        self.datastore.delete_pastie(1)
+        self.assertEqual(self.datastore.search_pasties("memory", 10)[1], 1)
+
+    def test_rebuild(self):
+        """Verify that the index can be rebuilt from the pasties."""
+        self.datastore.create_pastie({"content": "kernel panic"})
+        self.datastore.search_index.clear()
+        self.assertEqual(self.datastore.search_pasties("panic", 10)[1], 0)
+        self.assertEqual(self.datastore.rebuild_search_index(), 1)
+        self.assertEqual(self.datastore.search_pasties("panic", 10)[1], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
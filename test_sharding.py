@@ -0,0 +1,150 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_sharding.py
+Description : Unit tests for the sharded storage engine
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import unittest
+
+from datastore import Datastore
+from sharding import HashRing, ShardedEngine
+from storage import MemoryEngine, SQLiteEngine
+from test_storage import EngineTests
+
+
+def make_shards(*names):
+    """Make a dictionary of in-memory engines by shard name."""
+    return {name: MemoryEngine() for name in names}
+
+
+class TestHashRing(unittest.TestCase):
+    """Tests for the HashRing class."""
+
+    def test_spreads_keys(self):
+        """Verify that keys are spread over every node."""
+        ring = HashRing(["a", "b", "c"])
+        owners = collections.Counter(ring.node_for(key)
+                                     for key in range(3000))
+        self.assertEqual(set(owners), {"a", "b", "c"})
+        self.assertGreater(min(owners.values()), 600)
+
+    def test_adding_node_moves_few_keys(self):
+        """Verify that a new node only takes keys from the others."""
+        old = HashRing(["a", "b", "c"])
+        new = HashRing(["a", "b", "c", "d"])
+        moved = [key for key in range(3000)
+                 if old.node_for(key) != new.node_for(key)]
+        self.assertTrue(all(new.node_for(key) == "d" for key in moved))
+        self.assertLess(len(moved), 1200)
+
+    def test_needs_nodes(self):
+        """Verify that a ring can't be empty."""
+        with self.assertRaises(ValueError):
+            HashRing([])
+
+
+class TestShardedEngine(EngineTests, unittest.TestCase):
+    """Tests for the sharded storage engine, over one in-memory and one
+    SQLite shard."""
+
+    def make_engine(self):
+        return ShardedEngine({"a": MemoryEngine(),
+                              "b": SQLiteEngine({"sqlite":
+                                                 {"path": ":memory:"}})})
+
+    def test_routes_to_one_shard(self):
+        """Verify that each pastie is stored on exactly its own shard."""
+        for pastie_id in range(4, 40):
+            self.engine.insert({"id": pastie_id})
+        for name, shard in self.engine.shards.items():
+            ids = [doc["id"] for doc in shard.find()]
+            self.assertTrue(ids)
+            self.assertTrue(all(self.engine.shard_for(pastie_id) == name
+                                for pastie_id in ids))
+        self.assertEqual([doc["id"] for doc in self.engine.find()],
+                         list(range(1, 40)))
+        self.assertEqual(self.engine.count(), 39)
+
+    def test_insert_many_reports_errors(self):
+        """Verify that batch insert errors keep their positions."""
+        errors = self.engine.insert_many([{"id": 10}, {"id": 2}, {"id": 11},
+                                          {"id": 3}])
+        self.assertEqual(sorted(errors), [1, 3])
+        self.assertEqual(self.engine.count(), 5)
+
+
+class TestSharding(unittest.TestCase):
+    """Tests for a Datastore over several shards, and rebalancing."""
+
+    def setUp(self):
+        self.shards = make_shards("a", "b")
+        self.datastore = Datastore(engine=ShardedEngine(self.shards))
+        for number in range(1, 41):
+            self.datastore.create_pastie({"content": f"pastie {number}"})
+
+    def test_datastore(self):
+        """Verify that the datastore works unchanged over shards."""
+        listed = self.datastore.list_pasties(max_records=5, after_id=10)
+        self.assertEqual([pastie["id"] for pastie in listed],
+                         [11, 12, 13, 14, 15])
+        self.assertEqual(self.datastore.get_pastie(7)["content"], "pastie 7")
+        self.assertEqual(self.datastore.delete_pastie(7), 1)
+        self.assertIsNone(self.datastore.get_pastie(7))
+        _, total = self.datastore.search_pasties("pastie", 100)
+        self.assertEqual(total, 39)
+
+    def test_rebalance(self):
+        """Verify that adding a shard only moves the pasties it takes over,
+        and that they can be found while rebalancing."""
+        before = {name: {doc["id"] for doc in shard.find()}
+                  for name, shard in self.shards.items()}
+        grown = ShardedEngine(dict(self.shards, c=MemoryEngine()),
+                              rebalancing=True)
+        self.assertEqual(grown.get(17)["content"], "pastie 17")
+
+        moved = grown.rebalance(batch_size=7)
+        self.assertEqual(moved["a"] + moved["b"], 0)
+        self.assertGreater(moved["c"], 0)
+        for name in ("a", "b"):
+            after = {doc["id"] for doc in grown.shards[name].find()}
+            self.assertLessEqual(after, before[name])
+            self.assertTrue(all(grown.shard_for(pastie_id) == "c"
+                                for pastie_id in before[name] - after))
+        self.assertEqual(grown.count(), 40)
+        self.assertEqual(grown.rebalance(), dict(a=0, b=0, c=0))
+
+        grown.rebalancing = False
+        datastore = Datastore(engine=grown)
+        for pastie_id in range(1, 41):
+            self.assertEqual(datastore.get_pastie(pastie_id)["content"],
+                             f"pastie {pastie_id}")
+        _, total = datastore.search_pasties("pastie", 100)
+        self.assertEqual(total, 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
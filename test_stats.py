@@ -0,0 +1,109 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_stats.py
+Description : Unit tests for the aggregate pastie statistics.
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import time
+import unittest
+from unittest import mock
+
+from datastore import Datastore
+from stats import PastieStats, StatsReconciler
+from storage import MemoryEngine
+
+
+class TestPastieStats(unittest.TestCase):
+    """Tests for the PastieStats class."""
+
+    def test_add_and_reconcile(self):
+        """Verify that the totals follow adjustments until reconciled."""
+        stats = PastieStats()
+        self.assertFalse(stats.reconciled)
+        stats.add("tammy", 10)
+        stats.add("tammy", 5)
+        stats.add(None, 7)
+        stats.add("tammy", -10, count=-1)
+        self.assertEqual(stats.snapshot()["per_user"], {"tammy": 1})
+        self.assertEqual(stats.snapshot()["bytes"], 12)
+
+        self.assertEqual(stats.reconcile([("tammy", 1), ("alex", 2)]), 0)
+        self.assertTrue(stats.reconciled)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["pasties"], 2)
+        self.assertEqual(snapshot["bytes"], 3)
+        self.assertEqual(snapshot["per_user"], {"tammy": 1, "alex": 1})
+
+
+class TestStatsThroughDatastore(unittest.TestCase):
+    """Tests for the statistics kept by a Datastore."""
+
+    def setUp(self):
+        self.datastore = Datastore(engine=MemoryEngine())
+
+    def test_statistics_follow_writes(self):
+        """Verify that writes adjust the statistics without a rescan."""
+        self.datastore.create_pastie({"content": "abc", "owner": "tammy"})
+        self.assertEqual(self.datastore.get_stats()["pasties"], 1)
+        self.datastore.create_pasties([{"content": "de", "owner": "alex"},
+                                       {"content": "f"}])
+        self.datastore.update_pastie(1, {"content": "abcdef"})
+        self.datastore.patch_pastie(2, [(None, None, b"gh")])
+        self.datastore.delete_pastie(3)
+        stats = self.datastore.get_stats()
+        self.assertEqual(stats["pasties"], 2)
+        self.assertEqual(stats["bytes"], 10)
+        self.assertEqual(stats["per_user"], {"tammy": 1, "alex": 1})
+        self.assertEqual(self.datastore.reconcile_stats(), 0)
+        self.assertEqual(self.datastore.get_stats()["bytes"], 10)
+
+    def test_reconciler_corrects_drift(self):
+        """Verify that reconciling picks up writes made behind the
+        datastore's back."""
+        self.datastore.create_pastie({"content": "abc"})
+        self.datastore.get_stats()
+        self.datastore.engine.insert({"id": 2, "content": "legacy"})
+        self.assertEqual(self.datastore.get_pasties_count(), 1)
+        reconciler = StatsReconciler(self.datastore)
+        self.assertEqual(reconciler.run_once(), 1)
+        self.assertEqual(reconciler.stats["passes"], 1)
+        self.assertEqual(self.datastore.get_stats()["bytes"], 9)
+
+    def test_reconciler_failures_are_logged(self):
+        """Verify that a reconciliation which fails is logged."""
+        reconciler = StatsReconciler(self.datastore)
+        with mock.patch.object(self.datastore, "reconcile_stats",
+                               side_effect=RuntimeError("database down")):
+            with self.assertLogs("stats", "ERROR") as logs:
+                reconciler.start(interval=0.01)
+                deadline = time.time() + 5
+                while not logs.records and time.time() < deadline:
+                    time.sleep(0.01)
+                reconciler.stop()
+        self.assertIn("database down", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,266 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_storage.py
+Description : Unit tests for the storage engines.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import unittest
+from unittest import mock
+
+from pymongo.errors import DuplicateKeyError
+
+from storage import MemoryEngine, MongoEngine, SQLiteEngine, make_engine, \
+    match_query
+
+MONGO_CONFIG = {
+    "hostname": "localhost",
+    "port": 27017,
+    "db_name": "tammypaste",
+    "auth_source": "admin",
+    "auth_mechanism": "SCRAM-SHA-256",
+    "api_server": {"username": "user", "password": "password"},
+}
+
+
+class EngineTests:
+    """Tests shared by all of the embedded storage engines."""
+
+    def make_engine(self):
+        """Create the engine under test."""
+        raise NotImplementedError
+
+    def setUp(self):
+        self.engine = self.make_engine()
+        for pastie_id in (3, 1, 2):
+            self.engine.insert({"id": pastie_id,
+                                "content": f"pastie {pastie_id}"})
+
+    def test_get_pastie(self):
+        """Verify that documents can be looked up by numeric ID."""
+        self.assertEqual(self.engine.get(2)["content"], "pastie 2")
+        self.assertIsNone(self.engine.get(4))
+
+    def test_get_pastie_by_unique_id(self):
+        """Verify that documents can be looked up by their _id key."""
+        doc = self.engine.get(1)
+        self.assertEqual(self.engine.get_by_unique_id(doc["_id"])["id"], 1)
+
+    def test_insert_duplicate_id_throws_error(self):
+        """Check that inserting an existing ID raises ValueError."""
+        with self.assertRaises(ValueError):
+            self.engine.insert({"id": 1, "content": "again"})
+
+    def test_counter(self):
+        """Verify that counters start at zero and increment."""
+        self.assertEqual(self.engine.increment_counter("pasties"), 1)
+        self.assertEqual(self.engine.increment_counter("pasties", 10), 11)
+
+    def test_replace(self):
+        """Verify that replace keeps the ID and reports misses."""
+        self.assertTrue(self.engine.replace(1, {"content": "new"}))
+        self.assertEqual(self.engine.get(1)["content"], "new")
+        self.assertEqual(self.engine.get(1)["id"], 1)
+        self.assertFalse(self.engine.replace(4, {"content": "new"}))
+
+    def test_delete(self):
+        """Verify that delete removes a document."""
+        self.assertEqual(self.engine.delete(2)["id"], 2)
+        self.assertIsNone(self.engine.delete(2))
+        self.assertEqual(self.engine.count(), 2)
+
+    def test_find_is_sorted_by_id(self):
+        """Verify that find returns documents in ID order."""
+        self.assertEqual([p["id"] for p in self.engine.find()], [1, 2, 3])
+
+    def test_find_with_filter_and_limit(self):
+        """Verify that find honors a query and a record limit."""
+        found = self.engine.find({"id": {"$gt": 1}}, max_records=1)
+        self.assertEqual([p["id"] for p in found], [2])
+        self.assertEqual(self.engine.count({"content": "pastie 3"}), 1)
+
+    def test_find_with_projection(self):
+        """Verify that find can return just some fields of each document."""
+        found = list(self.engine.find({"id": 2}, fields=["id"]))
+        self.assertEqual(found, [{"id": 2}])
+
+    def test_body_reference_counting(self):
+        """Verify that a stored body lasts until its last reference goes."""
+        body = {"data": b"abc", "codec": "none", "size": 3}
+        self.engine.add_body_ref("digest", body)
+        self.engine.add_body_ref("digest", body)
+        self.engine.release_body_ref("digest")
+        self.assertEqual(self.engine.get_body("digest")["data"], b"abc")
+        self.engine.release_body_ref("digest")
+        self.assertIsNone(self.engine.get_body("digest"))
+
+    def test_chunks(self):
+        """Verify that chunks are read back in the order asked for."""
+        for key, data in (("a", b"aa"), ("b", b"bb"), ("c", b"cc")):
+            self.engine.put_chunk(key, data)
+        self.assertEqual(list(self.engine.get_chunks(["c", "a"])),
+                         [b"cc", b"aa"])
+        self.engine.delete_chunks(["a", "b"])
+        self.assertEqual(list(self.engine.get_chunks(["a", "c"])),
+                         [b"", b"cc"])
+
+    def test_postings(self):
+        """Verify that search postings can be stored, found and removed."""
+        self.engine.put_postings(1, {"w:foo": 2, "w:bar": 1})
+        self.engine.put_postings(2, {"w:foo": 1})
+        self.assertEqual(self.engine.find_postings("w:foo"), {1: 2, 2: 1})
+        self.assertEqual(self.engine.find_postings("w:foo", [2, 3]), {2: 1})
+        self.assertEqual(self.engine.count_postings("w:foo"), 2)
+        self.assertEqual(self.engine.get_postings(1),
+                         {"w:foo": 2, "w:bar": 1})
+        self.engine.delete_postings(1, ["w:bar"])
+        self.assertEqual(self.engine.get_postings(1), {"w:foo": 2})
+        self.engine.delete_postings(1)
+        self.assertEqual(self.engine.find_postings("w:foo"), {2: 1})
+        self.engine.clear_postings()
+        self.assertEqual(self.engine.count_postings("w:foo"), 0)
+
+    def test_expired_ids(self):
+        """Verify that expired documents are found soonest expiry first."""
+        self.engine.insert({"id": 10, "expires_at": 50.0})
+        self.engine.insert({"id": 11, "expires_at": 20.0})
+        self.engine.insert({"id": 12, "expires_at": 500.0})
+        self.assertEqual(self.engine.expired_ids(100.0, 10), [11, 10])
+        self.assertEqual(self.engine.expired_ids(100.0, 1), [11])
+
+    def test_update(self):
+        """Verify that partial updates apply only when the expected field
+        values match."""
+        self.engine.insert({"id": 9, "updated_at": "t1",
+                            "file": {"chunks": ["a"], "length": 1}})
+        self.assertTrue(self.engine.update(
+            9, {"$set": {"updated_at": "t2", "file.length": 3},
+                "$push": {"file.chunks": {"$each": ["b", "c"]}}},
+            {"updated_at": "t1"}))
+        self.assertFalse(self.engine.update(
+            9, {"$set": {"updated_at": "t3"}}, {"updated_at": "t1"}))
+        self.assertTrue(self.engine.update(
+            9, {"$set": {"file.chunks.0": "z"}, "$unset": {"updated_at": ""}}))
+        self.assertEqual(self.engine.get(9)["file"],
+                         {"chunks": ["z", "b", "c"], "length": 3})
+        self.assertNotIn("updated_at", self.engine.get(9))
+        self.assertFalse(self.engine.update(10, {"$set": {"x": 1}}))
+
+
+class TestMemoryEngine(EngineTests, unittest.TestCase):
+    """Tests for the in-memory storage engine."""
+
+    def make_engine(self):
+        return MemoryEngine()
+
+
+class TestSQLiteEngine(EngineTests, unittest.TestCase):
+    """Tests for the SQLite storage engine."""
+
+    def make_engine(self):
+        return SQLiteEngine({"sqlite": {"path": ":memory:"}})
+
+
+class TestMongoEngine(unittest.TestCase):
+    """Tests for the mongodb storage engine (mocked)."""
+
+    def setUp(self):
+        patcher = mock.patch("storage.MongoClient")
+        self.addCleanup(patcher.stop)
+        self.client = patcher.start().return_value
+        self.engine = MongoEngine(MONGO_CONFIG)
+        self.pasties = self.client["tammypaste"].pasties
+
+    def test_ensure_indexes_creates_unique_id_index(self):
+        """Verify that ensure_indexes creates a unique index on id, and the
+        index the expired pastie reaper relies on."""
+        self.engine.ensure_indexes()
+        self.pasties.create_index.assert_any_call("id", unique=True)
+        self.pasties.create_index.assert_any_call("expires_at", sparse=True)
+
+    def test_counter_is_created(self):
+        """Verify that incrementing a counter creates it if it's missing,
+        as in a fresh database."""
+        counters = self.client["tammypaste"].counters
+        counters.find_one_and_update.return_value = {"counterValue": 7}
+        self.assertEqual(self.engine.increment_counter("pastie_id", 7), 7)
+        self.assertTrue(
+            counters.find_one_and_update.call_args.kwargs["upsert"])
+
+    def test_pool_settings(self):
+        """Verify that the pool settings are passed to the client, which
+        doesn't connect until it is used."""
+        with mock.patch("storage.MongoClient") as client_class:
+            MongoEngine(dict(MONGO_CONFIG, pool={"max_pool_size": 20,
+                                                 "socket_timeout_ms": None}))
+        options = client_class.call_args.kwargs
+        self.assertEqual(options["maxPoolSize"], 20)
+        self.assertFalse(options["connect"])
+        self.assertNotIn("socketTimeoutMS", options)
+
+    def test_insert_is_a_single_round_trip(self):
+        """Verify that insert does one insert_one and no lookups."""
+        doc = {"id": 1, "content": "hello"}
+        self.assertIs(self.engine.insert(doc), doc)
+        self.pasties.insert_one.assert_called_once_with(doc)
+        self.pasties.find_one.assert_not_called()
+
+    def test_count_all_is_estimated(self):
+        """Verify that counting every pastie doesn't scan the collection."""
+        self.pasties.estimated_document_count.return_value = 7
+        self.assertEqual(self.engine.count(), 7)
+        self.pasties.count_documents.assert_not_called()
+        self.engine.count({"owner": "tammy"})
+        self.pasties.count_documents.assert_called_once_with(
+            {"owner": "tammy"})
+
+    def test_insert_duplicate_id_throws_error(self):
+        """Check that a duplicate key error is mapped to ValueError."""
+        self.pasties.insert_one.side_effect = DuplicateKeyError("dup")
+        with self.assertRaises(ValueError):
+            self.engine.insert({"id": 1, "content": "hello"})
+
+
+class TestStorageHelpers(unittest.TestCase):
+    """Tests for the storage module helper functions."""
+
+    def test_make_engine(self):
+        """Verify that make_engine picks the configured engine."""
+        self.assertIsInstance(make_engine({"engine": "memory"}), MemoryEngine)
+        with self.assertRaises(ValueError):
+            make_engine({"engine": "nonexistent"})
+
+    def test_match_query(self):
+        """Verify the supported query operators."""
+        doc = {"id": 5, "content": "abc"}
+        self.assertTrue(match_query(doc, {"id": {"$gte": 5, "$lt": 6}}))
+        self.assertTrue(match_query(doc, {"id": {"$in": [4, 5]}}))
+        self.assertFalse(match_query(doc, {"content": "xyz"}))
+        self.assertFalse(match_query(doc, {"expires_at": {"$exists": True}}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_transfer.py
+Description : Unit tests for bulk export and import
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import glob
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+from datastore import Datastore
+from storage import MemoryEngine, SQLiteEngine
+from transfer import Progress, export_pasties, import_pasties, \
+    split_id_range
+
+
+class StopAfter(Progress):
+    """Progress which sets a stop event after a number of batches, as if
+    the transfer had been interrupted."""
+
+    def __init__(self, stop, batches):
+        super().__init__()
+        self._stop = stop
+        self._batches = batches
+
+    def add(self, pasties, size):
+        super().add(pasties, size)
+        self._batches -= 1
+        if self._batches <= 0:
+            self._stop.set()
+
+
+class TestTransfer(unittest.TestCase):
+    """Tests for export_pasties and import_pasties."""
+
+    def setUp(self):
+        self.source = Datastore(engine=MemoryEngine())
+        for number in range(1, 31):
+            self.source.create_pastie({"content": f"pastie {number}\n" * 3,
+                                       "owner": "tammy"})
+        self.source.create_pastie_from_stream(
+            io.BytesIO(b"x" * 300000 + b"\n"), {"owner": "alex"})
+        self.source.delete_pastie(5)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def assert_copied(self, target):
+        """Check that target holds the same pasties as the source."""
+        fields = ("id", "content", "owner", "created_at", "size_bytes",
+                  "line_count")
+        expected = [{field: pastie.get(field) for field in fields}
+                    for pastie in self.source.list_pasties()]
+        for pastie in expected[-1:]:
+            pastie["content"] = "x" * 300000 + "\n"
+        copied = [{field: pastie.get(field) for field in fields}
+                  for pastie in target.list_pasties()]
+        self.assertEqual(copied, expected)
+
+    def test_split_id_range(self):
+        """Verify that ID ranges cover every ID, the last one open."""
+        self.assertEqual(split_id_range(1, 10, 3),
+                         [(1, 5), (5, 9), (9, None)])
+        self.assertEqual(split_id_range(7, 7, 4), [(7, None)])
+
+    def test_round_trip(self):
+        """Verify that an export imports into an identical corpus, and that
+        the counter is moved past the imported IDs."""
+        exported = export_pasties(self.source, self.directory, workers=3,
+                                  parts=4, batch_size=4)
+        self.assertEqual(exported.pasties, 30)
+        self.assertEqual(len(glob.glob(os.path.join(self.directory,
+                                                    "*.ndjson.gz"))), 4)
+
+        target = Datastore(engine=MemoryEngine())
+        imported = import_pasties(target, self.directory, workers=2,
+                                  batch_size=5)
+        self.assertEqual(imported.pasties, 30)
+        self.assert_copied(target)
+        self.assertEqual(target.get_stats()["per_user"],
+                         {"tammy": 29, "alex": 1})
+        self.assertEqual(target.create_pastie({"content": "new"})["id"], 32)
+
+    def test_import_into_empty_database(self):
+        """Verify that an import into a database which has never had a
+        pastie (nor a pastie counter) moves the counter."""
+        export_pasties(self.source, self.directory)
+        target = Datastore(engine=SQLiteEngine({"sqlite":
+                                                {"path": ":memory:"}}))
+        import_pasties(target, self.directory)
+        self.assertEqual(target.id_allocator.counter_value, 31)
+        self.assertEqual(target.create_pastie({"content": "new"})["id"], 32)
+
+    def test_binary_round_trip(self):
+        """Verify that a raw body which isn't UTF-8 is copied unchanged."""
+        pastie = self.source.create_pastie_from_stream(
+            io.BytesIO(b"\xff\xfe binary\n"), {"owner": "alex"})
+        export_pasties(self.source, self.directory, parts=2)
+        target = Datastore(engine=MemoryEngine())
+        import_pasties(target, self.directory)
+        copied = target.get_pastie(pastie["id"])
+        self.assertEqual(b"".join(target.iter_pastie_content(copied)),
+                         b"\xff\xfe binary\n")
+        self.assertEqual(copied["owner"], "alex")
+
+    def test_resume(self):
+        """Verify that interrupted transfers carry on where they stopped,
+        without repeating or losing pasties."""
+        stop = threading.Event()
+        first = export_pasties(self.source, self.directory, workers=1,
+                               parts=2, batch_size=4,
+                               progress=StopAfter(stop, 2), stop=stop)
+        self.assertEqual(first.pasties, 8)
+        rest = export_pasties(self.source, self.directory, workers=2,
+                              batch_size=4)
+        self.assertEqual(rest.pasties, 22)
+
+        target = Datastore(engine=MemoryEngine())
+        stop = threading.Event()
+        import_pasties(target, self.directory, workers=1, batch_size=3,
+                       progress=StopAfter(stop, 3), stop=stop)
+        self.assertEqual(target.get_stats()["pasties"], 9)
+        # Nothing moves the counter until the import is complete.
+        self.assertEqual(target.id_allocator.counter_value, 0)
+        rest = import_pasties(target, self.directory, batch_size=3)
+        self.assertEqual(rest.pasties, 21)
+        self.assert_copied(target)
+        self.assertEqual(target.id_allocator.counter_value, 31)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : test_writebehind.py
+Description : Unit tests for the write-behind queue
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+import yaml
+
+from datastore import Datastore
+from storage import MemoryEngine
+from writebehind import QueueFullError, WriteBehindQueue
+
+
+class GatedEngine(MemoryEngine):
+    """A memory engine whose batch inserts wait until they are let through,
+    and fail while failing is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.failing = False
+        self.batches = []
+
+    def insert_many(self, docs):
+        self.gate.wait()
+        if self.failing:
+            raise ConnectionError("database unavailable")
+        self.batches.append(len(docs))
+        return super().insert_many(docs)
+
+
+class PartlyFailingEngine(MemoryEngine):
+    """A memory engine whose first batch insert stores only the first
+    pastie before the connection drops."""
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    def insert_many(self, docs):
+        if not self.failed:
+            self.failed = True
+            self.insert(docs[0])
+            raise ConnectionError("connection lost")
+        return super().insert_many(docs)
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+    """Tests for the WriteBehindQueue class."""
+
+    def setUp(self):
+        self.engine = GatedEngine()
+        self.queue = WriteBehindQueue(self.engine, max_pending=4,
+                                      batch_size=3, flush_interval=60,
+                                      put_timeout=0.05, retry_pause=0.01)
+
+    def tearDown(self):
+        self.engine.gate.set()
+        self.engine.failing = False
+        self.queue.close()
+
+    def test_batches(self):
+        """Verify that pasties are inserted a full batch at a time, and
+        stay readable until they are."""
+        self.engine.gate.clear()
+        for pastie_id in range(1, 5):
+            self.queue.put(pastie_id, {"id": pastie_id})
+        self.assertEqual(self.queue.get(4), {"id": 4})
+        self.engine.gate.set()
+        self.queue.flush()
+        self.assertEqual(self.engine.batches, [3, 1])
+        self.assertIsNone(self.queue.get(4))
+        self.assertEqual(self.engine.get(4)["id"], 4)
+        stats = self.queue.stats
+        self.assertEqual((stats["queued"], stats["inserted"],
+                          stats["batches"], stats["pending"]), (4, 4, 2, 0))
+
+    def test_backpressure(self):
+        """Verify that a full queue turns pasties away."""
+        self.engine.gate.clear()
+        for pastie_id in range(1, 5):
+            self.queue.put(pastie_id, {"id": pastie_id})
+        with self.assertRaises(QueueFullError):
+            self.queue.put(5, {"id": 5})
+
+    def test_retries(self):
+        """Verify that a failed batch stays queued and is retried."""
+        self.engine.failing = True
+        self.queue.put(1, {"id": 1})
+        flushed = threading.Thread(target=self.queue.flush)
+        flushed.start()
+        flushed.join(0.1)
+        self.assertTrue(self.queue.is_pending(1))
+        self.assertGreater(self.queue.stats["retries"], 0)
+        self.engine.failing = False
+        flushed.join()
+        self.assertFalse(self.queue.is_pending(1))
+        self.assertIsNotNone(self.engine.get(1))
+
+    def test_flush_times_out(self):
+        """Verify that waiting for one pastie gives up while the engine is
+        failing, rather than holding up the request for ever."""
+        self.engine.failing = True
+        self.queue.put(1, {"id": 1})
+        with self.assertRaises(QueueFullError):
+            self.queue.flush(1)
+        self.assertTrue(self.queue.is_pending(1))
+
+    def test_partly_inserted_batch(self):
+        """Verify that pasties inserted before a batch failed part way
+        through aren't reported as clashing with themselves on the
+        retry."""
+        rejected = []
+        engine = PartlyFailingEngine()
+        queue = WriteBehindQueue(engine, batch_size=2, flush_interval=60,
+                                 retry_pause=0.01,
+                                 on_rejected=lambda *args:
+                                 rejected.append(args))
+        engine.insert({"id": 3, "_id": "other"})
+        for pastie_id in range(1, 4):
+            queue.put(pastie_id, {"id": pastie_id, "_id": f"queued{pastie_id}",
+                                  "content": "queued"})
+        with self.assertLogs("writebehind", "ERROR"):
+            queue.close()
+        self.assertEqual([args[0] for args in rejected], [3])
+        self.assertEqual(engine.get(1)["content"], "queued")
+        stats = queue.stats
+        self.assertEqual((stats["inserted"], stats["rejected"],
+                          stats["retries"]), (2, 1, 1))
+
+    def test_close_gives_up(self):
+        """Verify that close stops retrying a failing engine after its
+        timeout."""
+        self.engine.failing = True
+        self.queue.put(1, {"id": 1})
+        self.queue.close(timeout=0.1)
+        self.assertFalse(self.queue.is_pending(1))
+        self.assertEqual(self.queue.stats["abandoned"], 1)
+
+    def test_close_drains(self):
+        """Verify that closing the queue inserts what's left."""
+        self.queue.put(1, {"id": 1})
+        self.queue.close()
+        self.assertIsNotNone(self.engine.get(1))
+        with self.assertRaises(QueueFullError):
+            self.queue.put(2, {"id": 2})
+
+
+class TestWriteBehindDatastore(unittest.TestCase):
+    """Tests for a Datastore in write-behind mode."""
+
+    def setUp(self):
+        with open("config.yaml") as config_file:
+            config = yaml.safe_load(config_file)
+        config["write_behind"] = {"enabled": True, "flush_interval": 60,
+                                  "put_timeout": 0.1}
+        config_fd, self.config_path = tempfile.mkstemp(suffix=".yaml")
+        with os.fdopen(config_fd, "w") as config_file:
+            yaml.safe_dump(config, config_file)
+        self.engine = GatedEngine()
+        self.datastore = Datastore(self.config_path, engine=self.engine)
+
+    def tearDown(self):
+        self.engine.gate.set()
+        self.datastore.close()
+        os.unlink(self.config_path)
+
+    def test_reads_own_writes(self):
+        """Verify that a queued pastie can be read before it's inserted."""
+        pastie = self.datastore.create_pastie({"content": "queued"})
+        self.assertIsNone(self.engine.get(pastie["id"]))
+        self.assertEqual(self.datastore.get_pastie(pastie["id"])["content"],
+                         "queued")
+        self.assertEqual(
+            self.datastore.get_pastie(pastie["_id"],
+                                      search_by_unique_id=True)["id"],
+            pastie["id"])
+        self.assertEqual(
+            self.datastore.get_pasties([pastie["id"]])[pastie["id"]]
+            ["content"], "queued")
+        self.datastore.write_behind.flush()
+        self.assertIsNotNone(self.engine.get(pastie["id"]))
+
+    def test_changes_pending_pastie(self):
+        """Verify that updating or deleting a queued pastie inserts it
+        first."""
+        first = self.datastore.create_pastie({"content": "one"})
+        second = self.datastore.create_pastie({"content": "two"})
+        self.datastore.update_pastie(first["id"], {"content": "uno"})
+        self.assertEqual(self.datastore.get_pastie(first["id"])["content"],
+                         "uno")
+        self.assertEqual(self.datastore.delete_pastie(second["id"]), 1)
+        self.assertIsNone(self.datastore.get_pastie(second["id"]))
+        self.assertEqual(self.datastore.get_stats()["pasties"], 1)
+
+    def test_change_waits_no_longer_than_put_timeout(self):
+        """Verify that changing a queued pastie while the engine is down
+        is turned away instead of waiting for ever."""
+        pastie = self.datastore.create_pastie({"content": "queued"})
+        self.engine.failing = True
+        with self.assertRaises(QueueFullError):
+            self.datastore.update_pastie(pastie["id"], {"content": "new"})
+        self.engine.failing = False
+
+    def test_explicit_id_is_synchronous(self):
+        """Verify that a clashing ID is still reported straight away."""
+        pastie = self.datastore.create_pastie({"content": "queued"})
+        with self.assertRaises(ValueError):
+            self.datastore.create_pastie({"id": pastie["id"],
+                                          "content": "clash"})
+        queued = self.datastore.create_pastie({"content": "queued again"})
+        [(_, error)] = self.datastore.create_pasties(
+            [{"id": queued["id"], "content": "clash"}])
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(self.datastore.get_pastie(queued["id"])["content"],
+                         "queued again")
+        self.assertEqual(self.datastore.get_stats()["pasties"], 2)
+
+    def test_rejected_pastie_is_undone(self):
+        """Verify that a queued pastie the engine rejects is taken back
+        out of the statistics and the search index."""
+        pastie = self.datastore.create_pastie({"content": "queued " * 1000})
+        self.engine.insert({"id": pastie["id"], "content": "already here"})
+        with self.assertLogs("writebehind", "ERROR"):
+            self.datastore.write_behind.flush()
+        self.assertEqual(self.datastore.write_behind.stats["rejected"], 1)
+        self.assertEqual(self.datastore.get_pastie(pastie["id"])["content"],
+                         "already here")
+        # Only the pastie inserted behind the datastore's back is missing.
+        self.assertEqual(self.datastore.reconcile_stats(), 1)
+        self.assertEqual(self.datastore.search_pasties("queued", 10),
+                         ([], 0))
+        self.assertEqual(self.engine._bodies, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,351 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : transfer.py
+Description : Parallel, resumable bulk export and import of all pasties, as
+              gzip-compressed newline-delimited JSON files split by pastie
+              ID range. Run this file with "export" or "import" and a
+              directory.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import glob
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from content import BODY_FIELDS, SUMMARY_FIELDS
+from schema import ndjson_line
+
+DEFAULT_WORKERS = 4
+# Number of pastie ID ranges (and so files) an export is split into
+DEFAULT_PARTS = 16
+# Pasties written or inserted between checkpoints
+DEFAULT_BATCH_SIZE = 1000
+# gzip compression level of the exported files
+COMPRESS_LEVEL = 6
+# Seconds between progress reports
+REPORT_INTERVAL = 5
+
+EXPORT_CHECKPOINT = "export-checkpoint.json"
+IMPORT_CHECKPOINT = "import-checkpoint.json"
+PART_FILE_PATTERN = "pasties-*.ndjson.gz"
+
+# Fields which aren't exported: they are assigned or worked out again when
+# the pasties are imported.
+_DROPPED_FIELDS = frozenset(("_id",) + BODY_FIELDS + SUMMARY_FIELDS)
+
+
+class Progress:
+    """Counts the pasties and (uncompressed) bytes transferred, from any
+    number of threads, and reports the transfer rate."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.pasties = 0
+        self.bytes = 0
+
+    def add(self, pasties, size):
+        """Count a batch of pasties of a total size in bytes."""
+
+        with self._lock:
+            self.pasties += pasties
+            self.bytes += size
+
+    def report(self):
+        """Describe the progress so far, and the rate."""
+
+        elapsed = max(time.perf_counter() - self._started, 1e-9)
+        megabytes = self.bytes / (1024 * 1024)
+        return (f"{self.pasties} pasties ({self.pasties / elapsed:.0f}/s), "
+                f"{megabytes:.1f} MB ({megabytes / elapsed:.1f} MB/s) "
+                f"in {elapsed:.1f}s")
+
+
+class Checkpoint:
+    """The state of a transfer, saved to a JSON file after every batch so
+    an interrupted transfer can carry on where it stopped."""
+
+    def __init__(self, path):
+        """Load the checkpoint saved at path, if there is one."""
+
+        self._path = path
+        self._lock = threading.Lock()
+        self.state = None
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.state = json.load(checkpoint_file)
+
+    def save(self):
+        """Write the state out, replacing the saved one in one step."""
+
+        with self._lock:
+            self._write()
+
+    def update(self, part, **changes):
+        """Change the fields of one part of the state and save it, without
+        another thread's save seeing only some of the changes."""
+
+        with self._lock:
+            part.update(changes)
+            self._write()
+
+    def _write(self):
+        """Write the state out. Must be called with the lock held."""
+
+        temp_path = self._path + ".tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(self.state, checkpoint_file, indent=1)
+        os.replace(temp_path, self._path)
+
+
+def split_id_range(first_id, last_id, parts):
+    """Split the pastie IDs from first_id to last_id into up to parts
+    (start, end) ranges, end being exclusive. The last range is left open
+    (end is None), to take any pasties above last_id."""
+
+    size = max(1, -(-(last_id - first_id + 1) // parts))
+    starts = list(range(first_id, last_id + 1, size)) or [first_id]
+    return [(start, end) for start, end
+            in zip(starts, starts[1:] + [None])]
+
+
+def export_record(datastore, pastie):
+    """Get the fields of a pastie which are exported, with its whole body
+    as the content field, or as a content_base64 field if the body was
+    uploaded raw and isn't valid UTF-8."""
+
+    record = {field: value for field, value in pastie.items()
+              if field not in _DROPPED_FIELDS}
+    if "content_file" in pastie:
+        body = b"".join(datastore.iter_pastie_content(pastie))
+        try:
+            record["content"] = body.decode("utf-8")
+        except UnicodeDecodeError:
+            record["content_base64"] = base64.b64encode(body).decode("ascii")
+    else:
+        record["content"] = pastie.get("content")
+    return record
+
+
+def _import_binary(datastore, record):
+    """Create a pastie from a record with a content_base64 field, storing
+    its body byte for byte. Returns the error if it can't be created."""
+
+    body = base64.b64decode(record.pop("content_base64"))
+    try:
+        datastore.create_pastie_from_stream(io.BytesIO(body), record)
+    except ValueError as error:
+        return error
+    return None
+
+
+def _export_part(datastore, directory, checkpoint, part, batch_size,
+                 progress, stop):
+    """Export the pasties in one ID range, continuing after the last one
+    checkpointed. Each batch is written as a gzip member of its own, so the
+    file can be cut back to the end of the last checkpointed batch."""
+
+    path = os.path.join(directory, part["file"])
+    query = {"id": {"$gte": part["start"]}}
+    if part["end"] is not None:
+        query["id"]["$lt"] = part["end"]
+    pasties = datastore.list_pasties(query, after_id=part["last_id"])
+    with open(path, "r+b" if os.path.exists(path) else "wb") as out:
+        out.truncate(part["offset"])
+        out.seek(part["offset"])
+        while not stop.is_set():
+            batch = list(itertools.islice(pasties, batch_size))
+            if not batch:
+                checkpoint.update(part, done=True)
+                break
+            data = b"".join(ndjson_line(export_record(datastore, pastie))
+                            for pastie in batch)
+            out.write(gzip.compress(data, COMPRESS_LEVEL))
+            out.flush()
+            os.fsync(out.fileno())
+            checkpoint.update(part, last_id=batch[-1]["id"],
+                              offset=out.tell(),
+                              count=part["count"] + len(batch))
+            progress.add(len(batch), len(data))
+
+
+def _import_part(datastore, directory, checkpoint, part, batch_size,
+                 progress, stop):
+    """Import the pasties in one exported file with bulk inserts, skipping
+    those already checkpointed. Pasties which already exist (inserted by
+    a batch which was interrupted before its checkpoint) are skipped."""
+
+    with gzip.open(os.path.join(directory, part["file"]), "rb") as lines:
+        lines = itertools.islice(lines, part["lines"], None)
+        while not stop.is_set():
+            batch = list(itertools.islice(lines, batch_size))
+            if not batch:
+                checkpoint.update(part, done=True)
+                break
+            pasties = [json.loads(line) for line in batch]
+            errors = [_import_binary(datastore, dict(pastie))
+                      for pastie in pasties if "content_base64" in pastie]
+            errors += [error for _, error in datastore.create_pasties(
+                [pastie for pastie in pasties
+                 if "content_base64" not in pastie])]
+            failed = sum(1 for error in errors if error is not None)
+            checkpoint.update(
+                part, lines=part["lines"] + len(batch),
+                imported=part["imported"] + len(batch) - failed,
+                skipped=part["skipped"] + failed,
+                max_id=max([part["max_id"] or 0] +
+                           [pastie["id"] for pastie in pasties]))
+            progress.add(len(batch), sum(len(line) for line in batch))
+
+
+def _run_parts(worker, parts, workers, progress, stop, report):
+    """Run worker over every unfinished part on a pool of threads,
+    reporting progress every REPORT_INTERVAL seconds. An interrupt stops
+    the workers after their current batch."""
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(worker, part) for part in parts
+                   if not part["done"]]
+        try:
+            while True:
+                done, pending = concurrent.futures.wait(
+                    futures, REPORT_INTERVAL,
+                    concurrent.futures.FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+                if not pending:
+                    break
+                if report is not None:
+                    report(progress.report())
+        except BaseException:
+            stop.set()
+            raise
+
+
+def export_pasties(datastore, directory, workers=DEFAULT_WORKERS,
+                   parts=DEFAULT_PARTS, batch_size=DEFAULT_BATCH_SIZE,
+                   progress=None, stop=None, report=None):
+    """Export every pastie into a directory, as gzip-compressed NDJSON
+    files each holding one range of pastie IDs, written by a pool of
+    workers threads. If the directory holds the checkpoint of an earlier
+    export which didn't finish, that export is carried on instead.
+
+    Setting the stop event makes the workers stop after their current
+    batch. report, if given, is called with a progress message every
+    REPORT_INTERVAL seconds. Returns the Progress of this run."""
+
+    os.makedirs(directory, exist_ok=True)
+    progress = progress or Progress()
+    stop = stop or threading.Event()
+    checkpoint = Checkpoint(os.path.join(directory, EXPORT_CHECKPOINT))
+    if checkpoint.state is None:
+        first = next(datastore.list_pasties(max_records=1, fields=["id"]),
+                     None)
+        first_id = 1 if first is None else first["id"]
+        last_id = max(first_id, datastore.id_allocator.counter_value)
+        checkpoint.state = {"parts": [
+            {"file": f"pasties-{index:04d}.ndjson.gz", "start": start,
+             "end": end, "last_id": None, "offset": 0, "count": 0,
+             "done": False}
+            for index, (start, end) in enumerate(
+                split_id_range(first_id, last_id, parts))]}
+        checkpoint.save()
+
+    _run_parts(lambda part: _export_part(datastore, directory, checkpoint,
+                                         part, batch_size, progress, stop),
+               checkpoint.state["parts"], workers, progress, stop, report)
+    return progress
+
+
+def import_pasties(datastore, directory, workers=DEFAULT_WORKERS,
+                   batch_size=DEFAULT_BATCH_SIZE, progress=None, stop=None,
+                   report=None):
+    """Import the pasties exported into a directory by export_pasties,
+    keeping their IDs, with a pool of workers threads each inserting
+    batch_size pasties at a time. Once every file has been imported, the
+    pastie counter is moved past the highest imported ID so new pasties
+    don't clash with them. If the directory holds the checkpoint of an
+    earlier import which didn't finish, that import is carried on instead.
+
+    stop and report are as for export_pasties. Returns the Progress of
+    this run."""
+
+    progress = progress or Progress()
+    stop = stop or threading.Event()
+    checkpoint = Checkpoint(os.path.join(directory, IMPORT_CHECKPOINT))
+    if checkpoint.state is None:
+        checkpoint.state = {"parts": [
+            {"file": os.path.basename(path), "lines": 0, "imported": 0,
+             "skipped": 0, "max_id": None, "done": False}
+            for path in sorted(glob.glob(os.path.join(directory,
+                                                      PART_FILE_PATTERN)))]}
+        checkpoint.save()
+
+    parts = checkpoint.state["parts"]
+    _run_parts(lambda part: _import_part(datastore, directory, checkpoint,
+                                         part, batch_size, progress, stop),
+               parts, workers, progress, stop, report)
+    if all(part["done"] for part in parts):
+        datastore.id_allocator.reserve_through(
+            max([part["max_id"] or 0 for part in parts] + [0]))
+    return progress
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Export or import every pastie in bulk")
+    parser.add_argument("direction", choices=("export", "import"))
+    parser.add_argument("directory")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--parts", type=int, default=DEFAULT_PARTS,
+                        help="ID ranges (files) an export is split into")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    from datastore import Datastore
+    store = Datastore(args.config)
+    try:
+        if args.direction == "export":
+            done = export_pasties(store, args.directory, args.workers,
+                                  args.parts, args.batch_size,
+                                  report=print)
+        else:
+            done = import_pasties(store, args.directory, args.workers,
+                                  args.batch_size, report=print)
+    except KeyboardInterrupt:
+        sys.exit("Interrupted; run the same command again to carry on")
+    finally:
+        store.close()
+    print(f"Finished {args.direction}: {done.report()}")
@@ -0,0 +1,295 @@
+"""
+tammypaste: A simple Pastebin-like service with Python, Flask, MongoDB.
+Tammy Cravit <tammymakesthings@gmail.com>
+Version 1.0, 2020-04-15
+
+File        : writebehind.py
+Description : Write-behind queue for new pasties: pasties are acknowledged
+              as soon as they are queued, and a background thread inserts
+              them into the storage engine in batches.
+==============================================================================
+Copyright 2020 Tammy Cravit <tammymakesthings@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import itertools
+import logging
+import threading
+import time
+
+from content import BODY_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a pastie can't be queued because the queue has stayed
+    full for too long."""
+
+
+class WriteBehindQueue:
+    """A bounded queue of new pasties waiting to be inserted.
+
+    put adds a pastie to the queue and returns straight away, unless the
+    queue already holds max_pending pasties, in which case it waits up to
+    put_timeout seconds for room and then raises a QueueFullError. A
+    background thread inserts the queued pasties with insert_many, as soon
+    as batch_size of them are waiting or flush_interval seconds after the
+    oldest was queued. A pastie stays readable through get until it has
+    been inserted. If an insert fails, the batch stays queued and is
+    retried, so a pastie put on the queue is never lost while the process
+    is running; close inserts everything still queued, giving up after its
+    timeout if the engine keeps failing. A pastie the engine rejects (its
+    ID is taken) is logged and passed to on_rejected, as on_rejected(ID,
+    document, error), so its side effects can be undone.
+
+    The stats property reports the number of pasties queued, inserted,
+    rejected by the engine and abandoned by close, the number of batches
+    and retries, the number pending and the time taken by the last
+    batch."""
+
+    def __init__(self, engine, max_pending=10000, batch_size=500,
+                 flush_interval=0.05, put_timeout=1.0, retry_pause=1.0,
+                 on_rejected=None):
+        """Create a write-behind queue in front of a storage engine, and
+        start its background thread."""
+
+        self._engine = engine
+        self._max_pending = max_pending
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._put_timeout = put_timeout
+        self._retry_pause = retry_pause
+        self._on_rejected = on_rejected
+        # Pasties by ID, in the order they were queued
+        self._pending = {}
+        self._oldest = None
+        self._flushing = False
+        # Number of flush calls waiting, which make every batch due
+        self._forcing = 0
+        self._closed = False
+        self._deadline = None
+        self._changed = threading.Condition()
+        self._stats = {
+            "queued": 0,
+            "inserted": 0,
+            "rejected": 0,
+            "abandoned": 0,
+            "batches": 0,
+            "retries": 0,
+            "last_batch_seconds": 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="write-behind")
+        self._thread.start()
+
+    @property
+    def stats(self):
+        """Get the queue's statistics."""
+
+        return dict(self._stats, pending=len(self._pending))
+
+    def put(self, pastie_id, doc):
+        """Queue a pastie document for insertion, waiting for room if the
+        queue is full."""
+
+        deadline = time.monotonic() + self._put_timeout
+        with self._changed:
+            while len(self._pending) >= self._max_pending:
+                remaining = deadline - time.monotonic()
+                if self._closed or remaining <= 0:
+                    raise QueueFullError("Too many pasties are waiting to "
+                                         "be written")
+                self._changed.wait(remaining)
+            if self._closed:
+                raise QueueFullError("The write-behind queue is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending[pastie_id] = doc
+            self._stats["queued"] += 1
+            self._changed.notify_all()
+
+    def get(self, pastie_id):
+        """Get a queued pastie document, or None if it isn't queued."""
+
+        return self._pending.get(pastie_id)
+
+    def get_by_unique_id(self, unique_id):
+        """Get a queued pastie document by its unique ID, or None if it
+        isn't queued."""
+
+        with self._changed:
+            for doc in self._pending.values():
+                if doc["_id"] == unique_id:
+                    return doc
+        return None
+
+    def is_pending(self, pastie_id):
+        """Check if a pastie is waiting to be inserted."""
+
+        return pastie_id in self._pending
+
+    def _take_batch(self):
+        """Wait until a batch is due, then return it (an empty list once
+        the queue is closed and empty). Must be called with the lock
+        held."""
+
+        while True:
+            if self._pending and not self._flushing:
+                if self._closed or self._forcing or \
+                        len(self._pending) >= self._batch_size:
+                    break
+                due = self._oldest + self._flush_interval - time.monotonic()
+                if due <= 0:
+                    break
+                self._changed.wait(due)
+            elif self._closed and not self._pending:
+                return []
+            else:
+                self._changed.wait()
+        self._flushing = True
+        return list(itertools.islice(self._pending.items(),
+                                     self._batch_size))
+
+    def _insert(self, batch):
+        """Insert a batch, then drop it from the queue. Returns False if
+        the engine failed, leaving the batch queued."""
+
+        started = time.perf_counter()
+        docs = [doc for _, doc in batch]
+        try:
+            errors = self._engine.insert_many(docs)
+        except Exception:  # pylint: disable=broad-except
+            with self._changed:
+                self._flushing = False
+                self._stats["retries"] += 1
+                self._changed.notify_all()
+            return False
+        # A pastie inserted by an earlier try of this batch, before the
+        # engine failed part way through, clashes with itself.
+        errors = {index: error for index, error in errors.items()
+                  if not self._is_stored(batch[index][1])}
+        with self._changed:
+            for pastie_id, _ in batch:
+                # Dropped already if close gave up on it meanwhile
+                self._pending.pop(pastie_id, None)
+            self._oldest = time.monotonic() if self._pending else None
+            self._flushing = False
+            self._stats["inserted"] += len(batch) - len(errors)
+            self._stats["rejected"] += len(errors)
+            self._stats["batches"] += 1
+            self._stats["last_batch_seconds"] = \
+                time.perf_counter() - started
+            self._changed.notify_all()
+        for index, error in errors.items():
+            pastie_id, doc = batch[index]
+            logger.error("Queued pastie %s was rejected: %s", pastie_id,
+                         error)
+            if self._on_rejected is not None:
+                self._on_rejected(pastie_id, doc, error)
+        return True
+
+    def _is_stored(self, doc):
+        """Check if the engine already holds a queued document itself,
+        rather than another pastie with the same ID."""
+
+        stored = self._engine.get(doc["id"])
+        return stored is not None and all(
+            stored.get(field) == doc.get(field)
+            for field in ("_id", "created_at") + BODY_FIELDS)
+
+    def _abandon(self, force=False):
+        """Drop everything still queued, once close has run out of time
+        (or straight away if force is set). Returns True if close has run
+        out of time."""
+
+        with self._changed:
+            if not force and (self._deadline is None or
+                              time.monotonic() < self._deadline):
+                return False
+            if self._pending:
+                logger.error("Gave up inserting %d queued pasties",
+                             len(self._pending))
+            self._stats["abandoned"] += len(self._pending)
+            self._pending.clear()
+            self._changed.notify_all()
+            return True
+
+    def _run(self):
+        """Insert batches until the queue is closed and empty."""
+
+        while True:
+            with self._changed:
+                batch = self._take_batch()
+            if not batch:
+                return
+            if not self._insert(batch):
+                if self._abandon():
+                    return
+                time.sleep(self._retry_pause)
+
+    def flush(self, pastie_id=None):
+        """Wait until everything queued so far has been inserted, or, if
+        pastie_id is given, just until that pastie has been. A request
+        waiting on one pastie gives up after put_timeout seconds, raising a
+        QueueFullError, rather than hanging while the engine is down."""
+
+        deadline = None
+        if pastie_id is not None:
+            deadline = time.monotonic() + self._put_timeout
+        with self._changed:
+            if pastie_id is None:
+                waiting = set(self._pending)
+            elif pastie_id in self._pending:
+                waiting = {pastie_id}
+            else:
+                return
+            # Don't wait out the flush interval for a batch someone needs.
+            self._forcing += 1
+            self._changed.notify_all()
+            try:
+                while waiting & self._pending.keys():
+                    if deadline is None:
+                        self._changed.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise QueueFullError(f"Pastie {pastie_id} is still "
+                                             "waiting to be written")
+                    self._changed.wait(remaining)
+            finally:
+                self._forcing -= 1
+
+    def close(self, timeout=None):
+        """Insert everything still queued, and stop the background
+        thread. Nothing more can be queued afterwards. If timeout is given,
+        failed inserts are only retried for that many seconds, after which
+        the pasties still queued are dropped, and close waits no longer
+        than that for the thread."""
+
+        with self._changed:
+            self._closed = True
+            if timeout is not None:
+                self._deadline = time.monotonic() + timeout
+            self._changed.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self._abandon(force=True)